@@ -21,7 +21,7 @@ from kritter import get_color
 from kritter.tflite import TFliteClassifier, TFliteDetector
 from dash_devices.dependencies import Input, Output
 import dash_html_components as html
-from vizy import Vizy, MediaDisplayQueue
+from vizy import Vizy, MediaDisplayQueue, ThermalBudget, EventBus, DebouncedConfigFile, MediaStage, FrameLoop, frame_stats, ModScheduler, Viewers, DetectionLog
 import vizy.vizypowerboard as vpb
 from handlers import handle_event, handle_text
 from kritter.ktextvisor import KtextVisor, KtextVisorTable, Image, Video
@@ -44,6 +44,8 @@ PRE_POST_ROLL = 1
 DAYTIME_THRESHOLD = 20
 # Poll period (seconds) for checking for daytime
 DAYTIME_POLL_PERIOD = 10
+# Give pending event handlers and text messages this long to finish on exit.
+EVENT_BUS_CLOSE_TIMEOUT = 5 # seconds
 
 CONFIG_FILE = "birdfeeder.json"
 CONSTS_FILE = "birdfeeder_consts.py"
@@ -68,6 +70,8 @@ DEFAULT_CONFIG = {
 
 BASEDIR = os.path.dirname(os.path.realpath(__file__))
 MEDIA_DIR = os.path.join(BASEDIR, "media")
+# Detection history (see DetectionLog), in the etc directory
+DETECTION_LOG_DIR = "birdfeeder_detections"
 # Video states
 WAITING = 0
 RECORDING = 1
@@ -106,17 +110,22 @@ class Birdfeeder:
 
         # Initialize variables.
         config_filename = os.path.join(self.kapp.etcdir, CONFIG_FILE)      
-        self.config = kritter.ConfigFile(config_filename, DEFAULT_CONFIG)               
+        self.config = DebouncedConfigFile(config_filename, DEFAULT_CONFIG)               
         consts_filename = os.path.join(BASEDIR, CONSTS_FILE) 
-        self.config_consts = kritter.import_config(consts_filename, self.kapp.etcdir, ["IMAGES_KEEP", "IMAGES_DISPLAY", "PICKER_TIMEOUT", "GPHOTO_ALBUM", "MEDIA_QUEUE_IMAGE_WIDTH", "DEFEND_BIT", "CLASSIFIER", "TRACKER_DISAPPEARED_DISTANCE", "TRACKER_MAX_DISAPPEARED", "TRACKER_CLASS_SWITCH"]) 
+        self.config_consts = kritter.import_config(consts_filename, self.kapp.etcdir, ["IMAGES_KEEP", "IMAGES_DISPLAY", "MEDIA_STAGING", "PICKER_TIMEOUT", "GPHOTO_ALBUM", "MEDIA_QUEUE_IMAGE_WIDTH", "DEFEND_BIT", "CLASSIFIER", "TRACKER_DISAPPEARED_DISTANCE", "TRACKER_MAX_DISAPPEARED", "TRACKER_CLASS_SWITCH"]) 
         self.lock = RLock()
         self.record = None
-        self._grab_thread = None
+        self.mod_scheduler = ModScheduler(self.kapp)
+        self.viewers = Viewers(self.kapp)
+        self._create_frame_loop()
         self.detector = None
         self.record_state = WAITING
         self.take_pic = False
         self.defend_thread = None
         self.daytime = kritter.CalcDaytime(DAYTIME_THRESHOLD, DAYTIME_POLL_PERIOD)
+        self.thermal = ThermalBudget()
+        # Event handlers and text messages run here so they don't hold up the frame grabbing thread.
+        self.event_bus = EventBus()
         # Create unique identifier to mark photos
         self.uuid = bytes(self.kapp.uuid).hex().upper()
         # Map 1 to 100 (sensitivity) to 0.9 to 0.1 (detection threshold)
@@ -151,17 +160,39 @@ class Birdfeeder:
                     try:
                         if image.endswith(".mp4"):
                             res.append(f"{data['timestamp']} Video")
-                            res.append(Video(os.path.join(MEDIA_DIR, image)))
+                            res.append(Video(self.media_stage.path(image)))
                         else:
                             res.append(f"{data['timestamp']} {data['dets'][0]['class']}")
-                            res.append(Image(os.path.join(MEDIA_DIR, image)))                            
+                            res.append(Image(self.media_stage.path(image)))                            
                     except:
                         pass
                     else:
                         if len(res)//2==n:
                             break
                 return res
-            tv_table = KtextVisorTable({"mrm": (mrm, "Displays the most recent birdfeeder picture/video, or n media with optional n argument.")})
+            def thermal(words, sender, context):
+                metrics = self.thermal.metrics()
+                if not metrics:
+                    return "No thermal data yet."
+                return [f"{t}\u00b0C: {fps:.1f} fps, {ips:.1f} detections/s" for t, (fps, ips) in metrics.items()]
+            def events(words, sender, context):
+                return self.event_bus.summary()
+            def storage(words, sender, context):
+                return self.media_stage.summary()
+            def frames(words, sender, context):
+                return frame_stats(self.frame_loop, self.mod_scheduler, self.viewers)
+            def stats(words, sender, context):
+                try:
+                    days = max(int(words[1]), 1)
+                except:
+                    days = 1
+                return self.detection_log.summary(days)
+            tv_table = KtextVisorTable({"mrm": (mrm, "Displays the most recent birdfeeder picture/video, or n media with optional n argument."), 
+                "thermal": (thermal, "Displays frame and detection rates versus CPU temperature."),
+                "events": (events, "Displays event handler statistics."),
+                "storage": (storage, "Displays media storage statistics."),
+                "frames": (frames, "Displays frame pipeline stage timing."),
+                "stats": (stats, "Displays detection counts for the last day, or n days with optional n argument.")})
             @self.tv.callback_receive()
             def func(words, sender, context):
                 return tv_table.lookup(words, sender, context)
@@ -178,6 +209,8 @@ class Birdfeeder:
         self.store_media = kritter.SaveMediaQueue(path=MEDIA_DIR, keep=self.config_consts.IMAGES_KEEP, keep_uploaded=self.config_consts.IMAGES_KEEP)
         if self.config['gphoto_upload']:
             self.store_media.store_media = self.gphoto_interface 
+        self.media_stage = MediaStage(MEDIA_DIR, keep=self.config_consts.IMAGES_KEEP, enable=self.config_consts.MEDIA_STAGING)
+        self.detection_log = DetectionLog(os.path.join(self.kapp.etcdir, DETECTION_LOG_DIR))
         self.tracker = kritter.DetectionTracker(maxDisappeared=self.config_consts.TRACKER_MAX_DISAPPEARED, maxDistance=self.config_consts.TRACKER_DISAPPEARED_DISTANCE, classSwitch=self.config_consts.TRACKER_CLASS_SWITCH)
         self.picker = kritter.DetectionPicker(timeout=self.config_consts.PICKER_TIMEOUT)
         self.detector_process = kritter.Processify(BirdInference, (os.path.join(BASEDIR, self.config_consts.CLASSIFIER),))
@@ -203,7 +236,7 @@ class Birdfeeder:
         self.take_pic_c.append(self.defend)
         self.take_pic_c.append(settings_button)
 
-        self.media_queue =  MediaDisplayQueue(MEDIA_DIR, STREAM_WIDTH, CAMERA_WIDTH, self.config_consts.MEDIA_QUEUE_IMAGE_WIDTH, self.config_consts.IMAGES_DISPLAY) 
+        self.media_queue =  MediaDisplayQueue(MEDIA_DIR, STREAM_WIDTH, CAMERA_WIDTH, self.config_consts.MEDIA_QUEUE_IMAGE_WIDTH, self.config_consts.IMAGES_DISPLAY, stage=self.media_stage) 
         sensitivity = kritter.Kslider(name="Detection sensitivity", value=self.config['detection_sensitivity'], mxs=(1, 100, 1), format=lambda val: f'{int(val)}%', style=dstyle)
         species_of_interest = kritter.Kchecklist(name="Species of interest", options=self.detector_process.classes(), value=self.config['species_of_interest'], clear_check_all=True, scrollable=True, style=dstyle)
         pest_species = kritter.Kchecklist(name="Pest species", options=self.detector_process.classes(), value=self.config['pest_species'], clear_check_all=True, scrollable=True, style=dstyle)
@@ -313,39 +346,36 @@ class Birdfeeder:
         def func():
             return settings.out_open(True)
 
-        # Run camera grab thread.
-        self.run_thread = True
-        self._grab_thread = Thread(target=self.grab_thread)
-        self._grab_thread.start()
+        # Run camera frame loop.
+        self.frame_loop.start()
 
         # Run Kritter server, which blocks.
         self.kapp.run()
         self._stop_detector_and_thread()
+        self.mod_scheduler.close()
         self.detector_process.close()
         self.store_media.close()
+        self.media_stage.close()
+        self.detection_log.close()
+        self.event_bus.close(EVENT_BUS_CLOSE_TIMEOUT)
+        self.config.close()
 
     def _run_grab_thread(self):
-        # Run camera grab thread.
-        if self._grab_thread is None:    
-            self.run_thread = True
-            self._grab_thread = Thread(target=self.grab_thread)
-            self._grab_thread.start()
+        # Run camera frame loop.
+        self.frame_loop.start()
 
     def _stop_detector_and_thread(self):
-        # Stop thread
-        if self._grab_thread is not None:
-            self.run_thread = False
-            self._grab_thread.join()
-            self._grab_thread = None
+        # Stop frame loop
+        self.frame_loop.stop()
         # Stop detector
         if self.detector and isinstance(self.detector, kritter.KimageDetectorThread):
             self.detector.close()
 
     def _handle_detector(self):
         if self.config['smooth_video']:
-            self.detector = kritter.KimageDetectorThread(self.detector_process)
+            self.detector = kritter.KimageDetectorThread(self.thermal.wrap(self.detector_process))
         else:
-            self.detector = self.detector_process
+            self.detector = self.thermal.wrap(self.detector_process)
 
     def _handle_sharing(self):
         if self.config['share_photos'] and not self.config['share_url_emailed'] and self.gphoto_interface is not None:
@@ -379,72 +409,90 @@ class Birdfeeder:
         if self.low_threshold<MIN_THRESHOLD:
             self.low_threshold = MIN_THRESHOLD 
 
-    # Frame grabbing thread
-    def grab_thread(self):
-        last_tag = ""
-        while self.run_thread:
-            mods = []
-            timestamp = self._timestamp()
-            # Get frame
-            frame = self.stream.frame()[0]
-
-            # Handle daytime/nighttime logic
-            daytime, change = self.daytime.is_daytime(frame)
-            if change:
-                if daytime:
-                    handle_event(self, {"event_type": 'daytime'})
-                else:
-                    handle_event(self, {"event_type": 'nighttime'})
-
-            # Handle video tag
-            tag =  f"{timestamp} daytime" if daytime else  f"{timestamp} nighttime"
-            if tag!=last_tag:
-                self.video.overlay.draw_clear(id="tag")
-                self.video.overlay.draw_text(0, frame.shape[0]-1, tag, fillcolor="black", font=dict(family="sans-serif", size=12, color="white"), xanchor="left", yanchor="bottom", id="tag")
-                mods += self.video.overlay.out_draw()
-                last_tag = tag
-
-            if daytime:
-                detect = self.detector.detect(frame, self.low_threshold)
+    def _create_frame_loop(self):
+        self.frame_loop = FrameLoop("birdfeeder")
+        self.frame_loop.add_stage("capture", self._capture)
+        self.frame_loop.add_stage("daytime", self._daytime)
+        self.frame_loop.add_stage("infer", self._infer)
+        self.frame_loop.add_stage("track", self._track)
+        # Publish from another thread so that sending frames to browsers
+        # doesn't hold up detection.
+        self.frame_loop.add_stage("publish", self._publish, thread=True)
+        self.last_tag = ""
+
+    def _capture(self, frame):
+        frame.image = self.stream.frame()[0]
+        frame.timestamp = self._timestamp()
+        # Skip rendering and sending video if nobody's watching.
+        frame.watching = self.viewers.watching(self.video)
+
+    def _daytime(self, frame):
+        # Handle daytime/nighttime logic
+        frame.daytime, change = self.daytime.is_daytime(frame.image)
+        if change:
+            if frame.daytime:
+                self._handle_event({"event_type": 'daytime'}, key="daytime")
             else:
-                detect = [], None
-            if detect is not None:
-                if isinstance(detect, tuple):
-                    dets, det_frame = detect 
-                else:
-                    dets, det_frame = detect, frame
-                # Remove classes that aren't active
-                dets = self._filter_dets(dets)
-                # Feed detections into tracker
-                dets = self.tracker.update(dets, showDisappeared=True)
-                # Update picker
-                mods += self._handle_picks(det_frame, dets)
-                # Deal with pests
-                self._handle_pests(dets)
-                # Render tracked detections to overlay
-                mods += kritter.render_detected(self.video.overlay, dets)
-
-            # Sleep to give other threads a boost 
-            time.sleep(0.01)
-
-            # Send frame
-            self.video.push_frame(frame)
-            # Handle manual picture
-            if self.take_pic:
-                self.store_media.store_image_array(frame, album=self.config_consts.GPHOTO_ALBUM, desc="Manual picture", data={'uuid': self.uuid, 'width': frame.shape[0], 'height': frame.shape[1], "timestamp": self._timestamp()})
-                mods += self.media_queue.out_images() + self.take_pic_c.out_spinner_disp(False)
-                self.take_pic = False 
-
-            # Handle manual video
-            mods += self._handle_record()            
-
-            try:
-                self.kapp.push_mods(mods)
-            except: 
-                pass
+                self._handle_event({"event_type": 'nighttime'}, key="daytime")
+
+        # Handle video tag
+        tag =  f"{frame.timestamp} daytime" if frame.daytime else  f"{frame.timestamp} nighttime"
+        if not frame.watching:
+            self.last_tag = None # redraw when someone's watching again
+        elif tag!=self.last_tag:
+            self.video.overlay.draw_clear(id="tag")
+            self.video.overlay.draw_text(0, frame.image.shape[0]-1, tag, fillcolor="black", font=dict(family="sans-serif", size=12, color="white"), xanchor="left", yanchor="bottom", id="tag")
+            frame.mods += self.video.overlay.out_draw()
+            self.last_tag = tag
+
+    def _infer(self, frame):
+        if frame.daytime:
+            # Skip detection on some frames if we're running hot.
+            if self.thermal.ready():
+                frame.detect = self.detector.detect(frame.image, self.low_threshold)
+            else:
+                frame.detect = None
+        else:
+            frame.detect = [], None
 
-            # Sleep to give other threads a boost 
-            time.sleep(0.01)
+    def _track(self, frame):
+        if frame.detect is None:
+            return
+        if isinstance(frame.detect, tuple):
+            dets, det_frame = frame.detect 
+        else:
+            dets, det_frame = frame.detect, frame.image
+        # Remove classes that aren't active
+        dets = self._filter_dets(dets)
+        # Feed detections into tracker
+        dets = self.tracker.update(dets, showDisappeared=True)
+        # Update picker
+        frame.mods += self._handle_picks(det_frame, dets)
+        # Deal with pests
+        self._handle_pests(dets)
+        # Render tracked detections to overlay
+        if frame.watching:
+            frame.mods += kritter.render_detected(self.video.overlay, dets)
+
+    def _publish(self, frame):
+        # Send frame
+        if frame.watching:
+            self.video.push_frame(frame.image)
+        # Overlay, picks, etc. are coalesced.
+        self.mod_scheduler.push(frame.mods)
+        mods = []
+        # Handle manual picture
+        if self.take_pic:
+            self.store_media.store_image_array(frame.image, album=self.config_consts.GPHOTO_ALBUM, desc="Manual picture", data={'uuid': self.uuid, 'width': frame.image.shape[0], 'height': frame.image.shape[1], "timestamp": self._timestamp()})
+            mods += self.media_queue.out_images() + self.take_pic_c.out_spinner_disp(False)
+            self.take_pic = False 
+
+        # Handle manual video
+        mods += self._handle_record()            
+        # These controls are also set by callbacks, so send them directly
+        # (the media queue is also pushed through the scheduler).
+        if mods:
+            self.kapp.push_mods(self.mod_scheduler.invalidate(mods))
 
     def _run_defense(self, block):
         if not block:
@@ -453,7 +501,7 @@ class Birdfeeder:
                 self.defend_thread.start()
             return
         else:
-            handle_event(self, {"event_type": 'defend'})
+            self._handle_event({"event_type": 'defend'})
             self.kapp.push_mods(self.defend.out_spinner_disp(True))
             # If self.record isn't None, we're in the middle of recording/saving, so skip
             if self.config['record_defense'] and self.record is None:
@@ -492,40 +540,53 @@ class Birdfeeder:
     def _timestamp(self):
         return datetime.datetime.now().strftime("%a %H:%M:%S")
 
+    def _handle_event(self, event, key=None):
+        # Run handle_event() off the frame path.  Copy the event because 
+        # the caller may reuse it.  Events are only dropped if the handler falls 
+        # far behind -- handlers count on seeing every register, trigger, etc.
+        self.event_bus.post(handle_event, self, dict(event), key=key, drop=False)
+
     def _handle_picks(self, frame, dets):
         mods = []
         picks = self.picker.update(frame, dets)
         # Get regs (new entries) and deregs (deleted entries)
         regs, deregs = self.picker.get_regs_deregs()
         if regs:
-            handle_event(self, {'event_type': 'register', 'dets': regs})
+            self.detection_log.register(regs)
+            self._handle_event({'event_type': 'register', 'dets': regs})
         if picks:
             for i in picks:
                 image, data = i[0], i[1]
+                self.detection_log.pick(data)
                 timestamp = self._timestamp()
                 _data = {'dets': [data], 'width': image.shape[1], 'height': image.shape[0], "timestamp": timestamp, 'uuid': self.uuid}
                 event = {**data, 'image': image, "timestamp": timestamp}
                 if data['class'] in self.config['species_of_interest']:
                     event['event_type'] = 'species_of_interest'
-                    handle_event(self, event)
+                    self._handle_event(event)
                     # Save picture and metadata, add width and height of image to data so we don't
                     # need to decode it to set overlay dimensions.
-                    self.store_media.store_image_array(image, album=self.config_consts.GPHOTO_ALBUM, data=_data)
+                    if self.store_media.store_media:
+                        self.store_media.store_image_array(image, album=self.config_consts.GPHOTO_ALBUM, data=_data)
+                    else:
+                        # We're not uploading, so stage it (it may be pruned before it's written).
+                        self.media_stage.store_image_array(image, data=_data)
                     if data['class'] not in self.config['seen_species']:
                         self.config['seen_species'].append(data['class'])
                         self.config.save()
                         if self.tv and self.config['text_new_species']:
                             # Send new species text message with image
-                            self.tv.send([f"New species! {timestamp} {data['class']}", Image(image)])
+                            self.event_bus.post(self.tv.send, [f"New species! {timestamp} {data['class']}", Image(image)], name="text", lane="text")
                 if data['class'] in self.config['trigger_species']:
                     event['event_type'] = 'trigger'
-                    handle_event(self, event)
+                    self._handle_event(event)
                 if data['class'] in self.config['pest_species']: # pest_species
                     event['event_type'] = 'pest_species'
-                    handle_event(self, event)
+                    self._handle_event(event)
             mods = self.media_queue.out_images()
         if deregs:    
-            handle_event(self, {'event_type': 'deregister', 'deregs': deregs})
+            self.detection_log.deregister(deregs)
+            self._handle_event({'event_type': 'deregister', 'deregs': deregs})
         return mods      
 
     def _filter_dets(self, dets):
@@ -540,7 +601,7 @@ class Birdfeeder:
     def _save_video(self, desc):
         self.store_media.store_video_stream(self.record, fps=self.camera.framerate, album=self.config_consts.GPHOTO_ALBUM, desc=desc, data={'uuid': self.uuid, 'width': self.camera.resolution[0], 'height': self.camera.resolution[1], "timestamp": self._timestamp()}, thumbnail=True, progress_callback=self._update_progress)
         self.record = None # free up memory, indicate that we're done.
-        self.kapp.push_mods(self.media_queue.out_images())
+        self.kapp.push_mods(self.mod_scheduler.invalidate(self.media_queue.out_images()))
 
     def _update_record(self, stop=True):
         with self.lock:
@@ -400,8 +400,8 @@ class Capture(Tab):
         else: # stream live
             ptrigger = not self.data['recording'] or self.data['recording'].recording()!=RECORDING
             self.mtrigger.val = ptrigger and (self.data[self.name]['trigger_mode']=='motion trigger' or self.data[self.name]['trigger_mode']=='fully auto')
-            self.btrigger.val = ptrigger and self.data[self.name]['trigger_mode']=='button press' and self.vpb.button()
-            self.etrigger.val = ptrigger and self.data[self.name]['trigger_mode']=='external trigger' and not self.vpb.io_get_bit(self.main.config_consts.EXT_BUTTON_CHANNEL)
+            self.btrigger.val = ptrigger and self.data[self.name]['trigger_mode']=='button press' and self.main.button
+            self.etrigger.val = ptrigger and self.data[self.name]['trigger_mode']=='external trigger' and self.main.ext_button
 
             frame = self.stream.frame()
             if frame:
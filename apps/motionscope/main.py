@@ -19,8 +19,7 @@ import collections
 from dash_devices.dependencies import Input, Output
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-from vizy import Vizy, Perspective, OpenProjectDialog, NewProjectDialog, ExportProjectDialog, ImportProjectDialog
-import vizy.vizypowerboard as vpb
+from vizy import Vizy, Perspective, OpenProjectDialog, NewProjectDialog, ExportProjectDialog, ImportProjectDialog, FrameLoop, ModScheduler, Viewers
 from camera import Camera 
 from capture import Capture
 from process import Process
@@ -55,6 +54,7 @@ VIDEO_FILE = "video.raw"
 
 GDRIVE_DIR = "/vizy/motionscope"
 SHARE_KEY_TYPE = "MSPG" # MotionScope Project, Google Drive
+MAX_FRAME_RATE = 250 # frames per second
 
 
 
@@ -71,6 +71,8 @@ class MotionScope:
     def __init__(self):
         self.data = collections.defaultdict(dict)
         self.kapp = Vizy()
+        self.mod_scheduler = ModScheduler(self.kapp)
+        self.viewers = Viewers(self.kapp)
         self.project_dir = os.path.join(self.kapp.etcdir, "motionscope")
         self.current_project_dir = self.project_dir    
         if not os.path.exists(self.project_dir):
@@ -78,7 +80,13 @@ class MotionScope:
         consts_filename = os.path.join(APP_DIR, CONSTS_FILE) 
         self.config_consts = import_config(consts_filename, self.kapp.etcdir, ["WIDTH", "PADDING", "GRAPHS", "MAX_RECORDING_DURATION", "START_SHIFT", "MIN_RANGE", "PLAY_RATE", "UPDATE_RATE", "FOCAL_LENGTH", "BG_AVG_RATIO", "BG_CNT_FINAL", "EXT_BUTTON_CHANNEL", "DEFAULT_CAMERA_SETTINGS", "DEFAULT_CAPTURE_SETTINGS", "DEFAULT_PROCESS_SETTINGS", "DEFAULT_ANALYZE_SETTINGS"])     
         self.lock = RLock()
-        self.vpb = vpb.VizyPowerBoard()
+        # Share Vizy's power board (the broker's proxy if it's enabled) rather than 
+        # opening our own, which would poll I2C for events alongside the broker.
+        self.vpb = self.kapp.power_board
+        # Button states are kept current by power board events so frame loops don't poll.
+        self.button = False
+        self.ext_button = False
+        self.vpb.subscribe(self.handle_power_board_event)
 
         self.gdrive = kritter.Gcloud(self.kapp.etcdir).get_interface("KfileClient")
 
@@ -173,13 +181,19 @@ class MotionScope:
 
         self.kapp.push_mods(self.load_update() + self.reset())
 
-        # Run main gui thread.
-        self.run_thread = True
-        Thread(target=self.thread).start()
+        # Run main gui frame loop.  Some tabs return the same frame over and
+        # over (e.g. when paused), so cap the rate.
+        self.frame_loop = FrameLoop("motionscope")
+        self.frame_loop.add_stage("capture", self._capture, fps=MAX_FRAME_RATE)
+        self.frame_loop.add_stage("publish", self._publish)
+        self.frame_loop.start()
 
         # Run Kritter server, which blocks.
         self.kapp.run()
-        self.run_thread = False
+        self.frame_loop.stop()
+        self.mod_scheduler.close()
+        self.vpb.unsubscribe(self.handle_power_board_event)
+        self.vpb.led(0, 0, 0)
 
     def _create_saveas_dialog(self):
         self.saveas_dialog = NewProjectDialog(self.get_projects, title=[kritter.Kritter.icon("folder"), "Save project as"], overwritable=True)
@@ -407,23 +421,35 @@ class MotionScope:
         time.sleep(1)
         self.kapp.push_mods(dialog.out_open(False))
 
-    def thread(self):
-
-        while self.run_thread:
-            time.sleep(1e-3) # A tiny sleep to reduce latency of other threads.
-            with self.lock:
-                # Get frame
-                frame = self.tab.frame()
-            # Send frame
-            if isinstance(frame, tuple): 
-                # Capture can send frameperiod with frame 
-                # so it renders correctly
-                frame_ = self.perspective.transform(frame[0])
-                self.video.push_frame(frame_, frame[1])
-            elif frame is not None:
-                frame = self.perspective.transform(frame)
-                self.video.push_frame(frame)
-        self.vpb.led(0, 0, 0)
+    def handle_power_board_event(self, event):
+        if event['type']=="button":
+            self.button = event['state']
+        elif event['bit']==self.config_consts.EXT_BUTTON_CHANNEL:
+            # External button pulls input low when pressed.
+            self.ext_button = not event['state']
+
+    def _capture(self, frame):
+        with self.lock:
+            # Get frame
+            image = self.tab.frame()
+        # Capture can send frameperiod with frame so it renders correctly
+        if isinstance(image, tuple): 
+            frame.image, frame.period = image
+        else:
+            frame.image, frame.period = image, None
+        if frame.image is None:
+            return False
+
+    def _publish(self, frame):
+        # The tabs keep running (e.g. motion-triggered recording), but there's
+        # no need to transform and send video if nobody's watching.
+        if not self.viewers.watching(self.video):
+            return
+        image = self.perspective.transform(frame.image)
+        if frame.period is None:
+            self.video.push_frame(image)
+        else:
+            self.video.push_frame(image, frame.period)
 
 
 
@@ -229,9 +229,8 @@ class Process(Tab):
                     t = time.time()
                     if t-self.update_timer>1/self.main.config_consts.UPDATE_RATE:
                         self.update_timer = t
-                        mods = self.update()
-                        if mods:
-                            self.kapp.push_mods(mods)
+                        # Playback position, coalesced with the other frame-rate mods
+                        self.main.mod_scheduler.push(self.update())
 
             if self.curr_frame is None:
                 return None
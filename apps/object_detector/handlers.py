@@ -11,6 +11,7 @@
 from kritter.ktextvisor import KtextVisor, KtextVisorTable, Image, Video
 
 # This gets called when a noteworthy event happens.  
+# It runs in a worker thread (see EventBus), so it doesn't hold up the camera.
 # You can insert your own code here :)
 def handle_event(self, event):
     print(f"handle_event: {event}")
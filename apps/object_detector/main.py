@@ -28,7 +28,7 @@ from dash_devices.dependencies import Input, Output, State
 import dash_html_components as html
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
-from vizy import Vizy, MediaDisplayQueue, OpenProjectDialog, NewProjectDialog, ImportProjectDialog, ExportProjectDialog
+from vizy import Vizy, MediaDisplayQueue, OpenProjectDialog, NewProjectDialog, ImportProjectDialog, ExportProjectDialog, ThermalBudget, EventBus, DebouncedConfigFile, MediaStage, FrameLoop, frame_stats, ModScheduler, Viewers, open_store, load_metadata_many, save_metadata, remove_metadata, BlobStore, link_file, DetectionLog
 from handlers import handle_event, handle_text
 from kritter.ktextvisor import KtextVisor, KtextVisorTable, Image, Video
 
@@ -46,6 +46,8 @@ CAMERA_WIDTH = STREAM_WIDTH = 768
 DAYTIME_THRESHOLD = 20
 # Poll period (seconds) for checking for daytime
 DAYTIME_POLL_PERIOD = 10
+# Give pending event handlers and text messages this long to finish on exit.
+EVENT_BUS_CLOSE_TIMEOUT = 5 # seconds
 
 APP_CONFIG_FILE = "object_detector.json"
 PROJECT_CONFIG_FILE = "project.json"
@@ -55,6 +57,8 @@ TRAIN_FILE = "train_detector.ipynb"
 IMPORT_FILE = "import.zip"
 SHARE_KEY_TYPE = "ODPG" # Object Detector Project, Google Drive
 TRAINING_SET_FILE = "training_set.zip"
+# Detection history (see DetectionLog), in the project directory
+DETECTION_LOG_DIR = "detections"
 model = "detector.tflite"
 COMMON_OBJECTS = "Common Objects"
 DEFAULT_APP_CONFIG = {
@@ -178,11 +182,8 @@ class MediaDisplayGrid:
         images = [i for i in images if i.endswith(".jpg") or i.endswith(".mp4")]
         images.sort()
 
-        images_and_data = []
-        for image in images:
-            data = kritter.load_metadata(os.path.join(self.media_dir, image))
-            images_and_data.append((image, data))
-        self.images_and_data = images_and_data
+        data = load_metadata_many(self.media_dir, images)
+        self.images_and_data = [(image, data[image]) for image in images]
         self.pages = (len(self.images_and_data)-1)//(self.rows*self.cols) + 1 if self.images_and_data else 0
 
     def set_media_dir(self, media_dir):
@@ -377,20 +378,30 @@ class ObjectDetector:
         # Initialize variables
         config_filename = os.path.join(self.kapp.etcdir, APP_CONFIG_FILE)  
         self.project_dir = os.path.join(self.kapp.etcdir, "object_detector")
-        self.app_config = kritter.ConfigFile(config_filename, DEFAULT_APP_CONFIG)          
+        # Images and models are shared between projects (and copies within a project).
+        self.blobs = BlobStore(self.kapp.etcdir)
+        self.app_config = DebouncedConfigFile(config_filename, DEFAULT_APP_CONFIG)          
         consts_filename = os.path.join(BASEDIR, CONSTS_FILE) 
-        self.config_consts = kritter.import_config(consts_filename, self.kapp.etcdir, ["IMAGES_KEEP", "IMAGES_DISPLAY", "PICKER_TIMEOUT", "MEDIA_QUEUE_IMAGE_WIDTH", "GPHOTO_ALBUM", "TRACKER_DISAPPEARED_DISTANCE", "TRACKER_MAX_DISAPPEARED"])
+        self.config_consts = kritter.import_config(consts_filename, self.kapp.etcdir, ["IMAGES_KEEP", "IMAGES_DISPLAY", "MEDIA_STAGING", "PICKER_TIMEOUT", "MEDIA_QUEUE_IMAGE_WIDTH", "GPHOTO_ALBUM", "TRACKER_DISAPPEARED_DISTANCE", "TRACKER_MAX_DISAPPEARED"])
         self.daytime = kritter.CalcDaytime(DAYTIME_THRESHOLD, DAYTIME_POLL_PERIOD)
+        self.thermal = ThermalBudget()
+        # Event handlers and text messages run here so they don't hold up the frame grabbing thread.
+        self.event_bus = EventBus()
         self.open_lock = Lock()
         self.classes = []
         self.layouts = {}
         self.tabs = {}
         self.store_media = None
+        self.media_stage = None
+        self.detection_log = None
+        self.project_config = None
         self.detector_process = None
         self.detector = None
         self.tracker = None
         self.picker = None
-        self._grab_thread = None
+        self.mod_scheduler = ModScheduler(self.kapp)
+        self.viewers = Viewers(self.kapp)
+        self._create_frame_loop()
         self.tab = "Detect"
         self.test_models = False
 
@@ -417,14 +428,42 @@ class ObjectDetector:
                 for image, data in images_and_data:
                     try:
                         res.append(f"{data['timestamp']} {data['dets'][0]['class']}")
-                        res.append(Image(os.path.join(self.media_queue.media_dir, image)))                            
+                        res.append(Image(self.media_stage.path(image)))                            
                     except:
                         pass
                     else:
                         if len(res)//2==n:
                             break
                 return res
-            tv_table = KtextVisorTable({"mrm": (mrm, "Displays the most recent picture, or n media with optional n argument.")})
+            def thermal(words, sender, context):
+                metrics = self.thermal.metrics()
+                if not metrics:
+                    return "No thermal data yet."
+                return [f"{t}\u00b0C: {fps:.1f} fps, {ips:.1f} detections/s" for t, (fps, ips) in metrics.items()]
+            def events(words, sender, context):
+                return self.event_bus.summary()
+            def storage(words, sender, context):
+                if not self.media_stage:
+                    return "No project is open."
+                b = self.blobs.report()
+                return [self.media_stage.summary(),
+                    f"shared files: {b['blobs']} stored in {b['stored']/1024/1024:.1f} MB, {b['refs']} references, {b['saved']/1024/1024:.1f} MB saved"]
+            def frames(words, sender, context):
+                return frame_stats(self.frame_loop, self.mod_scheduler, self.viewers)
+            def stats(words, sender, context):
+                try:
+                    days = max(int(words[1]), 1)
+                except:
+                    days = 1
+                if not self.detection_log:
+                    return "No project is open."
+                return self.detection_log.summary(days)
+            tv_table = KtextVisorTable({"mrm": (mrm, "Displays the most recent picture, or n media with optional n argument."), 
+                "thermal": (thermal, "Displays frame and detection rates versus CPU temperature."),
+                "events": (events, "Displays event handler statistics."),
+                "storage": (storage, "Displays media storage statistics."),
+                "frames": (frames, "Displays frame pipeline stage timing."),
+                "stats": (stats, "Displays detection counts for the last day, or n days with optional n argument.")})
             @self.tv.callback_receive()
             def func(words, sender, context):
                 return tv_table.lookup(words, sender, context)
@@ -507,6 +546,9 @@ class ObjectDetector:
         # Run Kritter server, which blocks.
         self.kapp.run()
         self._close_project()
+        self.mod_scheduler.close()
+        self.app_config.close()
+        self.event_bus.close(EVENT_BUS_CLOSE_TIMEOUT)
 
     def _tab_func(self, tab):
         mods = []
@@ -515,6 +557,8 @@ class ObjectDetector:
         except: 
             pass
         self.tab = tab
+        # Don't render video for tabs that don't show it.
+        self.viewers.set_visible(self.video, 'video' in self.tabs[tab][LAYOUT])
         mods += self.tabs[self.tab][OPEN]()
         return mods + [Output(i+"collapse", "is_open", i in self.tabs[tab][LAYOUT]) for i in self.layouts] + [Output(t+"nav", "active", t==tab) for t in self.tabs]
 
@@ -534,13 +578,16 @@ class ObjectDetector:
         os.chdir("tmp")
         files = os.listdir(self.project_training_dir)
         files = [f for f in files if f.endswith(".jpg")]
+        store = open_store(self.project_training_dir)
+        metadata = store.get_many(files)
+        new_metadata = {}
         for f in files:
             if VALIDATION_PERCENTAGE>=random.randint(1, 100):
                 _dir = "validate"
             else:
                 _dir = "train"
             ff = os.path.join(self.project_training_dir, f)
-            data = kritter.load_metadata(ff)
+            data = metadata.get(f, {})
             try:
                 defs = data['defs']
                 resolution = (data['width'], data['height'])
@@ -551,17 +598,18 @@ class ObjectDetector:
                     continue # File is corrupt, skip
                 defs = []
                 resolution = (width, height)
-                data = {"defs": defs, "width": width, "height": height}
-                kritter.save_metadata(ff, data)
+                data = metadata[f] = new_metadata[f] = {"defs": defs, "width": width, "height": height}
             try:
                 # create pvoc based on json
                 create_pvoc(ff, defs, out_filename=os.path.join(self.current_project_dir, f"tmp/{_dir}", kritter.file_basename(f)+".xml"), resolution=resolution)
             except Exception as e:
                 print(e)
                 continue
-            # copy files
-            os.system(f"cp ../training/{f} {_dir}")
-            os.system(f"cp ../training/{kritter.get_metadata_filename(f)} .meta")
+            # link files (no copying, these are only read by zip)
+            link_file(ff, os.path.join(_dir, f))
+            kritter.save_metadata(os.path.join(".meta", f), data)
+        if new_metadata:
+            store.update(new_metadata)
         os.system(f"rm ../{TRAINING_SET_FILE}")
         self.kapp.push_mods(self.train_status.out_value("Zipping training set..."))
         os.system(f"zip -r ../{TRAINING_SET_FILE} train validate .meta")
@@ -628,6 +676,11 @@ class ObjectDetector:
                 self.project_training_dir = os.path.join(self.current_project_dir, "training")
                 if not os.path.exists(self.project_training_dir):
                     os.makedirs(self.project_training_dir)
+                # Training set metadata lives in one store (migrates the old per-image files).
+                open_store(self.project_training_dir)
+                # Dedupe new training images and models (e.g. from an import), and free 
+                # shared files that deleted images and models no longer use, in the background.
+                Thread(target=self._adopt_blobs, args=(self.project_training_dir, self.project_models_dir), daemon=True).start()
                 models = self.get_models()
                 self.model_options = [os.path.basename(m) for m in models]
                 self.latest_model = os.path.join(self.current_project_dir, models[0]) if models else ""
@@ -642,13 +695,15 @@ class ObjectDetector:
             if not os.path.exists(self.project_dets_dir):
                 os.makedirs(self.project_dets_dir)
             config_filename = os.path.join(self.current_project_dir, PROJECT_CONFIG_FILE)
-            self.project_config = kritter.ConfigFile(config_filename, DEFAULT_PROJECT_CONFIG.copy())
+            self.project_config = DebouncedConfigFile(config_filename, DEFAULT_PROJECT_CONFIG.copy())
             self.project_config['project_name'] = self.app_config['project']
             self.store_media = kritter.SaveMediaQueue(path=self.project_dets_dir, keep=self.config_consts.IMAGES_KEEP, keep_uploaded=self.config_consts.IMAGES_KEEP)
             if self.app_config['gphoto_upload']:
                 self.store_media.store_media = self.gphoto_interface 
+            self.media_stage = MediaStage(self.project_dets_dir, keep=self.config_consts.IMAGES_KEEP, enable=self.config_consts.MEDIA_STAGING)
+            self.detection_log = DetectionLog(os.path.join(self.current_project_dir, DETECTION_LOG_DIR))
 
-            self.media_queue.set_media_dir(self.project_dets_dir)
+            self.media_queue.set_media_dir(self.project_dets_dir, self.media_stage)
             self.dets_grid.set_media_dir(self.project_dets_dir)
             if self.project_training_dir:
                 self.capture_queue.set_media_dir(self.project_training_dir)
@@ -672,9 +727,9 @@ class ObjectDetector:
             else: # If we do have a model, enable detect tab, start process and threads.
                 self.detector_process = kritter.Processify(TFliteDetector, (self.latest_model,))
                 if self.app_config['smooth_video']:
-                    self.detector = kritter.KimageDetectorThread(self.detector_process)
+                    self.detector = kritter.KimageDetectorThread(self.thermal.wrap(self.detector_process))
                 else:
-                    self.detector = self.detector_process
+                    self.detector = self.thermal.wrap(self.detector_process)
                 classes = self.detector_process.classes()
                 if not self.project_config['enabled_classes']:
                     self.project_config['enabled_classes'] = classes
@@ -692,6 +747,13 @@ class ObjectDetector:
             self.detector_process.close()
         if self.store_media:
             self.store_media.close()
+        if self.media_stage:
+            self.media_stage.close()
+        if self.detection_log:
+            self.detection_log.close()
+        # Write any pending config changes.
+        if self.project_config:
+            self.project_config.close()
 
     def _update_train_state(self):
         self.kapp.push_mods(self.train_button.out_spinner_disp(True))
@@ -786,17 +848,17 @@ class ObjectDetector:
             new_filename = kritter.date_stamped_file("jpg")
             new_filename_fullpath = os.path.join(self.project_training_dir, new_filename)
             new_data = {"defs": [], "width": self.select_kimage.data["width"], "height": self.select_kimage.data["height"]}
-            os.system(f"cp '{self.select_kimage.fullpath}' '{new_filename_fullpath}'")
-            kritter.save_metadata(new_filename_fullpath, new_data)
+            self.blobs.copy(self.select_kimage.fullpath, new_filename_fullpath)
+            save_metadata(new_filename_fullpath, new_data)
             self.select_kimage.data['copy'] = new_filename
-            kritter.save_metadata(self.select_kimage.fullpath, self.select_kimage.data)
+            save_metadata(self.select_kimage.fullpath, self.select_kimage.data)
             return copy_button.out_name([kritter.Kritter.icon("copy"), "Copied"]) + copy_button.out_disabled(True)
 
         @delete_button.callback()
         def func():
             try:
                 os.remove(self.select_kimage.fullpath)
-                os.remove(kritter.get_metadata_filename(self.select_kimage.fullpath))
+                remove_metadata(self.select_kimage.fullpath)
             except:
                 pass
             return self.dets_grid.out_images(True) + self.dets_image_dialog.out_open(False)
@@ -825,7 +887,7 @@ class ObjectDetector:
                 self.select_kimage.data['defs'].extend(self.select_kimage.data['predefs'])
             else:
                 self.select_kimage.data['defs'] = self.select_kimage.data['predefs']
-            kritter.save_metadata(self.select_kimage.fullpath, self.select_kimage.data)
+            save_metadata(self.select_kimage.fullpath, self.select_kimage.data)
             return self.training_grid.render(self.select_kimage, self.select_kimage.data, 0.33) + self.training_image_dialog.out_open(False)
 
         @clear_button.callback()
@@ -839,7 +901,7 @@ class ObjectDetector:
         def func():
             try:
                 os.remove(self.select_kimage.fullpath)
-                os.remove(kritter.get_metadata_filename(self.select_kimage.fullpath))
+                remove_metadata(self.select_kimage.fullpath)
             except:
                 pass
             return self.training_grid.out_images(True) + self.training_image_dialog.out_open(False)
@@ -944,11 +1006,22 @@ class ObjectDetector:
         return self.train_dialog
 
 
+    def _adopt_blobs(self, *dirs):
+        try:
+            count = sum([self.blobs.adopt(d) for d in dirs])
+            if count:
+                print(f"Added {count} files to blob store, {self.blobs.report()['saved']/1024/1024:.1f} MB saved")
+            count, size = self.blobs.gc()
+            if count:
+                print(f"Freed {count} shared files ({size/1024/1024:.1f} MB)")
+        except Exception as e:
+            print("Unable to dedupe project files:", e)
+
     def _install_next_model(self, model):
         # rename/copy model files
         next_model_base = self.next_model()
         next_model = f'{os.path.join(self.project_models_dir, next_model_base)}.tflite' 
-        os.system(f"cp '{model}' '{next_model}'")
+        self.blobs.copy(model, next_model)
         model_info = kritter.file_basename(model)+".json"
         next_model_info = f'{os.path.join(self.project_models_dir, next_model_base)}.json' 
         os.system(f"cp '{model_info}' '{next_model_info}'")
@@ -976,18 +1049,15 @@ class ObjectDetector:
         validate_images = [os.path.basename(i) for i in validate_images]
 
         next_model = os.path.basename(next_model)
-        for i in train_images:
-            i = os.path.join(self.project_training_dir, i)
-            data = defaultdict(list, kritter.load_metadata(i))
-            if next_model not in data['train']:
-                data['train'].append(next_model)
-                kritter.save_metadata(i, data)
-        for i in validate_images:
-            i = os.path.join(self.project_training_dir, i)
-            data = defaultdict(list, kritter.load_metadata(i))
-            if next_model not in data['validate']:
-                data['validate'].append(next_model)
-                kritter.save_metadata(i, data)
+        validate_images = set(validate_images)
+        def annotate(name, data):
+            data = defaultdict(list, data)
+            key = 'validate' if name in validate_images else 'train'
+            if next_model not in data[key]:
+                data[key].append(next_model)
+                return data
+        # One transaction for the whole training set
+        open_store(self.project_training_dir).modify(train_images + list(validate_images), annotate)
 
     def get_projects(self, exclude_current=False):
         plist = glob.glob(os.path.join(self.project_dir, '*', PROJECT_CONFIG_FILE))
@@ -1014,6 +1084,8 @@ class ObjectDetector:
         def func(project, delete):
             if delete:
                 os.system(f"rm -rf '{os.path.join(self.project_dir, project)}'")
+                count, size = self.blobs.gc()
+                print(f"Freed {count} shared files ({size/1024/1024:.1f} MB)")
                 return []
             else:
                 self.app_config['project'] = project
@@ -1068,7 +1140,7 @@ class ObjectDetector:
                 return 
             os.rename(filename_fullpath, new_filename_fullpath)
             new_data = {"defs": [], "width": width, "height": height}
-            kritter.save_metadata(new_filename_fullpath, new_data)
+            save_metadata(new_filename_fullpath, new_data)
 
         self.import_photos_dialog = ImportPhotosDialog(self.gphoto_interface, dest_dir, file_func)
 
@@ -1286,17 +1358,21 @@ class ObjectDetector:
 
         def detect_open():
             self._run_grab_thread()
-            return self.media_queue.out_images()
+            return self.mod_scheduler.invalidate(self.media_queue.out_images())
 
         def detections_open():
             self._stop_grab_thread()
             self.stream.stop()
+            # The grid only lists what's been written.
+            if self.media_stage:
+                self.media_stage.flush()
             return self.dets_grid.out_images(True)              
 
         def capture_open():
             self._run_grab_thread()
             self.video.overlay.draw_clear()
-            return self.video.overlay.out_draw() + self.capture_queue.out_images()
+            # The overlay is also pushed through the scheduler.
+            return self.mod_scheduler.invalidate(self.video.overlay.out_draw()) + self.capture_queue.out_images()
 
         def training_set_open():
             self._stop_grab_thread()
@@ -1374,7 +1450,7 @@ class ObjectDetector:
             filename = os.path.join(self.project_training_dir, kritter.date_stamped_file("jpg"))
             data = {"defs": [], "width": self.frame.shape[1], "height": self.frame.shape[0]}
             cv2.imwrite(filename, self.frame)
-            kritter.save_metadata(filename, data)
+            save_metadata(filename, data)
             return self.capture_queue.out_images() + self.take_picture_button.out_spinner_disp(False)
 
     def _set_threshold(self):
@@ -1390,75 +1466,92 @@ class ObjectDetector:
         return datetime.datetime.now().strftime("%a %H:%M:%S")
 
     def _run_grab_thread(self):
-        # Run camera grab thread.
-        if self._grab_thread is None:    
-            self.run_thread = True
-            self._grab_thread = Thread(target=self.grab_thread)
-            self._grab_thread.start()
+        # Run camera frame loop.
+        self.frame_loop.start()
 
     def _stop_grab_thread(self):
-        # Stop camera grab thread.
-        if self._grab_thread is not None:
-            self.run_thread = False
-            self._grab_thread.join()
-            self._grab_thread = None
-
-    # Frame grabbing thread
-    def grab_thread(self):
-        last_tag = ""
-        while self.run_thread:
-            mods = []
-            # Get frame
-            self.frame = self.stream.frame()[0]
-            if self.tab=="Detect":
-                timestamp = self._timestamp()
-                # Handle daytime/nighttime logic
-                daytime, change = self.daytime.is_daytime(self.frame)
-                if change:
-                    if daytime:
-                        handle_event(self, {"event_type": 'daytime'})
-                    else:
-                        handle_event(self, {"event_type": 'nighttime'})
-                # Handle video tag
-                tag =  f"{timestamp} daytime" if daytime else  f"{timestamp} nighttime"
-                if tag!=last_tag:
-                    self.video.overlay.draw_clear(id="tag")
-                    self.video.overlay.draw_text(0, self.frame.shape[0]-1, tag, fillcolor="black", font=dict(family="sans-serif", size=12, color="white"), xanchor="left", yanchor="bottom", id="tag")
-                    mods += self.video.overlay.out_draw()
-                    last_tag = tag
-
-            if self.detector and self.tab=="Detect" and daytime:
+        # Stop camera frame loop.
+        self.frame_loop.stop()
+
+    def _create_frame_loop(self):
+        self.frame_loop = FrameLoop("object detector")
+        self.frame_loop.add_stage("capture", self._capture)
+        self.frame_loop.add_stage("daytime", self._daytime)
+        self.frame_loop.add_stage("infer", self._infer)
+        self.frame_loop.add_stage("track", self._track)
+        # Publish from another thread so that sending frames to browsers
+        # doesn't hold up detection.
+        self.frame_loop.add_stage("publish", self._publish, thread=True)
+        self.last_tag = ""
+
+    def _capture(self, frame):
+        frame.image = self.frame = self.stream.frame()[0]
+        frame.daytime = False
+        frame.detect = []
+        # Skip rendering and sending video if nobody's watching.
+        frame.watching = self.viewers.watching(self.video)
+
+    def _daytime(self, frame):
+        if self.tab!="Detect":
+            return
+        timestamp = self._timestamp()
+        # Handle daytime/nighttime logic
+        frame.daytime, change = self.daytime.is_daytime(frame.image)
+        if change:
+            if frame.daytime:
+                self._handle_event({"event_type": 'daytime'}, key="daytime")
+            else:
+                self._handle_event({"event_type": 'nighttime'}, key="daytime")
+        # Handle video tag
+        tag =  f"{timestamp} daytime" if frame.daytime else  f"{timestamp} nighttime"
+        if not frame.watching:
+            self.last_tag = None # redraw when someone's watching again
+        elif tag!=self.last_tag:
+            self.video.overlay.draw_clear(id="tag")
+            self.video.overlay.draw_text(0, frame.image.shape[0]-1, tag, fillcolor="black", font=dict(family="sans-serif", size=12, color="white"), xanchor="left", yanchor="bottom", id="tag")
+            frame.mods += self.video.overlay.out_draw()
+            self.last_tag = tag
+
+    def _infer(self, frame):
+        if self.detector and self.tab=="Detect" and frame.daytime:
+            # Skip detection on some frames if we're running hot.
+            if self.thermal.ready():
                 # Get raw detections from detector thread
-                detect = self.detector.detect(self.frame, self.low_threshold)
+                frame.detect = self.detector.detect(frame.image, self.low_threshold)
             else:
-                detect = []
-            if detect is not None:
-                if isinstance(detect, tuple):
-                    dets, det_frame = detect 
-                else:
-                    dets, det_frame = detect, self.frame
-                # Remove classes that aren't active
-                dets = self._filter_dets(dets)
-
-                # Feed detections into tracker
-                if self.tracker:
-                    dets = self.tracker.update(dets, showDisappeared=True)
-                # Render tracked detections to overlay
-                mods += kritter.render_detected(self.video.overlay, dets)
-                # Update picker
-                if self.picker:
-                    mods += self._handle_picks(det_frame, dets)
-
-            # Send frame
-            self.video.push_frame(self.frame)
+                frame.detect = None
 
-            try:
-                self.kapp.push_mods(mods)
-            except:
-                pass
+    def _track(self, frame):
+        if frame.detect is None:
+            return
+        if isinstance(frame.detect, tuple):
+            dets, det_frame = frame.detect 
+        else:
+            dets, det_frame = frame.detect, frame.image
+        # Remove classes that aren't active
+        dets = self._filter_dets(dets)
 
-            # Sleep to give other threads a boost 
-            time.sleep(0.01)
+        # Feed detections into tracker
+        if self.tracker:
+            dets = self.tracker.update(dets, showDisappeared=True)
+        # Render tracked detections to overlay
+        if frame.watching:
+            frame.mods += kritter.render_detected(self.video.overlay, dets)
+        # Update picker
+        if self.picker:
+            frame.mods += self._handle_picks(det_frame, dets)
+
+    def _publish(self, frame):
+        # Send frame
+        if frame.watching:
+            self.video.push_frame(frame.image)
+        self.mod_scheduler.push(frame.mods)
+
+    def _handle_event(self, event, key=None):
+        # Run handle_event() off the frame path.  Copy the event because 
+        # the caller may reuse it.  Events are only dropped if the handler falls 
+        # far behind -- handlers count on seeing every register, trigger, etc.
+        self.event_bus.post(handle_event, self, dict(event), key=key, drop=False)
 
     def _handle_picks(self, frame, dets):
         mods = []
@@ -1466,21 +1559,28 @@ class ObjectDetector:
         # Get regs (new entries) and deregs (deleted entries)
         regs, deregs = self.picker.get_regs_deregs()
         if regs:
-            handle_event(self, {'event_type': 'register', 'dets': regs})
+            self.detection_log.register(regs)
+            self._handle_event({'event_type': 'register', 'dets': regs})
         if picks:
             for i in picks:
                 image, data = i[0], i[1]
+                self.detection_log.pick(data)
                 # Save picture and metadata, add width and height of image to data so we don't
                 # need to decode it to set overlay dimensions.
                 timestamp = self._timestamp()
                 _data = {'dets': [data], 'width': image.shape[1], 'height': image.shape[0], "timestamp": timestamp}
-                self.store_media.store_image_array(image, album=self.config_consts.GPHOTO_ALBUM, data=_data)
+                if self.store_media.store_media:
+                    self.store_media.store_image_array(image, album=self.config_consts.GPHOTO_ALBUM, data=_data)
+                else:
+                    # We're not uploading, so stage it (it may be pruned before it's written).
+                    self.media_stage.store_image_array(image, data=_data)
                 if data['class'] in self.project_config['trigger_classes']:
                     event = {**data, 'image': image, 'event_type': 'trigger', "timestamp": timestamp}
-                    handle_event(self, event)
+                    self._handle_event(event)
             mods = self.media_queue.out_images()
         if deregs:    
-            handle_event(self, {'event_type': 'deregister', 'deregs': deregs})
+            self.detection_log.deregister(deregs)
+            self._handle_event({'event_type': 'deregister', 'deregs': deregs})
         return mods       
 
     def _filter_dets(self, dets):
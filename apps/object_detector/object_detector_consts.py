@@ -12,6 +12,10 @@
 IMAGES_KEEP = 100
 # Number of images to display in the media queue
 IMAGES_DISPLAY = 25
+# Stage new images in RAM and write them to the SD card in batches, which
+# reduces SD card wear.  Images that are pruned before they're written are
+# never written.
+MEDIA_STAGING = True
 # How long to wait (seconds) before picking best detection image for media queue
 PICKER_TIMEOUT = 10
 # Width of media queue images
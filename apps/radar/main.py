@@ -9,7 +9,6 @@
 #
 
 import os
-from threading import Thread
 import datetime
 import kritter
 import cv2
@@ -17,7 +16,7 @@ import numpy as np
 from dash_devices.dependencies import Output
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-from vizy import Vizy, MediaDisplayQueue
+from vizy import Vizy, MediaDisplayQueue, EventBus, DebouncedConfigFile, MediaStage, FrameLoop, frame_stats, ModScheduler, Viewers, get_profiler
 import kritter.ktextvisor as kt
 import time
 from PIL import Image, ImageDraw, ImageFont
@@ -43,9 +42,13 @@ MIN_SPAN = BINS/2
 DAYTIME_THRESHOLD = 20
 # Poll period (seconds) for checking for daytime
 DAYTIME_POLL_PERIOD = 10
+# Give pending event handlers and text messages this long to finish on exit.
+EVENT_BUS_CLOSE_TIMEOUT = 5 # seconds
 DEFAULT_CALIBRATION = 0.33 # MPH*seconds/bins
 KM_PER_MILE = 1.60934
 FRAME_QUEUE_LENGTH = 2
+# Let the camera's auto white balance settle for this long before locking it.
+AWB_SETTLE_TIME = 3 # seconds
 STATE_QUEUE_LENGTH = 5 
 
 DEFAULT_CONFIG = {
@@ -62,14 +65,32 @@ DEFAULT_CONFIG = {
     "debug": False
 }
 
+def column_profile(image, image0, cols, noise_floor):
+    # image and image0 are split (cv2.split) consecutive frames, cols is an
+    # array the size of a channel where each pixel is its column number.
+    diff = 0
+    # Take diffence of all 3 color channels
+    for i in range(3):
+        diff += cv2.absdiff(image[i], image0[i])
+    # Detect motion by thresholding just above the noise of the image.
+    th = diff>noise_floor
+    # Take the thresholded pixels and associate with column values
+    th = cols[th]
+    # Create a "histogram of motion".  We're essentially taking the image and dividing it into BINS 
+    # number of columns.
+    return np.histogram(th, BINS, (0, diff.shape[1]-1))
+
+
 class Video: 
     def __init__(self):
         # Create Kritter server.
         self.kapp = Vizy()
+        self.mod_scheduler = ModScheduler(self.kapp)
+        self.viewers = Viewers(self.kapp)
         config_filename = os.path.join(self.kapp.etcdir, CONFIG_FILE)      
-        self.config = kritter.ConfigFile(config_filename, DEFAULT_CONFIG)               
+        self.config = DebouncedConfigFile(config_filename, DEFAULT_CONFIG)               
         consts_filename = os.path.join(BASEDIR, CONSTS_FILE) 
-        self.config_consts = kritter.import_config(consts_filename, self.kapp.etcdir, ["ALBUM", "NOISE_FLOOR", "DATA_TIMEOUT", "SPEED_DISPLAY_TIMEOUT", "FONT_SIZE", "FONT_COLOR", "FONT_COLOR_EXCEED", "MINIMUM_DATA", "SHUTTER_SPEED", "LOW_LIGHT_SHUTTER_SPEED", "MAX_RESIDUAL"]) 
+        self.config_consts = kritter.import_config(consts_filename, self.kapp.etcdir, ["ALBUM", "MEDIA_STAGING", "NOISE_FLOOR", "DATA_TIMEOUT", "SPEED_DISPLAY_TIMEOUT", "FONT_SIZE", "FONT_COLOR", "FONT_COLOR_EXCEED", "MINIMUM_DATA", "SHUTTER_SPEED", "LOW_LIGHT_SHUTTER_SPEED", "MAX_RESIDUAL"]) 
         self.font = ImageFont.truetype(os.path.join(BASEDIR, "font.ttf"), self.config_consts.FONT_SIZE)        
         if not os.path.isdir(MEDIA_DIR):
             os.makedirs(MEDIA_DIR)
@@ -95,14 +116,23 @@ class Video:
                 for image, data in images_and_data:
                     try:
                         res.append(f"{data['speed_string']} {data['timestamp']}")
-                        res.append(kt.Image(os.path.join(MEDIA_DIR, image)))                            
+                        res.append(kt.Image(self.media_stage.path(image)))                            
                     except:
                         pass
                     else:
                         if len(res)//2==n:
                             break
                 return res
-            tv_table = kt.KtextVisorTable({"mrv": (mrm, "Displays the most recent vehicles, or n vehicles with optional n argument.")})
+            def events(words, sender, context):
+                return self.event_bus.summary()
+            def storage(words, sender, context):
+                return self.media_stage.summary()
+            def frames(words, sender, context):
+                return frame_stats(self.frame_loop, self.mod_scheduler, self.viewers)
+            tv_table = kt.KtextVisorTable({"mrv": (mrm, "Displays the most recent vehicles, or n vehicles with optional n argument."),
+                "events": (events, "Displays event handler statistics."),
+                "storage": (storage, "Displays media storage statistics."),
+                "frames": (frames, "Displays frame pipeline stage timing.")})
             @self.tv.callback_receive()
             def func(words, sender, context):
                 return tv_table.lookup(words, sender, context)
@@ -115,12 +145,15 @@ class Video:
             print("*** Texting interface not found.")
 
         self.daytime = kritter.CalcDaytime(DAYTIME_THRESHOLD, DAYTIME_POLL_PERIOD)
+        # Event handlers and text messages run here so they don't hold up the frame grabbing thread.
+        self.event_bus = EventBus()
         self.sensitivity_range = kritter.Range((1, 100), (200, 20), inval=self.config['sensitivity']) 
         self.bin_threshold = self.sensitivity_range.outval
 
         style = {"label_width": 2, "control_width": 4}
         self.video = kritter.Kvideo(width=self.camera.resolution[0], overlay=True)
-        self.media_queue = MediaDisplayQueue(MEDIA_DIR, CAMERA_WIDTH, CAMERA_WIDTH) 
+        self.media_stage = MediaStage(MEDIA_DIR, enable=self.config_consts.MEDIA_STAGING)
+        self.media_queue = MediaDisplayQueue(MEDIA_DIR, CAMERA_WIDTH, CAMERA_WIDTH, stage=self.media_stage) 
         self.settings_button = kritter.Kbutton(name=[kritter.Kritter.icon("gear"), "Settings..."], service=None)
         self.brightness = kritter.Kslider(name="Brightness", value=self.config['brightness'], mxs=(0, 100, 1), format=lambda val: f'{val}%', grid=False, style=style)
         self.settings_button.append(self.brightness)
@@ -216,7 +249,7 @@ class Video:
 
         @self.media_queue.dialog_image_callback()
         def func(src, srcpath):
-            self.calib_info = srcpath, kritter.load_metadata(srcpath)
+            self.calib_info = srcpath, self.media_stage.load_metadata(srcpath)
             return self.calib_dialog.out_open(True)
         
         @self.calib_button.callback(self.calib_text.state_value())
@@ -224,6 +257,9 @@ class Video:
             try:
                 speed = float(''.join(filter(str.isdigit, speed))) # convert to float, remove all non-numeric characters
                 srcpath, data = self.calib_info
+                # Make sure the image is written before we change it.
+                self.media_stage.flush()
+                srcpath = os.path.join(MEDIA_DIR, os.path.basename(srcpath))
                 calibration = speed/data['speed_raw']
                 if data['left_moving']:
                     self.config['left_calibration'] = calibration
@@ -245,15 +281,25 @@ class Video:
             except Exception as e:
                 print("Calibration error:", e)
             
-        # Run camera grab thread.
-        self.run_grab = True
-        Thread(target=self.grab).start()
+        # Run camera frame loop.
+        self._create_frame_loop()
+        self.frame_loop.start()
 
         # Run Kritter server, which blocks.
         self.kapp.run()
-        self.run_grab = False
+        self.frame_loop.stop()
+        self.mod_scheduler.close()
+        self.media_stage.close()
+        self.event_bus.close(EVENT_BUS_CLOSE_TIMEOUT)
+        self.config.close()
         
 
+    def _handle_event(self, event, key=None):
+        # Run handle_event() off the frame path.  Copy the event because 
+        # the caller may reuse it.  Events are only dropped if the handler falls 
+        # far behind -- handlers count on seeing every register, trigger, etc.
+        self.event_bus.post(handle_event, self, dict(event), key=key, drop=False)
+
     def _debug(self, *args):
         if self.config['debug']:
             print(*args)
@@ -333,19 +379,18 @@ class Video:
         timestamp = self._timestamp()
         speed_string = self._speed_string(speed)
         metadata = {"speed": speed, "speed_string": speed_string, "speed_raw": speed_raw, "speeding": speeding, "left_moving": left, "left_pointing": self.config["left_pointing"], "timestamp": timestamp, "width": pic.shape[1], "height": pic.shape[0], "album": self.config_consts.ALBUM}
-        # write image without speed overlay
-        cv2.imwrite(filename+"_", pic) 
-        # Overlay speed and write image with speed
+        # Stage image without speed overlay (it's written to filename+"_")
+        self.media_stage.store_image_array(pic, filename_+"_")
+        # Overlay speed and stage image with speed
         pic = self._overlay_speed(pic, speed)
-        cv2.imwrite(filename, pic) 
-        kritter.save_metadata(filename, metadata)
+        self.media_stage.store_image_array(pic, filename_, metadata)
         # Update media queue
         self.kapp.push_mods(self.media_queue.out_images())
 
         # Send event
-        handle_event(self, {"event_type": 'vehicle', "image": pic, "filename": filename, "speed": speed, "speed_string": speed_string, "speed_raw": speed_raw, "speeding": speeding, "data": [list(data_time), list(data_y)]})
+        self._handle_event({"event_type": 'vehicle', "image": pic, "filename": filename, "speed": speed, "speed_string": speed_string, "speed_raw": speed_raw, "speeding": speeding, "data": [list(data_time), list(data_y)]})
         if speeding and self.tv and self.config['text_speeders']:
-            self.tv.send([f"{speed_string} {timestamp}", kt.Image(pic)])
+            self.event_bus.post(self.tv.send, [f"{speed_string} {timestamp}", kt.Image(pic)], name="text", lane="text")
 
         return speed
 
@@ -378,164 +423,173 @@ class Video:
             self._debug("self.left_state NONE (not motion, no pic)")
         self.left_state = STATE_NONE
 
-    # Frame grabbing thread
-    def grab(self):  
+    def _create_frame_loop(self):
+        self.frame_loop = FrameLoop("radar")
+        self.frame_loop.add_stage("capture", self._capture)
+        self.frame_loop.add_stage("daytime", self._daytime)
+        self.frame_loop.add_stage("profile", self._profile)
+        # Publish from another thread so that sending frames to browsers
+        # doesn't hold up speed measurement.
+        self.frame_loop.add_stage("publish", self._publish, thread=True)
         self.speed_disp = None
-        frame0 = None
-        cols = None
-        last_tag = ""
-        frame_queue = []
-        t0 = time.time()
-        hist_cols = np.arange(0, BINS, dtype='uint')
-        right_time = left_time = 0
+        self.frame0 = None
+        self.cols = None
+        self.last_tag = ""
+        self.is_daytime = True
+        self.frame_queue = []
+        self.hist_cols = np.arange(0, BINS, dtype='uint')
+        self.right_time = self.left_time = 0
         self.left_state = self.right_state = STATE_NONE
         self.left_pic = self.right_pic = None
         self.motion_queue = []
-
-        while time.time()-t0<3:
-            self.stream.frame()
-        self.camera.awb = False
-
-        while self.run_grab:
-            mods = []
-            left_pointing = self.config['left_pointing']
-
-            # Get frame
-            frame_orig = self.stream.frame()
-
-            # Handle daytime/nighttime logic
-            if not self.left_state and not self.right_state: 
-                daytime, change = self.daytime.is_daytime(frame_orig[0])
-                if change:
-                    if daytime:
-                        handle_event(self, {"event_type": 'daytime'})
-                    else:
-                        handle_event(self, {"event_type": 'nighttime'})
-
-            # Handle video tag
-            timestamp = self._timestamp()
-            tag =  f"{timestamp} daytime" if daytime else  f"{timestamp} nighttime"
-            if tag!=last_tag:
-                self.video.overlay.draw_clear()
-                self.video.overlay.draw_text(0, frame_orig[0].shape[0]-1, tag, fillcolor="black", font=dict(family="sans-serif", size=12, color="white"), xanchor="left", yanchor="bottom")
-                mods += self.video.overlay.out_draw()
-                last_tag = tag
-
-            
-            frame = frame_orig[0]
-            if cols is None:
-                r = np.arange(0, frame.shape[1], dtype='uint')
-                cols = np.atleast_2d(r).repeat(repeats=frame.shape[0], axis=0)
-            frame = cv2.split(frame)
-            if frame0 and daytime:
-                diff = 0
-                # Take diffence of all 3 color channels
-                for i in range(3):
-                    diff += cv2.absdiff(frame[i], frame0[i])
-                # Detect motion by thresholding just above the noise of the image.
-                th = diff>self.config_consts.NOISE_FLOOR
-                # Take the thresholded pixels and associate with column values
-                th = cols[th]
-                # Create a "histogram of motion".  We're essentially taking the image and dividing it into BINS 
-                # number of columns.
-                hist = np.histogram(th, BINS, (0, diff.shape[1]-1))
-                # Further threshold the columns to eliminate columns that don't have "significant data".
-                col_thresh = hist_cols[hist[0]>self.bin_threshold]
-                # The rest of the code will look at the first (leftmost) column of motion (col_thresh[0]) and the 
-                # last (rightmost) column of motion (col_threshj[-1]).  
-                # If we see motion of col_thresh[0], start recording data in to self.right_data (right-moving object data).
-                # Stop recording when we see motion on col_thresh[BINS-1]
-                # If we see motion of col_thresh[BINS-1], start recording data in to self.left_data (left-moving object data).
-                # Stop recording when we see motion on col_thresh[0]
-                self.motion_queue = self.motion_queue[0:STATE_QUEUE_LENGTH-1]           
-                if len(col_thresh): 
-                    leftmost = col_thresh[0]
-                    rightmost = col_thresh[-1]                            
-                    left_col = leftmost==0
-                    right_col = rightmost==BINS-1 
-                    self.motion_queue.insert(0, True)
-                    motion = self.motion()
-                        
-                    if self.right_state==STATE_NONE:
-                        if left_col and self.left_state==STATE_NONE:
-                            self._debug("self.right_state FULL")
-                            self.right_state = STATE_FULL    
-                            self.motion_queue = []
-                            self.right_data = [np.array([]), np.array([])]
-                            right_time = time.time()
-                            self.right_pic = None
-                    elif self.right_state==STATE_FULL:
-                        if right_col:
-                            self._debug("self.right_state FINISHING")
-                            if left_pointing:
-                                self.right_pic = frame_queue[0][0]
-                            self.right_state = STATE_FINISHING 
-                    if not left_pointing and self.right_state and left_col:         
-                        self._debug("take right pic")                                  
-                        self.right_pic = frame_orig[0]
-
-                    if self.left_state==STATE_NONE:
-                        if right_col and self.right_state==STATE_NONE:
-                            self._debug("self.left_state FULL")
-                            self.left_state = STATE_FULL    
-                            self.motion_queue = []
-                            self.left_data = [np.array([]), np.array([])]
-                            left_time = time.time()
-                            self.left_pic = None
-                    elif self.left_state==STATE_FULL:
-                        if left_col:
-                            self._debug("self.left_state FINISHING")
-                            if not left_pointing:
-                                self.left_pic = frame_queue[0][0]
-                            self.left_state = STATE_FINISHING 
-                    if left_pointing and self.left_state and right_col:         
-                        self._debug("take left pic")                                  
-                        self.left_pic = frame_orig[0]
-
-
-                    if self.left_state:
-                        self._debug("left", self.left_state, col_thresh[0], col_thresh[-1])
-                        if self.left_state==STATE_FULL:
-                            # Add column data
-                            self.left_data[0] = np.append(self.left_data[0], col_thresh[0])
-                            # Add timestamp data
-                            self.left_data[1] = np.append(self.left_data[1], frame_orig[1])
-                    if self.right_state:
-                        self._debug("right", self.right_state, col_thresh[0], col_thresh[-1])
-                        if self.right_state==STATE_FULL:
-                            # Add column data
-                            self.right_data[0] = np.append(self.right_data[0], col_thresh[-1])
-                            # Add timestamp data
-                            self.right_data[1] = np.append(self.right_data[1], frame_orig[1])
+        self.warm_up_time = time.time()
+
+    def _capture(self, frame):
+        # frame.orig is (image, timestamp)
+        frame.orig = self.stream.frame()
+        frame.image = frame.orig[0]
+        # Skip rendering and sending video if nobody's watching.
+        frame.watching = self.viewers.watching(self.video)
+        # Let auto white balance settle, then lock it.
+        if self.warm_up_time:
+            if time.time()-self.warm_up_time<AWB_SETTLE_TIME:
+                return False
+            self.camera.awb = False
+            self.warm_up_time = None
+
+    def _daytime(self, frame):
+        # Handle daytime/nighttime logic
+        if not self.left_state and not self.right_state: 
+            daytime, change = self.daytime.is_daytime(frame.image)
+            self.is_daytime = daytime
+            if change:
+                if daytime:
+                    self._handle_event({"event_type": 'daytime'}, key="daytime")
                 else:
-                    self.motion_queue.insert(0, False)
-
-                if self.right_state and not self.motion():
-                    self._debug("right no motion")
-                    self.finish_right()
-                elif self.right_state and time.time()-right_time>self.config_consts.DATA_TIMEOUT:
-                    self.right_state = STATE_NONE
-                    self._debug("right timeout")
-
-                if self.left_state and not self.motion():
-                    self._debug("left no motion")
-                    self.finish_left()
-                elif self.left_state and time.time()-left_time>self.config_consts.DATA_TIMEOUT:
-                    self.left_state = STATE_NONE
-                    self._debug("left timeout")
-                 
-            if self.speed_disp is None:
-                self.video.push_frame(frame_orig) # np.dstack(frame0)
+                    self._handle_event({"event_type": 'nighttime'}, key="daytime")
+
+        # Handle video tag
+        timestamp = self._timestamp()
+        tag =  f"{timestamp} daytime" if self.is_daytime else  f"{timestamp} nighttime"
+        if not frame.watching:
+            self.last_tag = None # redraw when someone's watching again
+        elif tag!=self.last_tag:
+            self.video.overlay.draw_clear()
+            self.video.overlay.draw_text(0, frame.image.shape[0]-1, tag, fillcolor="black", font=dict(family="sans-serif", size=12, color="white"), xanchor="left", yanchor="bottom")
+            frame.mods += self.video.overlay.out_draw()
+            self.last_tag = tag
+
+    def _profile(self, frame):
+        left_pointing = self.config['left_pointing']
+        frame_orig = frame.orig
+        image = frame.image
+        if self.cols is None:
+            r = np.arange(0, image.shape[1], dtype='uint')
+            self.cols = np.atleast_2d(r).repeat(repeats=image.shape[0], axis=0)
+        image = cv2.split(image)
+        if self.frame0 and self.is_daytime:
+            with get_profiler().stage("radar/column profile"):
+                hist = column_profile(image, self.frame0, self.cols, self.config_consts.NOISE_FLOOR)
+            # Further threshold the columns to eliminate columns that don't have "significant data".
+            col_thresh = self.hist_cols[hist[0]>self.bin_threshold]
+            # The rest of the code will look at the first (leftmost) column of motion (col_thresh[0]) and the 
+            # last (rightmost) column of motion (col_threshj[-1]).  
+            # If we see motion of col_thresh[0], start recording data in to self.right_data (right-moving object data).
+            # Stop recording when we see motion on col_thresh[BINS-1]
+            # If we see motion of col_thresh[BINS-1], start recording data in to self.left_data (left-moving object data).
+            # Stop recording when we see motion on col_thresh[0]
+            self.motion_queue = self.motion_queue[0:STATE_QUEUE_LENGTH-1]           
+            if len(col_thresh): 
+                leftmost = col_thresh[0]
+                rightmost = col_thresh[-1]                            
+                left_col = leftmost==0
+                right_col = rightmost==BINS-1 
+                self.motion_queue.insert(0, True)
+                motion = self.motion()
+                    
+                if self.right_state==STATE_NONE:
+                    if left_col and self.left_state==STATE_NONE:
+                        self._debug("self.right_state FULL")
+                        self.right_state = STATE_FULL    
+                        self.motion_queue = []
+                        self.right_data = [np.array([]), np.array([])]
+                        self.right_time = time.time()
+                        self.right_pic = None
+                elif self.right_state==STATE_FULL:
+                    if right_col:
+                        self._debug("self.right_state FINISHING")
+                        if left_pointing:
+                            self.right_pic = self.frame_queue[0][0]
+                        self.right_state = STATE_FINISHING 
+                if not left_pointing and self.right_state and left_col:         
+                    self._debug("take right pic")                                  
+                    self.right_pic = frame_orig[0]
+
+                if self.left_state==STATE_NONE:
+                    if right_col and self.right_state==STATE_NONE:
+                        self._debug("self.left_state FULL")
+                        self.left_state = STATE_FULL    
+                        self.motion_queue = []
+                        self.left_data = [np.array([]), np.array([])]
+                        self.left_time = time.time()
+                        self.left_pic = None
+                elif self.left_state==STATE_FULL:
+                    if left_col:
+                        self._debug("self.left_state FINISHING")
+                        if not left_pointing:
+                            self.left_pic = self.frame_queue[0][0]
+                        self.left_state = STATE_FINISHING 
+                if left_pointing and self.left_state and right_col:         
+                    self._debug("take left pic")                                  
+                    self.left_pic = frame_orig[0]
+
+
+                if self.left_state:
+                    self._debug("left", self.left_state, col_thresh[0], col_thresh[-1])
+                    if self.left_state==STATE_FULL:
+                        # Add column data
+                        self.left_data[0] = np.append(self.left_data[0], col_thresh[0])
+                        # Add timestamp data
+                        self.left_data[1] = np.append(self.left_data[1], frame_orig[1])
+                if self.right_state:
+                    self._debug("right", self.right_state, col_thresh[0], col_thresh[-1])
+                    if self.right_state==STATE_FULL:
+                        # Add column data
+                        self.right_data[0] = np.append(self.right_data[0], col_thresh[-1])
+                        # Add timestamp data
+                        self.right_data[1] = np.append(self.right_data[1], frame_orig[1])
+            else:
+                self.motion_queue.insert(0, False)
+
+            if self.right_state and not self.motion():
+                self._debug("right no motion")
+                self.finish_right()
+            elif self.right_state and time.time()-self.right_time>self.config_consts.DATA_TIMEOUT:
+                self.right_state = STATE_NONE
+                self._debug("right timeout")
+
+            if self.left_state and not self.motion():
+                self._debug("left no motion")
+                self.finish_left()
+            elif self.left_state and time.time()-self.left_time>self.config_consts.DATA_TIMEOUT:
+                self.left_state = STATE_NONE
+                self._debug("left timeout")
+
+        self.frame0 = image
+        self.frame_queue.insert(0, frame_orig)
+        self.frame_queue = self.frame_queue[0:FRAME_QUEUE_LENGTH]
+        if self.speed_disp and time.time()-self.speed_disp[1]>self.config_consts.SPEED_DISPLAY_TIMEOUT:
+            self.speed_disp = None 
+        frame.speed_disp = self.speed_disp
+
+    def _publish(self, frame):
+        if frame.watching:
+            if frame.speed_disp is None:
+                self.video.push_frame(frame.orig) # np.dstack(frame0)
             else: # overlay speed ontop of video 
-                speed_frame = self._overlay_speed(frame_orig[0], self.speed_disp[0])
+                speed_frame = self._overlay_speed(frame.image, frame.speed_disp[0])
                 self.video.push_frame(speed_frame)
-                if time.time()-self.speed_disp[1]>self.config_consts.SPEED_DISPLAY_TIMEOUT:
-                    self.speed_disp = None 
-                        
-            frame0 = frame
-            frame_queue.insert(0, frame_orig)
-            frame_queue = frame_queue[0:FRAME_QUEUE_LENGTH]
-            self.kapp.push_mods(mods)
+        self.mod_scheduler.push(frame.mods)
             
 if __name__ == "__main__":
     Video()
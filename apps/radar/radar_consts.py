@@ -10,6 +10,9 @@
 
 # Name of Google Photos album to store photos
 ALBUM = "radar"
+# Stage new images in RAM and write them to the SD card in batches, which
+# reduces SD card wear.
+MEDIA_STAGING = True
 # Mimimum value before differences in pixel values are considered motion
 NOISE_FLOOR = 30*3
 # Maximum amount of time a vehicle can take to traverse the width of the image
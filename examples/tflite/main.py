@@ -9,10 +9,9 @@
 #
 
 from threading import Thread
-from vizy import Vizy
+from vizy import Vizy, get_profiler
 from kritter import Camera, Kvideo, Kslider, render_detected
 from kritter.tflite import TFliteDetector
-import time  
 
 class TFliteExample:
 
@@ -51,10 +50,10 @@ class TFliteExample:
         while self.run_process:
             # Get frame
             frame = self.stream.frame()[0]
-            # Run detection
-            t0 = time.time()
-            dets = self.tflite.detect(frame, self.sensitivity)
-            print(time.time()-t0)
+            # Run detection, and record how long it takes (see Profiler in 
+            # the side menu)
+            with get_profiler().stage("detect"):
+                dets = self.tflite.detect(frame, self.sensitivity)
             # If we detect something...
             if dets is not None:
                 self.kapp.push_mods(render_detected(self.video.overlay, dets))
@@ -8,13 +8,50 @@
 # support@charmedlabs.com. 
 #
 
+import importlib
 from .about import __version__
-from .vizy import Vizy, dirs, VizyConfig, BASE_DIR, ETCDIR_NAME, APPSDIR_NAME, EXAMPLESDIR_NAME, SCRIPTSDIR_NAME
-from .vizypowerboard import VizyPowerBoard, get_cpu_temp
-from .vizyvisor import VizyVisor
-from .perspective import Perspective
-from .mediadisplayqueue import MediaDisplayQueue
-from .newprojectdialog import NewProjectDialog
-from .openprojectdialog import OpenProjectDialog
-from .exportprojectdialog import ExportProjectDialog
-from .importprojectdialog import ImportProjectDialog
+
+# Public names are imported on first use so that light consumers (e.g. 
+# vizy-power-monitor) don't pull in kritter, dash, etc.
+_EXPORTS = {
+    ".vizy": ["Vizy", "VizyConfig", "BASE_DIR"],
+    ".settings": ["dirs", "read_config", "ETCDIR_NAME", "APPSDIR_NAME", "EXAMPLESDIR_NAME", "SCRIPTSDIR_NAME"],
+    ".vizypowerboard": ["VizyPowerBoard", "get_cpu_temp"],
+    ".powerboardbroker": ["PowerBoardBroker", "VizyPowerBoardProxy"],
+    ".telemetry": ["TelemetryReader"],
+    ".thermalgovernor": ["ThermalBudget"],
+    ".eventbus": ["EventBus"],
+    ".debouncedconfig": ["DebouncedConfigFile"],
+    ".vizyvisor": ["VizyVisor"],
+    ".perspective": ["Perspective"],
+    ".mediadisplayqueue": ["MediaDisplayQueue"],
+    ".mediastage": ["MediaStage"],
+    ".frameloop": ["FrameLoop", "Frame", "frame_stats"],
+    ".profiler": ["Profiler", "get_profiler", "profile"],
+    ".modscheduler": ["ModScheduler"],
+    ".simcamera": ["SimCamera"],
+    ".viewers": ["Viewers"],
+    ".metadatastore": ["MetadataStore", "open_store", "get_store", "load_metadata", "load_metadata_many", "save_metadata", "remove_metadata"],
+    ".newprojectdialog": ["NewProjectDialog"],
+    ".openprojectdialog": ["OpenProjectDialog"],
+    ".exportprojectdialog": ["ExportProjectDialog"],
+    ".importprojectdialog": ["ImportProjectDialog"],
+    ".projectarchive": ["write_archive", "extract_archive", "LocalDrive"],
+    ".blobstore": ["BlobStore", "link_file"],
+    ".detectionlog": ["DetectionLog"],
+}
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = ["__version__"] + list(_MODULES.keys())
+
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_MODULES[name], __name__), name)
+    # Cache so __getattr__ isn't called again.
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(_MODULES.keys()))
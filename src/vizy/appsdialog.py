@@ -10,8 +10,10 @@
 
 import os
 import time
+import sys
 import signal
 import json
+import subprocess
 import cv2
 import numpy as np
 from datetime import datetime
@@ -25,6 +27,8 @@ from dash_devices import callback_context
 from kritter import Kritter, KsideMenuItem, Kdialog, Ktext, Kdropdown, Kbutton, Kradio, PORT, valid_image_name, MEDIA_DIR
 from kritter.kterm import Kterm, RESTART_QUERY
 from vizy import BASE_DIR
+from .supervisor import ReadySocket, ExitWatcher, Wakeup
+from .zygote import ZYGOTE_PATH
 import dash_html_components as html
 from urllib.parse import urlparse, urlencode
 from urllib.request import urlopen
@@ -39,6 +43,11 @@ IMAGE_WIDTH = 460
 IMAGE_HEIGHT = 230
 IMAGE_PREFIX = "__"
 START_TIMEOUT = 30 # seconds
+# Apps that don't send a ready notification are polled via HTTP at this rate.
+HTTP_POLL_PERIOD = 0.5 # seconds
+# App info is cached here (in etcdir) and only re-read when an app's files change.
+CATALOG_FILE = "apps_catalog.json"
+CATALOG_VERSION = 1
 
 def _create_image(image_path):
     new_image_path = os.path.join(os.path.dirname(image_path), IMAGE_PREFIX + os.path.basename(image_path))
@@ -66,6 +75,24 @@ def _create_image(image_path):
     return new_image_path
 
 
+def _mtime(file):
+    try:
+        return os.path.getmtime(file)
+    except OSError:
+        return None
+
+# The app directory's mtime changes when files are added/removed/renamed, which
+# covers most edits, but files can be modified in place, so include those too.
+def _signature(path, info):
+    files = [path, os.path.join(path, "info.json")]
+    if info:
+        files += info['files'] + info['image_files']
+    return [[f, _mtime(f)] for f in files]
+
+def _valid(signature):
+    return all(_mtime(f)==mtime for f, mtime in signature)
+
+
 # I thought about making the selector carousel not shared, so different users could browse 
 # programs independently, but there are some shared aspects of the carousel, like the running 
 # status and if a prog runs on startup.  Keeping track of this isn't worth the effort for now,
@@ -81,6 +108,16 @@ class AppsDialog:
         self.modified = False
         self.progs_lock = Lock() # We need this because we're updating the progs list asynchronously
         self.ftime = []
+        self.pid = None
+        # The app's own pid (from its ready notification), and whether it was forked from the zygote
+        self.app_pid = None
+        self.forked = False
+        self.ready_socket = ReadySocket()
+        self.wakeup = Wakeup()
+        self.zygote = None
+        self._start_zygote()
+        self.catalog_file = os.path.join(self.kapp.etcdir, CATALOG_FILE)
+        self._load_catalog()
 
         self.progmap = {
             "Apps": {"typename": "app", "path": "apps"}, 
@@ -149,6 +186,7 @@ class AppsDialog:
                 self.prog = self.progs[self.type][index]
             self.name = f"{self.prog['name']} {self.progmap[self.type]['typename']}" 
             self.restart = True
+            self.wakeup.set()
             return self.run_button.out_spinner_disp(True)
 
         @self.kapp.callback_connect
@@ -158,6 +196,7 @@ class AppsDialog:
                 if self._ftime_update():
                     print(f"{self.prog['name']} has changed, restarting...")
                     self.modified = True
+                    self.wakeup.set()
                 self.update_progs()
                 return [Output(self.carousel.id, "items", self.citems()), Output(self.carousel.id, "active_index", 0)]
 
@@ -214,7 +253,9 @@ class AppsDialog:
             "files": [],
             "image": None,
             "image_no_bg": None,
-            "url": None
+            "image_files": [], # source and generated image, for the catalog signature
+            "url": None,
+            "zygote": True # set to false in info.json if app needs a clean interpreter
         }
         path = os.path.join(path, app)
         info['path'] = os.path.relpath(path, self.kapp.homedir)
@@ -263,8 +304,10 @@ class AppsDialog:
         # Create media path to image
         if info['image']:
             try:
-                image_path = _create_image(self._app_file_path(path, info['image']))
-                info['image_no_bg'] = self._media_path(self._app_file_path(path, info['image']))
+                source_path = self._app_file_path(path, info['image'])
+                image_path = _create_image(source_path)
+                info['image_files'] = [source_path, image_path]
+                info['image_no_bg'] = self._media_path(source_path)
                 info['image'] = self._media_path(image_path)
             except: 
                 pass
@@ -302,6 +345,18 @@ class AppsDialog:
                 self.pid = None
             return bool(obj)
 
+    def usage_pid(self):
+        """
+        Returns the pid whose process tree is the running app (for resource
+        usage), or None if it isn't known, e.g. it was forked from the zygote
+        and hasn't told us its pid.
+        """
+        if self.pid is None:
+            return None
+        if self.app_pid:
+            return self.app_pid
+        return None if self.forked else self.pid
+
     def citems(self):
         with self.progs_lock:
             self._citems = [
@@ -313,14 +368,48 @@ class AppsDialog:
             ]
         return self._citems
         
+    def _load_catalog(self):
+        self.catalog = {}
+        try:
+            with open(self.catalog_file) as f:
+                catalog = json.load(f)
+            if catalog['version']==CATALOG_VERSION:
+                self.catalog = catalog['apps']
+        except:
+            pass
+
+    def _save_catalog(self):
+        try:
+            # Write to temp file and rename so we never leave a partial file behind.
+            filename = self.catalog_file + ".tmp"
+            with open(filename, "w") as f:
+                json.dump({"version": CATALOG_VERSION, "apps": self.catalog}, f)
+            os.replace(filename, self.catalog_file)
+        except Exception as e:
+            print(f"Unable to save app catalog: {e}")
+
     def update_progs(self):
         with self.progs_lock:
             self.progs = {}
+            catalog = {}
             for k, v in self.progmap.items():
                 appdir = os.path.join(self.kapp.homedir, v['path'])
-                self.progs[k] = [self._app_info(appdir, f) for f in os.listdir(appdir)]
-                self.progs[k] = [p for p in self.progs[k] if p is not None]
+                self.progs[k] = []
+                for f in os.listdir(appdir):
+                    path = os.path.join(appdir, f)
+                    entry = self.catalog.get(path)
+                    # Only re-read app info if the app has changed.
+                    if entry is None or not _valid(entry['signature']):
+                        info = self._app_info(appdir, f)
+                        entry = {"signature": _signature(path, info), "info": info}
+                    catalog[path] = entry
+                    if entry['info'] is not None:
+                        self.progs[k].append(entry['info'])
                 self.progs[k].sort(key=lambda f: f['name'].lower()) # sort by name ignoring upper/lowercase
+            # Removed apps are dropped from the catalog.
+            if catalog!=self.catalog:
+                self.catalog = catalog
+                self._save_catalog()
 
     def _out_editor_files(self):
         # Remove homedir from files, assumes they are all in the homedir, which may change...
@@ -329,40 +418,79 @@ class AppsDialog:
         url = f"/editor/load{urlencode(files, True)}"
         return self.kapp.editor_item.out_url(url) + self.kapp.about_dialog.view_edit_button.out_url(url)
 
+    def _start_zygote(self):
+        if not self.kapp.vizy_config['software'].get('app zygote'):
+            return
+        # (Re)start zygote if it isn't running.
+        if self.zygote is None or self.zygote.poll() is not None:
+            print("Starting app zygote...")
+            self.zygote = subprocess.Popen(["sudo", "-E", "-u", self.user, sys.executable, ZYGOTE_PATH, "serve"])
+
+    def _command(self):
+        executable = self.prog['executable']
+        # Fork python apps from the zygote (which falls back to a regular exec if it isn't ready).
+        if self.zygote and self.prog.get('zygote', True) and executable.startswith("python3 "):
+            self._start_zygote()
+            executable = f"python3 {ZYGOTE_PATH} run {executable[len('python3 '):]}"
+        return f"sudo -E -u {self.user} {executable}"
+
+    def _http_ready(self):
+        try:
+            urlopen(f'http://localhost:{PORT}', timeout=HTTP_POLL_PERIOD)
+            return True
+        except:
+            return False
+
     def wfc_thread(self):
         msg = ""
         while self.run_thread:
             self._ftime_update()
-            self.pid = self.console.start_single_process(f"sudo -E -u {self.user} {self.prog['executable']}")
+            # Discard stale ready notifications.
+            self.ready_socket.received()
+            self.app_pid = None
+            command = self._command()
+            # If the app is forked from the zygote, it isn't a descendant of self.pid.
+            self.forked = ZYGOTE_PATH in command
+            self.pid = self.console.start_single_process(command)
+            exit_watcher = ExitWatcher(self.pid)
             self.name_ = self.name
             start_msg = msg if msg else f"Starting {self.name_}..."
             self.console.print(colored(start_msg, "green"))
             mods = self.kapp.out_main_src("") + self.kapp.out_start_message(start_msg) 
-            # Wait for app to come up
-            t0 = time.time()
+            self.kapp.push_mods(mods)
+            # Wait for app to signal that it's listening, or fall back to polling via HTTP
+            t_start = t0 = t_poll = time.time()
             while True: 
-                try:
-                    self.kapp.push_mods(mods)
-                    urlopen(f'http://localhost:{PORT}')
+                r = self.wakeup.wait([self.ready_socket, exit_watcher], HTTP_POLL_PERIOD)
+                t = time.time()
+                if self.ready_socket in r and self.ready_socket.received():
+                    self.app_pid = self.ready_socket.pid
+                    break
+                # If program exits...
+                if exit_watcher in r and self._exit_poll("has failed to start, starting default program..."):
+                    self._set_default_prog()
                     break
-                except:
-                    # If program exits...
-                    if self._exit_poll("has failed to start, starting default program..."):
-                        self._set_default_prog()
+                if t-t_poll>=HTTP_POLL_PERIOD:
+                    t_poll = t
+                    self.kapp.push_mods(mods)
+                    if self._http_ready():
                         break
-                    # or if program doesn't start after a timeout period, kill it,
-                    # which will cause the default program to run
-                    if time.time()-t0>START_TIMEOUT:
-                        t0 = 1e10 
-                        os.kill(self.pid, signal.SIGTERM)
-                    time.sleep(0.5)
-                            
+                # or if program doesn't start after a timeout period, kill it,
+                # which will cause the default program to run
+                if t-t0>START_TIMEOUT:
+                    t0 = 1e10 
+                    os.kill(self.pid, signal.SIGTERM)
 
             if self.pid:
+                msg = colored(f"{self.name_} is ready ({time.time()-t_start:.2f} seconds)", "green")
+                print(msg)
+                self.console.print(msg)
                 self.kapp.push_mods(self.kapp.out_main_src("/app") + self._out_editor_files() + [Output(self.carousel.id, "items", self.citems())] + self.kapp.out_set_program(self.prog) + self.run_button.out_spinner_disp(False) + self.status.out_value(self.name + " is running"))
                 msg = ""
+                # Block until the app exits or we're asked to restart it.
                 while self.run_thread:
-                    if self._exit_poll(f"has exited, starting {self.name}..."):
+                    r = self.wakeup.wait([exit_watcher])
+                    if exit_watcher in r and self._exit_poll(f"has exited, starting {self.name}..."):
                         break
                     if self.restart:
                         if self.pid:
@@ -373,7 +501,7 @@ class AppsDialog:
                             os.kill(self.pid, signal.SIGTERM)
                             msg = f"{self.name_} has been modified, restarting..."
                         self.modified = False
-                    time.sleep(0.5)
+            exit_watcher.close()
 
     def exit_app(self):
         self.close()
@@ -381,3 +509,7 @@ class AppsDialog:
 
     def close(self):        
         self.run_thread = False
+        self.wakeup.set()
+        self.ready_socket.close()
+        if self.zygote:
+            self.zygote.terminate()
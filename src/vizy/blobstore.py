@@ -0,0 +1,186 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import shutil
+import hashlib
+from threading import Lock
+
+# Under the Vizy etc directory
+BLOB_DIR_NAME = "blobs"
+# Files that are written once and never modified in place, so they can be
+# shared.
+BLOB_EXTENSIONS = (".jpg", ".jpeg", ".png", ".mp4", ".tflite")
+CHUNK_SIZE = 1024*1024
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def link_file(src, dest):
+    """
+    Hard links src to dest (replacing dest), or copies it if they're on
+    different filesystems.  Returns True if it was linked.
+    """
+    tmp = dest + ".tmp"
+    try:
+        os.link(src, tmp)
+        linked = True
+    except OSError:
+        shutil.copyfile(src, tmp)
+        linked = False
+    os.replace(tmp, dest)
+    return linked
+
+
+class BlobStore:
+    """
+    Content-addressed store for media and models that projects share.  Each
+    distinct file is stored once (named by its SHA-256 hash) and the
+    project's files are hard links to it, so the same image in several
+    training sets, or the same model in models/ and an export, takes up
+    space once:
+
+        blobs = BlobStore(etcdir)
+        blobs.copy(src, dest)       # in place of "cp src dest"
+        blobs.adopt(training_dir)   # dedupe files that are already there
+        blobs.gc()                  # after deleting projects
+
+    The reference count of a blob is its link count (minus the store's own
+    link), so it's always right, even if project files are deleted with
+    rm.  gc() removes blobs nobody references.  Shared files must not be
+    modified in place -- write a new file and rename it instead.
+    """
+    def __init__(self, etcdir, name=BLOB_DIR_NAME):
+        self.root = os.path.join(etcdir, name)
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = Lock()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def _put(self, src, digest, move):
+        # Get src into the store as digest, if it isn't already.  Called with
+        # self.lock held, and the caller links to the blob before releasing it,
+        # so gc() can't remove the blob in between.
+        blob = self.path(digest)
+        if os.path.exists(blob):
+            return blob
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if move:
+            # src becomes the blob (it's about to be linked back).
+            try:
+                os.link(src, blob)
+                return blob
+            except OSError:
+                pass
+        shutil.copyfile(src, blob + ".tmp")
+        os.replace(blob + ".tmp", blob)
+        return blob
+
+    def copy(self, src, dest):
+        """
+        Makes dest a (shared) copy of src.  src itself is left alone, so it
+        can still be modified.  Returns the hash.
+        """
+        digest = file_hash(src)
+        with self.lock:
+            link_file(self._put(src, digest, False), dest)
+        return digest
+
+    def add(self, path):
+        """
+        Puts the file at path in the store, and replaces it with a link to
+        the stored copy (e.g. an identical file from another project).
+        Returns the hash.
+        """
+        digest = file_hash(path)
+        with self.lock:
+            blob = self._put(path, digest, True)
+            if not os.path.samefile(blob, path):
+                link_file(blob, path)
+        return digest
+
+    def adopt(self, directory, extensions=BLOB_EXTENSIONS):
+        """
+        add()s the files in directory (recursively) that aren't already
+        links to blobs.  Returns the number of files added.
+        """
+        # Files are identified by inode, so we only hash the new ones.
+        inodes = set()
+        for blob in self._blobs():
+            st = os.stat(blob)
+            inodes.add((st.st_dev, st.st_ino))
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                try:
+                    st = os.lstat(path)
+                    if not f.lower().endswith(extensions) or (st.st_dev, st.st_ino) in inodes:
+                        continue
+                    self.add(path)
+                    count += 1
+                except OSError as e:
+                    print(f"Unable to add {path} to blob store: {e}")
+        return count
+
+    def refcount(self, digest):
+        try:
+            return os.stat(self.path(digest)).st_nlink - 1
+        except OSError:
+            return 0
+
+    def _blobs(self):
+        for d in os.listdir(self.root):
+            dirpath = os.path.join(self.root, d)
+            if not os.path.isdir(dirpath):
+                continue
+            for f in os.listdir(dirpath):
+                if not f.endswith(".tmp"):
+                    yield os.path.join(dirpath, f)
+
+    def gc(self):
+        """
+        Removes blobs that no project references.  Returns (number of
+        blobs, bytes) freed.
+        """
+        count = size = 0
+        with self.lock:
+            for blob in self._blobs():
+                st = os.stat(blob)
+                if st.st_nlink<=1:
+                    os.remove(blob)
+                    count += 1
+                    size += st.st_size
+        return count, size
+
+    def report(self):
+        """
+        Returns dict with the number of blobs and references, the bytes
+        stored, the bytes the references would take as separate copies, and
+        the difference (saved).
+        """
+        blobs = refs = stored = logical = 0
+        for blob in self._blobs():
+            st = os.stat(blob)
+            n = st.st_nlink - 1
+            blobs += 1
+            refs += n
+            stored += st.st_size
+            logical += st.st_size*n
+        return dict(blobs=blobs, refs=refs, stored=stored, logical=logical, saved=max(logical-stored, 0))
@@ -0,0 +1,91 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import json
+import atexit
+from threading import Timer, Lock
+from kritter import ConfigFile
+
+# Wait this long after the last save() before writing.
+DEBOUNCE_PERIOD = 1 # seconds
+
+
+class DebouncedConfigFile(ConfigFile):
+    """
+    Drop-in replacement for kritter.ConfigFile whose save() doesn't write
+    right away.  The file is written DEBOUNCE_PERIOD seconds after the last
+    save(), so a burst of saves (e.g. dragging a slider) results in one
+    write.  Writes are atomic (temp file + rename), so a power loss can't
+    leave a truncated file, and a failed write is retried after another
+    DEBOUNCE_PERIOD.  Call flush() to write pending changes now --
+    this also happens in close() and when the program exits.
+    """
+    def __init__(self, filename, default={}, period=DEBOUNCE_PERIOD):
+        self.filename_ = filename
+        self.period = period
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.timer = None
+        # JSON waiting to be written
+        self.pending = None
+        self.saves = self.writes = 0
+        super().__init__(filename, default)
+        atexit.register(self.flush)
+
+    def _arm(self):
+        # Called with self.lock held.
+        if self.timer:
+            self.timer.cancel()
+        self.timer = Timer(self.period, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def save(self):
+        with self.lock:
+            self.saves += 1
+            # Serialize here, in the thread that modified the config, rather than
+            # in the timer thread while callbacks may be modifying it.
+            self.pending = json.dumps(self.config, indent=4)
+            self._arm()
+
+    def flush(self):
+        # save() only needs self.lock, so it isn't held up while we're writing.
+        with self.write_lock:
+            with self.lock:
+                if self.pending is None:
+                    return
+                if self.timer:
+                    self.timer.cancel()
+                    self.timer = None
+                data, self.pending = self.pending, None
+            filename = self.filename_ + ".tmp"
+            try:
+                with open(filename, "w") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(filename, self.filename_)
+            except OSError as e:
+                print(f"Unable to write {self.filename_}, will retry: {e}")
+                with self.lock:
+                    # Try again later, unless there's a newer save pending.
+                    if self.pending is None:
+                        self.pending = data
+                        self._arm()
+                return
+            self.writes += 1
+
+    def writes_avoided(self):
+        return self.saves - self.writes
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
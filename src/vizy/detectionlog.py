@@ -0,0 +1,386 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import time
+import json
+import sqlite3
+from array import array
+from threading import Thread, Lock, Condition
+
+# Write buffered events this often (or when there are FLUSH_COUNT of them).
+FLUSH_PERIOD = 60 # seconds
+FLUSH_COUNT = 1000
+ROLLUPS_FILE = "rollups.db"
+CLASSES_FILE = "classes.json"
+
+REGISTER = 0
+PICK = 1
+DEREGISTER = 2
+EVENTS = {"register": REGISTER, "pick": PICK, "deregister": DEREGISTER}
+
+# One file per column per day.  Each file is a packed array, so appending is
+# cheap and a column can be read without touching the others.
+COLUMNS = {"time": "d", "event": "B", "class": "H", "score": "f", "track": "i", "duration": "f"}
+HOUR = "hour"
+DAY = "day"
+
+
+def _buckets(t):
+    # Hour and day buckets (local time) for timestamp t
+    lt = time.localtime(t)
+    return time.strftime("%Y-%m-%d %H", lt), time.strftime("%Y-%m-%d", lt)
+
+def _bucket_bounds(start, end, period):
+    # Bucket keys covering [start, end) -- keys sort like the times they represent.
+    lo = _buckets(start)[0 if period==HOUR else 1] if start is not None else ""
+    hi = _buckets(end)[0 if period==HOUR else 1] if end is not None else "~"
+    return lo, hi
+
+
+class DetectionLog:
+    """
+    Append-only log of detections (register, pick and deregister events
+    from the tracker and picker), with hourly and daily rollups kept up to
+    date as events are written, so questions like "how many of each class
+    did we see per day this month" are answered from the rollups without
+    reading the log:
+
+        log = DetectionLog(os.path.join(etcdir, "detections"))
+        log.register(regs)     # from picker.get_regs_deregs()
+        log.pick(det)
+        log.deregister(deregs)
+        log.totals(time.time()-7*24*3600)    # {class: count}
+        log.counts(period="hour")            # [(bucket, {class: count}), ...]
+
+    Events are buffered in memory and written every FLUSH_PERIOD seconds,
+    so logging is cheap enough for the frame path.  The log itself is
+    columnar (one packed array file per column per day, see COLUMNS) and
+    the rollups are in a small SQLite database, along with how many rows
+    of each day's log they include.  When the log is opened, columns left
+    with different lengths by a crash are truncated to the shortest, and
+    rows that didn't make it into the rollups are rolled up.  If the
+    rollups are lost they're rebuilt from the log.
+    """
+    def __init__(self, directory, flush_period=FLUSH_PERIOD):
+        self.directory = directory
+        self.flush_period = flush_period
+        os.makedirs(directory, exist_ok=True)
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        # Columns of a batch have to be appended together.
+        self.flush_lock = Lock()
+        self.pending = []
+        self.tracks = {}
+        self.classes_file = os.path.join(directory, CLASSES_FILE)
+        try:
+            with open(self.classes_file) as f:
+                self.classes = json.load(f)
+        except (OSError, ValueError):
+            self.classes = []
+        self.class_index = {c: i for i, c in enumerate(self.classes)}
+        # Days whose files have been checked (see _open_day())
+        self.open_days = set()
+        rollups_file = os.path.join(directory, ROLLUPS_FILE)
+        self.db = sqlite3.connect(rollups_file, isolation_level=None, check_same_thread=False)
+        # Rollups without a high-water mark table can't be trusted.
+        rebuild = not self.db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='marks'").fetchone()
+        self.db.execute("CREATE TABLE IF NOT EXISTS rollups (period TEXT, bucket TEXT, class TEXT, registers INTEGER DEFAULT 0, picks INTEGER DEFAULT 0, dwell REAL DEFAULT 0, PRIMARY KEY (period, bucket, class))")
+        # Number of rows of each day's log that are in the rollups
+        self.db.execute("CREATE TABLE IF NOT EXISTS marks (day TEXT PRIMARY KEY, rows INTEGER)")
+        self.db_lock = Lock()
+        if rebuild:
+            self.rebuild()
+        else:
+            for day in self.days():
+                self._open_day(day)
+        self.running = True
+        self.thread = Thread(target=self.flush_thread, daemon=True)
+        self.thread.start()
+
+    def log(self, event, cls, score=0, track=-1, duration=0, t=None):
+        """
+        Logs an event ("register", "pick" or "deregister") for class cls.
+        duration is how long the track was around (for deregister).
+        """
+        with self.lock:
+            self.pending.append((time.time() if t is None else t, EVENTS[event], cls, score, track, duration))
+            if len(self.pending)>=FLUSH_COUNT:
+                self.cond.notify()
+
+    def register(self, dets):
+        t = time.time()
+        for d in dets:
+            track = d.get('index', -1)
+            self.tracks[track] = t, d['class']
+            self.log("register", d['class'], d.get('score', 0), track, t=t)
+
+    def pick(self, det):
+        self.log("pick", det['class'], det.get('score', 0), det.get('index', -1))
+
+    def deregister(self, deregs):
+        t = time.time()
+        for d in deregs:
+            # Deregs may be dets or just track indexes.
+            track = d.get('index', -1) if isinstance(d, dict) else d
+            t0, cls = self.tracks.pop(track, (t, None))
+            if isinstance(d, dict):
+                cls = d.get('class', cls)
+            if cls is not None:
+                self.log("deregister", cls, d.get('score', 0) if isinstance(d, dict) else 0, track, t-t0, t=t)
+
+    def _class_index(self, cls):
+        i = self.class_index.get(cls)
+        if i is None:
+            i = self.class_index[cls] = len(self.classes)
+            self.classes.append(cls)
+            with open(self.classes_file + ".tmp", "w") as f:
+                json.dump(self.classes, f)
+            os.replace(self.classes_file + ".tmp", self.classes_file)
+        return i
+
+    def _rows(self, day):
+        # Number of complete rows in day's log
+        dirname = os.path.join(self.directory, day)
+        rows = []
+        for name, typecode in COLUMNS.items():
+            try:
+                rows.append(os.path.getsize(os.path.join(dirname, name))//array(typecode).itemsize)
+            except OSError:
+                rows.append(0)
+        return min(rows)
+
+    def _open_day(self, day):
+        # Before appending to a day (after opening, or after a write error),
+        # truncate its columns to the same length, so a torn write can't
+        # misalign later rows, and roll up rows the rollups don't have.
+        if day in self.open_days:
+            return
+        dirname = os.path.join(self.directory, day)
+        rows = self._rows(day)
+        for name, typecode in COLUMNS.items():
+            filename = os.path.join(dirname, name)
+            size = rows*array(typecode).itemsize
+            if os.path.exists(filename) and os.path.getsize(filename)>size:
+                print(f"Truncating {filename} after incomplete write")
+                os.truncate(filename, size)
+        with self.db_lock:
+            row = self.db.execute("SELECT rows FROM marks WHERE day=?", (day,)).fetchone()
+        mark = row[0] if row else 0
+        if mark<rows:
+            c = self._read_day(day)
+            events = [(c['time'][i], c['event'][i], self.classes[c['class'][i]], 0, 0, c['duration'][i]) for i in range(mark, rows)]
+            self._update_rollups(self._rollup_rows(events), day, rows-mark)
+        elif mark>rows:
+            print(f"Detection log for {day} is shorter than its rollups")
+            with self.db_lock:
+                self.db.execute("UPDATE marks SET rows=? WHERE day=?", (rows, day))
+        self.open_days.add(day)
+
+    def _append(self, day, columns):
+        dirname = os.path.join(self.directory, day)
+        os.makedirs(dirname, exist_ok=True)
+        for name, values in columns.items():
+            with open(os.path.join(dirname, name), "ab") as f:
+                array(COLUMNS[name], values).tofile(f)
+
+    @staticmethod
+    def _rollup_rows(events):
+        # Sum events into (period, bucket, class): [registers, picks, dwell]
+        sums = {}
+        for t, event, cls, score, track, duration in events:
+            for period, bucket in zip((HOUR, DAY), _buckets(t)):
+                s = sums.setdefault((period, bucket, cls), [0, 0, 0.0])
+                if event==REGISTER:
+                    s[0] += 1
+                elif event==PICK:
+                    s[1] += 1
+                else:
+                    s[2] += duration
+        return [k + tuple(v) for k, v in sums.items()]
+
+    def _update_rollups(self, rows, day, count):
+        # Add rows to the rollups and count to day's mark, in one transaction.
+        with self.db_lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("INSERT INTO rollups (period, bucket, class, registers, picks, dwell) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (period, bucket, class) DO UPDATE SET registers=registers+excluded.registers, picks=picks+excluded.picks, dwell=dwell+excluded.dwell", rows)
+                self.db.execute("INSERT INTO marks (day, rows) VALUES (?, ?) ON CONFLICT (day) DO UPDATE SET rows=rows+excluded.rows", (day, count))
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                events = self.pending
+                self.pending = []
+            if events:
+                self._write(events)
+
+    def _write(self, events):
+        days = {}
+        for e in events:
+            days.setdefault(_buckets(e[0])[1], []).append(e)
+        for day, day_events in days.items():
+            columns = {name: [] for name in COLUMNS}
+            for t, event, cls, score, track, duration in day_events:
+                columns['time'].append(t)
+                columns['event'].append(event)
+                columns['class'].append(self._class_index(cls))
+                columns['score'].append(score)
+                columns['track'].append(track)
+                columns['duration'].append(duration)
+            try:
+                self._open_day(day)
+                self._append(day, columns)
+                self._update_rollups(self._rollup_rows(day_events), day, len(day_events))
+            except:
+                # Check the day's files (and catch up the rollups) before
+                # writing to it again.
+                self.open_days.discard(day)
+                raise
+
+    def flush_thread(self):
+        while True:
+            with self.lock:
+                if self.running:
+                    self.cond.wait(self.flush_period)
+                running = self.running
+            try:
+                self.flush()
+            except Exception as e:
+                print("Unable to write detection log:", e)
+            if not running:
+                return
+
+    def days(self):
+        return sorted([d for d in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, d))])
+
+    def _read_day(self, day, names=COLUMNS):
+        dirname = os.path.join(self.directory, day)
+        columns = {}
+        n = None
+        for name in names:
+            a = array(COLUMNS[name])
+            try:
+                with open(os.path.join(dirname, name), "rb") as f:
+                    a.frombytes(f.read())
+            except OSError:
+                pass
+            columns[name] = a
+            n = len(a) if n is None else min(n, len(a))
+        # Columns can have different lengths until _open_day() fixes them.
+        return {name: a[:n] for name, a in columns.items()}
+
+    def events(self, start=None, end=None, classes=None):
+        """
+        Returns the logged events between start and end (timestamps) as a
+        list of dicts (time, event, class, score, track, duration).  This
+        reads the log, use counts()/totals() for summaries.
+        """
+        self.flush()
+        lo, hi = _bucket_bounds(start, end, DAY)
+        names = {v: k for k, v in EVENTS.items()}
+        res = []
+        for day in self.days():
+            if not lo<=day<=hi:
+                continue
+            c = self._read_day(day)
+            for i, t in enumerate(c['time']):
+                cls = self.classes[c['class'][i]]
+                if (start is None or t>=start) and (end is None or t<end) and (classes is None or cls in classes):
+                    res.append({"time": t, "event": names[c['event'][i]], "class": cls, "score": c['score'][i], "track": c['track'][i], "duration": c['duration'][i]})
+        return res
+
+    def counts(self, start=None, end=None, period=DAY, classes=None, field="registers"):
+        """
+        Returns [(bucket, {class: count}), ...] for the hour or day buckets
+        between start and end (timestamps), oldest first.  field is
+        "registers" (objects seen), "picks" or "dwell" (seconds).
+        """
+        lo, hi = _bucket_bounds(start, end, period)
+        return self._counts(lo, hi, period, classes, field)
+
+    def _counts(self, lo, hi, period, classes, field):
+        # counts() for bucket keys lo through hi
+        if field not in ("registers", "picks", "dwell"):
+            raise ValueError(f"Unknown field {field}")
+        self.flush()
+        with self.db_lock:
+            rows = self.db.execute(f"SELECT bucket, class, {field} FROM rollups WHERE period=? AND bucket>=? AND bucket<=? ORDER BY bucket", (period, lo, hi)).fetchall()
+        res = []
+        for bucket, cls, value in rows:
+            if classes is not None and cls not in classes:
+                continue
+            if not res or res[-1][0]!=bucket:
+                res.append((bucket, {}))
+            res[-1][1][cls] = value
+        return res
+
+    def totals(self, start=None, end=None, classes=None, field="registers"):
+        """
+        Returns {class: count} between start and end.  Whole days are
+        counted from the day rollups, and the partial days at either end
+        from the hour rollups, so the result is accurate to the hour.
+        """
+        day_lo, day_hi = _bucket_bounds(start, end, DAY)
+        hour_lo, hour_hi = _bucket_bounds(start, end, HOUR)
+        if start is not None and day_lo==day_hi:
+            rows = self._counts(hour_lo, hour_hi, HOUR, classes, field)
+        else:
+            rows = self._counts(day_lo, day_hi, DAY, classes, field)
+            if start is not None:
+                rows = [r for r in rows if r[0]!=day_lo] + self._counts(hour_lo, day_lo + " 23", HOUR, classes, field)
+            if end is not None:
+                rows = [r for r in rows if r[0]!=day_hi] + self._counts(day_hi + " 00", hour_hi, HOUR, classes, field)
+        totals = {}
+        for bucket, counts in rows:
+            for cls, value in counts.items():
+                totals[cls] = totals.get(cls, 0) + value
+        return totals
+
+    def rebuild(self):
+        """
+        Recomputes the rollups from the log.
+        """
+        with self.db_lock:
+            self.db.execute("DELETE FROM rollups")
+            self.db.execute("DELETE FROM marks")
+        self.open_days = set()
+        for day in self.days():
+            self._open_day(day)
+
+    def summary(self, days=1):
+        """
+        Returns text lines summarizing the last days days, for the "stats"
+        text command.
+        """
+        start = time.time() - days*24*3600
+        totals = self.totals(start)
+        if not totals:
+            return [f"No detections in the last {days} day(s)."]
+        res = [f"{cls}: {n}" for cls, n in sorted(totals.items(), key=lambda i: -i[1])]
+        hours = {}
+        for bucket, counts in self.counts(start, period=HOUR):
+            hour = bucket[-2:]
+            hours[hour] = hours.get(hour, 0) + sum(counts.values())
+        busiest = max(hours.items(), key=lambda i: i[1])
+        return [f"Last {days} day(s), {sum(totals.values())} detections:"] + res + [f"Busiest hour: {busiest[0]}:00 ({busiest[1]})"]
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        with self.db_lock:
+            self.db.close()
@@ -0,0 +1,198 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import time
+from collections import deque, OrderedDict
+from threading import Thread, Condition
+
+EVENT_QUEUE_SIZE = 50
+# Each lane has this many workers.  One worker runs a lane's handlers in the
+# order they were posted (e.g. a trigger is handled after the register that
+# preceded it).
+WORKERS = 1
+DEFAULT_LANE = "default"
+# When a lane's queue is full of jobs that can't be dropped, post() waits this
+# long for room before it drops the new job.
+BLOCK_TIMEOUT = 0.5 # seconds
+# What to do when the queue is full
+DROP_OLDEST = "drop oldest"
+DROP_NEWEST = "drop newest"
+
+
+class _Job:
+    def __init__(self, name, key, drop, func, args, kwargs):
+        self.name = name
+        self.key = key
+        self.drop = drop
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.time = time.time()
+
+
+class EventBus:
+    """
+    Runs event handlers (and slow sends, e.g. text messages) in worker
+    threads so that the caller, typically a frame grabbing thread, never
+    blocks on them for long.  Jobs are posted to a `lane`, and each lane
+    has its own queue and workers, so a slow send in one lane doesn't hold
+    up handlers in another.  Each lane's queue is bounded (`size`) -- when
+    it's full the oldest (or newest) droppable job is dropped according to
+    `policy`, and the drop is logged.  Jobs posted with drop=False (e.g.
+    events that handlers count on) are only dropped if the queue is still
+    full of them after waiting `block` seconds.  Jobs posted with a `key`
+    are coalesced, i.e. a pending job with the same key is replaced by the
+    newer one.  With more than one worker per lane, handlers can run
+    concurrently and complete out of order.
+
+        bus = EventBus()
+        bus.post(handle_event, self, {"event_type": "trigger"}, drop=False)
+        bus.post(handle_event, self, {"event_type": "daytime"}, key="daytime")
+        bus.post(self.tv.send, ["Hello"], name="text", lane="text")
+    """
+    def __init__(self, workers=WORKERS, size=EVENT_QUEUE_SIZE, policy=DROP_OLDEST, block=BLOCK_TIMEOUT):
+        self.workers = workers
+        self.size = size
+        self.policy = policy
+        self.block = block
+        # lane: queue
+        self.queues = {}
+        self.cond = Condition()
+        # name: posted, dropped, coalesced, errors, runs, total wait, max wait, total run time, max run time
+        self.metrics_ = OrderedDict()
+        self.run_thread = True
+        self.threads = []
+
+    def _metrics(self, name):
+        if name not in self.metrics_:
+            self.metrics_[name] = dict(posted=0, dropped=0, coalesced=0, errors=0, runs=0, wait=0, max_wait=0, run=0, max_run=0)
+        return self.metrics_[name]
+
+    def _queue(self, lane):
+        # Called with self.cond held.  Lanes (and their workers) are created on
+        # first use.
+        queue = self.queues.get(lane)
+        if queue is None:
+            queue = self.queues[lane] = deque()
+            for i in range(self.workers):
+                t = Thread(target=self.worker, args=(queue,), daemon=True)
+                t.start()
+                self.threads.append(t)
+        return queue
+
+    def post(self, func, *args, name=None, key=None, drop=True, lane=DEFAULT_LANE, **kwargs):
+        """
+        Queues func(*args, **kwargs) to be called from one of `lane`'s
+        workers.  `name` is used for metrics (defaults to the function's
+        name).  If `drop` is False, the job is only dropped if there's no
+        room for it after waiting.  Returns False if the job was dropped.
+        """
+        if name is None:
+            name = getattr(func, "__name__", repr(func))
+        job = _Job(name, key, drop, func, args, kwargs)
+        with self.cond:
+            if not self.run_thread:
+                return False
+            queue = self._queue(lane)
+            self._metrics(name)['posted'] += 1
+            if key is not None:
+                for i, j in enumerate(queue):
+                    if j.key==key:
+                        self._metrics(j.name)['coalesced'] += 1
+                        queue[i] = job
+                        return True
+            if len(queue)>=self.size and self.policy==DROP_OLDEST:
+                for j in queue:
+                    if j.drop:
+                        queue.remove(j)
+                        self._drop(j)
+                        break
+            if len(queue)>=self.size:
+                if not drop:
+                    # Give the workers a chance to catch up.
+                    self.cond.wait_for(lambda: len(queue)<self.size or not self.run_thread, self.block)
+                if len(queue)>=self.size:
+                    # Drop it (and the image, etc. it's holding) rather than grow without limit.
+                    self._drop(job)
+                    return False
+            queue.append(job)
+            self.cond.notify_all()
+        return True
+
+    def _drop(self, job):
+        self._metrics(job.name)['dropped'] += 1
+        print(f"Event queue is full, dropped {job.name}")
+
+    def worker(self, queue):
+        while True:
+            with self.cond:
+                while self.run_thread and not queue:
+                    self.cond.wait()
+                if not queue:
+                    return
+                job = queue.popleft()
+                # Let post() know there's room.
+                self.cond.notify_all()
+            t0 = time.time()
+            error = False
+            try:
+                job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                print(f"Exception in event handler {job.name}: {e}")
+                error = True
+            t = time.time()
+            with self.cond:
+                m = self._metrics(job.name)
+                m['runs'] += 1
+                m['errors'] += error
+                m['wait'] += t0-job.time
+                m['max_wait'] = max(m['max_wait'], t0-job.time)
+                m['run'] += t-t0
+                m['max_run'] = max(m['max_run'], t-t0)
+
+    def pending(self):
+        with self.cond:
+            return sum([len(q) for q in self.queues.values()])
+
+    def metrics(self):
+        """
+        Returns dict of {name: metrics} where metrics is a dict with the
+        number of jobs posted, dropped, coalesced, failed (errors) and run,
+        and the average and maximum queue wait and run times in seconds.
+        """
+        res = OrderedDict()
+        with self.cond:
+            for name, m in self.metrics_.items():
+                runs = max(m['runs'], 1)
+                res[name] = dict(posted=m['posted'], dropped=m['dropped'], coalesced=m['coalesced'], errors=m['errors'], runs=m['runs'],
+                    wait=m['wait']/runs, max_wait=m['max_wait'], run=m['run']/runs, max_run=m['max_run'])
+        return res
+
+    def summary(self):
+        """
+        Returns lines of text with each handler's metrics, for the apps'
+        "events" text command.
+        """
+        metrics = self.metrics()
+        if not metrics:
+            return "No events yet."
+        return [f"{name}: {m['runs']} run, {m['dropped']} dropped, {m['run']*1000:.0f}ms avg, {m['max_run']*1000:.0f}ms max" for name, m in metrics.items()]
+
+    def close(self, timeout=None):
+        """
+        Stops the workers after the queued jobs have run (or after `timeout`
+        seconds, in which case the remaining jobs are abandoned).
+        """
+        with self.cond:
+            self.run_thread = False
+            self.cond.notify_all()
+        t0 = time.time()
+        for t in self.threads:
+            t.join(None if timeout is None else max(timeout-(time.time()-t0), 0))
@@ -5,6 +5,7 @@ import json
 import dash_core_components as dcc
 import dash_html_components as html
 from dash_devices.dependencies import Input, Output, State
+from .projectarchive import write_archive, transfer
 
 class ExportProjectDialog(kritter.Kdialog):
 
@@ -38,6 +39,9 @@ class ExportProjectDialog(kritter.Kdialog):
         def _update_status(percent):
             self.kapp.push_mods(self.status.out_value(f"Copying to Google Drive ({percent}%)..."))
 
+        def _update_zip_status(percent, name):
+            self.kapp.push_mods(self.status.out_value(f"Zipping project files ({percent}%)..."))
+
         @self.callback_view()
         def func(state):
             if not state:
@@ -47,20 +51,24 @@ class ExportProjectDialog(kritter.Kdialog):
         def func():
             self.kapp.push_mods(self.export.out_spinner_disp(True) + self.status.out_value("Zipping project files...") + self.copy_key.out_disp(False))
             file_info = self.file_info_func()
-            os.chdir(file_info['project_dir'])
-            files_string = ''
-            for i in file_info['files']:
-                files_string += f" '{i}'"
-            files_string = files_string[1:]
             export_file = kritter.time_stamped_file("zip", f"{file_info['project_name']}_export_")
-            os.system(f"zip -r '{export_file}' {files_string}")
+            export_path = os.path.join(file_info['project_dir'], export_file)
             gdrive_file = os.path.join(file_info['gdrive_dir'], export_file)
             try:
-                self.gdrive.copy_to(os.path.join(file_info['project_dir'], export_file), gdrive_file, True, _update_status)
+                write_archive(export_path, file_info['project_dir'], file_info['files'], _update_zip_status)
+            except Exception as e:
+                print("Unable to create project export file.", e)
+                self.kapp.push_mods(self.status.out_value(f'Unable to create project export file. ({e})') + self.export.out_spinner_disp(False))
+                return
+            try:
+                transfer(self.gdrive.copy_to, export_path, gdrive_file, True, _update_status)
             except Exception as e:
                 print("Unable to upload project export file to Google Drive.", e)
                 self.kapp.push_mods(self.status.out_value(f'Unable to upload project export file to Google Drive. ({e})'))
                 return 
+            finally:
+                # The export lives on Google Drive, no need to keep a local copy.
+                os.remove(export_path)
             url = self.gdrive.get_url(gdrive_file)
             pieces = url.split("/")
             # Remove obvous non-id pieces
@@ -0,0 +1,123 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import datetime
+import threading
+from .vizypowerboard import COMPAT_HW_VERSION, EXEC_OFFSET, EXEC_SEMAPHORE, EXEC_WRITE, EXEC_NVCONFIG, EXEC_AD, EXEC_RTC, EXEC_RTC_CALIBRATE, CHANNEL_VIN, CHANNEL_5V, DIPSWITCH_2_BOOT_MODES
+
+FW_VERSION = [0, 0, 0]
+UUID = list(range(0x10, 0x20))
+VOLTAGES = {CHANNEL_VIN: 12.0, CHANNEL_5V: 5.1}
+
+
+def _bcd(dec):
+    return ((dec//10)<<4) | (dec%10)
+
+def _decimal(bcd):
+    return ((bcd&0xf0)>>4)*10 + (bcd&0x0f)
+
+
+class FakeBus:
+    """
+    In-memory stand-in for smbus.SMBus that emulates the Vizy Power Board's
+    register map, firmware semaphore and exec commands (RTC, NV config, A/D).
+    Pass an instance as the bus argument of VizyPowerBoard to run off-hardware.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.regs = [0]*0x100
+        self.regs[1:3] = COMPAT_HW_VERSION
+        self.regs[3:6] = FW_VERSION
+        self.regs[22:38] = UUID
+        self.regs[EXEC_OFFSET] = EXEC_SEMAPHORE
+        self.semaphore = True
+        self.nvconfig = DIPSWITCH_2_BOOT_MODES
+        self.rtc_offset = datetime.timedelta()
+        self.rtc_calibrate = 0
+        self.voltages = dict(VOLTAGES)
+        self.transactions = 0
+
+    def read_i2c_block_data(self, addr, offset, length):
+        with self.lock:
+            self.transactions += 1
+            if offset==EXEC_OFFSET and length==1:
+                # Reading the exec register grabs the semaphore if it's free.
+                if self.semaphore:
+                    self.semaphore = False
+                    return [EXEC_SEMAPHORE]
+                return [0]
+            return self.regs[offset:offset+length]
+
+    def write_i2c_block_data(self, addr, offset, data):
+        with self.lock:
+            self.transactions += 1
+            if offset==EXEC_OFFSET:
+                self._exec(data)
+            else:
+                self.regs[offset:offset+len(data)] = data
+
+    def close(self):
+        pass
+
+    def _exec(self, data):
+        cmd = data[0]
+        if cmd==EXEC_SEMAPHORE:
+            self.semaphore = True
+        elif cmd==EXEC_RTC:
+            t = datetime.datetime.now() + self.rtc_offset
+            self.regs[EXEC_OFFSET+1:EXEC_OFFSET+9] = [0, _bcd(t.second), _bcd(t.minute), _bcd(t.hour), _bcd(t.day), 0, _bcd(t.month), _bcd(t.year-2016)]
+        elif cmd==EXEC_RTC|EXEC_WRITE:
+            t = datetime.datetime(year=_decimal(data[8])+2016, month=_decimal(data[7]), day=_decimal(data[5]), hour=_decimal(data[4]), minute=_decimal(data[3]), second=_decimal(data[2]))
+            self.rtc_offset = t - datetime.datetime.now()
+        elif cmd==EXEC_NVCONFIG:
+            self.regs[EXEC_OFFSET+1] = self.nvconfig
+        elif cmd==EXEC_NVCONFIG|EXEC_WRITE:
+            self.nvconfig = data[1]
+        elif cmd==EXEC_RTC_CALIBRATE:
+            self.regs[EXEC_OFFSET+1] = self.rtc_calibrate
+        elif cmd==EXEC_RTC_CALIBRATE|EXEC_WRITE:
+            self.rtc_calibrate = data[1]
+        elif cmd==EXEC_AD:
+            mv = int(self.voltages.get(data[1], 0)*1000)
+            self.regs[EXEC_OFFSET+2:EXEC_OFFSET+4] = [mv&0xff, (mv>>8)&0xff]
+
+    # Helpers for simulating user input
+
+    def press_button(self, state=True):
+        with self.lock:
+            if state:
+                self.regs[47] |= 0x03 # pressed and pressed-latch bits
+            else:
+                self.regs[47] &= ~0x02
+
+    def request_power_off(self):
+        with self.lock:
+            self.regs[38] = 0x0f
+
+    def set_io_bit(self, bit, state=True):
+        with self.lock:
+            if state:
+                self.regs[72] |= 1<<bit
+            else:
+                self.regs[72] &= ~(1<<bit)
+
+
+_fake_bus = None
+
+def get_fake_bus():
+    """
+    Returns the FakeBus that VizyPowerBoard uses when VIZY_POWER_BOARD=fake.
+    It's shared so all power board instances in the process see the same
+    registers.
+    """
+    global _fake_bus
+    if _fake_bus is None:
+        _fake_bus = FakeBus()
+    return _fake_bus
@@ -0,0 +1,268 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import time
+from collections import deque, OrderedDict
+from threading import Thread, Condition
+from .profiler import get_profiler
+
+# How long to wait before calling the source stage again when it doesn't
+# return a frame.
+IDLE_PERIOD = 0.001 # seconds
+# When the source stage keeps raising, back off (doubling up to
+# MAX_ERROR_BACKOFF) instead of spinning.
+ERROR_BACKOFF = 0.01 # seconds
+MAX_ERROR_BACKOFF = 1 # seconds
+# Print a stage's exceptions at most this often.
+ERROR_PRINT_PERIOD = 5 # seconds
+STOP_TIMEOUT = 5 # seconds
+
+
+class Frame:
+    """
+    Passed from stage to stage.  The source stage sets image (and
+    whatever else it likes), later stages add to mods, which is typically
+    pushed by the last stage.  Attributes that haven't been set are None --
+    e.g. frame.detect for a frame that an fps-capped infer stage skipped.
+    """
+    def __init__(self):
+        self.image = None
+        self.mods = []
+        self.time = time.time()
+
+    def __getattr__(self, name):
+        # Only called for attributes that haven't been set.
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return None
+
+
+class _Stage:
+    def __init__(self, name, func, fps, thread, queue_size):
+        self.name = name
+        self.func = func
+        self.period = 1/fps if fps else 0
+        self.thread = thread
+        self.queue_size = queue_size
+        self.last = 0
+        self.key = None
+        self.consecutive_errors = 0
+        self.last_print = 0
+        self.suppressed = 0
+        self.metrics = dict(runs=0, skipped=0, dropped=0, errors=0, time=0, max_time=0)
+
+
+class FrameLoop:
+    """
+    Runs a frame pipeline, e.g. capture -> infer -> track -> render ->
+    publish, as a sequence of stages.  Each stage is a function that takes a
+    Frame.  The first stage is the source -- it sets frame.image (typically
+    from stream.frame()).  A stage can return False to drop the frame, in
+    which case the remaining stages are skipped.
+
+        loop = FrameLoop()
+        loop.add_stage("capture", self.capture)
+        loop.add_stage("infer", self.infer, fps=10)
+        loop.add_stage("publish", self.publish, thread=True)
+        loop.start()
+        ...
+        loop.stop()
+
+    fps caps a stage's rate.  For the source stage this paces the whole
+    loop; other stages are skipped for frames that arrive too soon, and the
+    frame continues to the later stages without whatever the skipped stage
+    sets (it reads as None), so later stages need to handle that, e.g.
+
+        def track(self, frame):
+            if frame.detect is None:
+                return
+
+    A stage added with thread=True runs (along with the stages after it)
+    in its own thread.  It's fed through a queue of queue_size frames --
+    when the queue is full the oldest frame is dropped, so a slow stage
+    (e.g. publishing to browsers) never holds up the stages before it.  A
+    dropped frame's mods aren't lost -- they're carried over to the frame
+    that replaces it.
+
+    Exceptions in stages are printed (at most every ERROR_PRINT_PERIOD
+    seconds) and counted, and the frame is dropped.  metrics() returns per-stage run counts and timing, and stage
+    latencies are recorded in the profiler (defaults to get_profiler()) as
+    "name/stage".
+    """
+    def __init__(self, name="frame loop", profiler=None):
+        self.name = name
+        self.profiler = profiler
+        self.stages = []
+        self.threads = []
+        self.running = False
+
+    def add_stage(self, name, func, fps=None, thread=False, queue_size=1):
+        if self.running:
+            raise RuntimeError("Can't add stages while running.")
+        stage = _Stage(name, func, fps, thread and len(self.stages)>0, queue_size)
+        stage.key = f"{self.name}/{name}"
+        self.stages.append(stage)
+
+    def _segments(self):
+        # Split stages into runs of stages that share a thread.
+        segments = []
+        for s in self.stages:
+            if not segments or s.thread:
+                segments.append([])
+            segments[-1].append(s)
+        return segments
+
+    def _run_stage(self, stage, frame, source=False):
+        t0 = time.time()
+        if stage.period and t0-stage.last<stage.period:
+            if not source:
+                stage.metrics['skipped'] += 1
+                return True
+            # Pace the source
+            time.sleep(stage.period-(t0-stage.last))
+            t0 = time.time()
+        stage.last = t0
+        try:
+            res = stage.func(frame)
+            stage.consecutive_errors = 0
+        except Exception as e:
+            stage.metrics['errors'] += 1
+            stage.consecutive_errors += 1
+            if t0-stage.last_print>=ERROR_PRINT_PERIOD:
+                suppressed = f" ({stage.suppressed} more since last time)" if stage.suppressed else ""
+                print(f"Exception in {self.name} stage {stage.name}: {e}{suppressed}")
+                stage.last_print = t0
+                stage.suppressed = 0
+            else:
+                stage.suppressed += 1
+            res = False
+        t = time.time()-t0
+        m = stage.metrics
+        m['runs'] += 1
+        m['time'] += t
+        m['max_time'] = max(m['max_time'], t)
+        self.profiler.record(stage.key, t)
+        return res is not False
+
+    def _run_segment(self, segment, frame, source=False):
+        for i, stage in enumerate(segment):
+            if not self._run_stage(stage, frame, source and i==0):
+                return False
+        return True
+
+    def _source_thread(self, segment, next_):
+        while self.running:
+            frame = Frame()
+            if self._run_segment(segment, frame, True):
+                if next_:
+                    next_.put(frame)
+            elif segment[0].consecutive_errors:
+                time.sleep(min(ERROR_BACKOFF*2**(segment[0].consecutive_errors-1), MAX_ERROR_BACKOFF))
+            elif frame.image is None:
+                # Nothing to do (e.g. paused), don't spin.
+                time.sleep(IDLE_PERIOD)
+
+    def _segment_thread(self, segment, input_, next_):
+        while True:
+            frame = input_.get()
+            if frame is None:
+                return
+            if self._run_segment(segment, frame) and next_:
+                next_.put(frame)
+
+    def start(self):
+        if self.running:
+            return
+        if not self.stages:
+            raise RuntimeError("No stages.")
+        if self.profiler is None:
+            self.profiler = get_profiler()
+        self.running = True
+        segments = self._segments()
+        queues = [None] + [_Queue(s[0]) for s in segments[1:]] + [None]
+        self.queues = queues[1:-1]
+        self.threads = [Thread(target=self._source_thread, args=(segments[0], queues[1]), daemon=True)]
+        self.threads += [Thread(target=self._segment_thread, args=(s, queues[i+1], queues[i+2]), daemon=True) for i, s in enumerate(segments[1:])]
+        for t in self.threads:
+            t.start()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Stops the loop and waits for the stages to finish the frames they're
+        working on.
+        """
+        if not self.running:
+            return
+        self.running = False
+        t0 = time.time()
+        # Stop the source first, then each following thread in turn.
+        self.threads[0].join(timeout)
+        for q, t in zip(self.queues, self.threads[1:]):
+            q.close()
+            t.join(max(timeout-(time.time()-t0), 0))
+        self.threads = []
+
+    def metrics(self):
+        """
+        Returns dict of {stage name: metrics} with the number of times each
+        stage ran, was skipped (fps cap), dropped frames (full queue) or
+        raised an exception, and its average and maximum run time (seconds).
+        """
+        res = OrderedDict()
+        for s in self.stages:
+            m = s.metrics
+            runs = max(m['runs'], 1)
+            res[s.name] = dict(runs=m['runs'], skipped=m['skipped'], dropped=m['dropped'], errors=m['errors'], time=m['time']/runs, max_time=m['max_time'])
+        return res
+
+
+def frame_stats(frame_loop, mod_scheduler, viewers):
+    """
+    Returns lines of text with the frame loop's stage metrics, the mod
+    scheduler's stats and the viewer stats, for the apps' "frames" text
+    command.
+    """
+    s = mod_scheduler.stats()
+    v = viewers.stats()
+    return [f"{name}: {m['runs']} run, {m['skipped']} skipped, {m['dropped']} dropped, {m['time']*1000:.1f}ms avg, {m['max_time']*1000:.1f}ms max" for name, m in frame_loop.metrics().items()] + \
+        [f"mods: {s['pushed']} pushed, {s['merged']} merged, {s['unchanged']} unchanged, {s['sent']} sent in {s['flushes']} batches",
+        f"viewers: {v['clients']} connected, {v['watched']} frames rendered, {v['unwatched']} skipped"]
+
+
+class _Queue:
+    # Bounded queue that drops the oldest frame when it's full.  Only the
+    # image is dropped -- the frame's mods (e.g. a new pick's media queue
+    # update) are carried over to the next frame, in order.
+    def __init__(self, stage):
+        self.stage = stage
+        self.queue = deque()
+        self.cond = Condition()
+        self.closed = False
+
+    def put(self, frame):
+        with self.cond:
+            if len(self.queue)>=self.stage.queue_size:
+                dropped = self.queue.popleft()
+                if dropped.mods:
+                    frame.mods = dropped.mods + frame.mods
+                self.stage.metrics['dropped'] += 1
+            self.queue.append(frame)
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while not self.queue and not self.closed:
+                self.cond.wait()
+            return self.queue.popleft() if self.queue else None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
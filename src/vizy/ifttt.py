@@ -1,30 +1,253 @@
 # imports
+import os
+import time
+import json
 import requests
-from json import dumps
+from collections import deque
+from threading import Thread, Condition
+from requests.adapters import HTTPAdapter
 
+IFTTT_URL_BASE = 'https://maker.ifttt.com/trigger/'
+QUEUE_SIZE = 100
+POOL_SIZE = 2
+TIMEOUT = 10 # seconds
+# Retry backoff doubles after each failure, up to BACKOFF_MAX.
+BACKOFF_START = 1 # seconds
+BACKOFF_MAX = 300 # seconds
+# Events with the same name and key are sent at most this often -- events
+# posted in between are coalesced into the pending one.  (Events without a key
+# are all sent.)
+MIN_INTERVAL = 1 # seconds
+SPOOL_FILE = "ifttt_spool.json"
 
-class IFTTT_Wrapper:
-    def __init__(self, key):
+
+class IFTTTClient:
+    """
+    Sends IFTTT webhook events from a background thread over a persistent
+    (keep-alive) HTTP session, so send() never blocks the caller.  Failed
+    sends are retried with exponential backoff, and HTTP 429 responses are
+    honored (Retry-After).  If a spool directory is given, events that are
+    still queued when the network is down (or when the client is closed)
+    are written to disk and resent when the network comes back.  Bursts of
+    events with the same name and key are coalesced -- only the newest data
+    is sent, with the number of coalesced events in "count".  The sending
+    thread is started when the first event is queued.
+
+        ifttt = IFTTTClient(key, spool_dir=self.kapp.etcdir)
+        ifttt.send("bird_detected", {"value1": "Cardinal"})
+
+    url_base can point to a local server for testing.
+    """
+    def __init__(self, key, spool_dir=None, url_base=IFTTT_URL_BASE, queue_size=QUEUE_SIZE, min_interval=MIN_INTERVAL):
         self.key = key if key else ''
-        self.url_base = 'https://maker.ifttt.com/trigger/'
+        self.url_base = url_base
+        self.queue_size = queue_size
+        self.min_interval = min_interval
+        self.spool_file = os.path.join(spool_dir, SPOOL_FILE) if spool_dir else None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.queue = deque()
+        self.cond = Condition()
+        self.last_sent = {}
+        self.backoff = 0
+        self.retry_time = 0
+        self.stats = dict(sent=0, failed=0, dropped=0, coalesced=0, spooled=0)
+        self.run_thread = True
+        self.thread = None
+        self._load_spool()
+        # Resend what's left over from last time.
+        if self.queue:
+            self._start()
 
-    def ping_event(self, event_name, event_type, data):
-        if self.key:
-            url = self.build_url(event_name, event_type, data)
-            try:
-                r = requests.post(url, data)
-            except Exception as e:
-                print ('Failed: ', e)
-        else:
-            print('no key')
+    def _start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.send_thread, daemon=True)
+            self.thread.start()
 
-    def build_url(self, event_name, event_type, data):
+    def build_url(self, event_name, json_=True):
         url = f"{self.url_base}{event_name}/"
-        if event_type=='json':         # elif event_type=='parameter': 
+        if json_:
             url += 'json/'
         url += f"with/key/{self.key}"
         return url
-        # match event_type:
-        #   case 'json': 
-        #   case 'parameter': 
-        #   case _: return # default
\ No newline at end of file
+
+    def send(self, event_name, data=None, json_=True, key=None):
+        """
+        Queues event for sending and returns right away.  json_ selects
+        IFTTT's JSON endpoint (arbitrary JSON body) vs. the regular endpoint
+        (value1, value2, value3).  data is a dict, or a str or bytes body
+        that's sent as is.  If key is given, pending events with the
+        same event_name and key are coalesced, and they're sent no more often
+        than min_interval.
+        """
+        if not self.key:
+            print('no key')
+            return
+        event = {"name": event_name, "data": data if data else {}, "json": json_, "key": key, "time": time.time(), "count": 1}
+        with self.cond:
+            if not self.run_thread:
+                return
+            self._start()
+            if key is not None:
+                for e in self.queue:
+                    if e['name']==event_name and e['key']==key:
+                        event['count'] += e['count']
+                        e.update(event)
+                        self.stats['coalesced'] += 1
+                        return
+            if len(self.queue)>=self.queue_size:
+                self.queue.popleft()
+                self.stats['dropped'] += 1
+            self.queue.append(event)
+            self.cond.notify()
+
+    def _post(self, event):
+        # Returns None if successful, otherwise the number of seconds to wait before retrying
+        # (0 means don't retry).
+        data = event['data']
+        try:
+            url = self.build_url(event['name'], event['json'])
+            if isinstance(data, dict):
+                data = dict(data)
+                if event['json'] and event['count']>1:
+                    data['count'] = event['count']
+                if event['json']:
+                    r = self.session.post(url, json=data, timeout=TIMEOUT)
+                else:
+                    r = self.session.post(url, data=data, timeout=TIMEOUT)
+            else:
+                # A body the caller already encoded (e.g. a JSON string) is sent as is.
+                r = self.session.post(url, data=data, timeout=TIMEOUT)
+        except requests.RequestException as e:
+            print('IFTTT send failed: ', e)
+            return self._next_backoff()
+        if r.status_code<300:
+            self.backoff = 0
+            return None
+        if r.status_code==429:
+            try:
+                return max(float(r.headers.get('Retry-After')), self._next_backoff())
+            except (TypeError, ValueError):
+                return self._next_backoff()
+        if r.status_code>=500:
+            return self._next_backoff()
+        # Other client errors (bad key, etc.) won't get better by retrying.
+        print(f'IFTTT send failed: {r.status_code} {r.text}')
+        return 0
+
+    def _next_backoff(self):
+        self.backoff = min(self.backoff*2, BACKOFF_MAX) if self.backoff else BACKOFF_START
+        return self.backoff
+
+    def _next_event(self):
+        # Returns the next event that isn't rate-limited, or the time to wait.
+        t = time.time()
+        wait = None
+        for e in self.queue:
+            if e['key'] is None:
+                self.queue.remove(e)
+                return e, 0
+            dt = self.last_sent.get((e['name'], e['key']), 0) + self.min_interval - t
+            if dt<=0:
+                self.queue.remove(e)
+                return e, 0
+            wait = dt if wait is None else min(wait, dt)
+        return None, wait
+
+    def send_thread(self):
+        while True:
+            with self.cond:
+                if not self.run_thread:
+                    return
+                # Don't send anything while we're backing off.
+                wait = self.retry_time - time.time()
+                event = None
+                if wait<=0:
+                    event, wait = self._next_event()
+                if event is None:
+                    self.cond.wait(wait)
+                    continue
+            try:
+                retry = self._post(event)
+            except Exception as e:
+                # Something's wrong with the event itself (e.g. data that can't be
+                # serialized), so drop it rather than take down the thread.
+                print(f"IFTTT unable to send {event['name']}, dropping: {e}")
+                retry = 0
+            if event['key'] is not None:
+                self.last_sent[(event['name'], event['key'])] = time.time()
+            with self.cond:
+                if retry is None:
+                    self.stats['sent'] += 1
+                    # We're back online, so the spool is out of date.
+                    if self.stats['spooled']:
+                        self._save_spool()
+                elif retry==0:
+                    self.stats['failed'] += 1
+                else:
+                    # Put it back at the front and spool everything while we're offline.
+                    self.queue.appendleft(event)
+                    self.retry_time = time.time() + retry
+                    self._save_spool()
+
+    def _load_spool(self):
+        if not self.spool_file:
+            return
+        try:
+            with open(self.spool_file) as f:
+                self.queue.extend(json.load(f)[-self.queue_size:])
+            self.stats['spooled'] = len(self.queue)
+        except:
+            pass
+
+    def _save_spool(self):
+        if not self.spool_file:
+            return
+        try:
+            if not self.queue:
+                if os.path.exists(self.spool_file):
+                    os.remove(self.spool_file)
+                self.stats['spooled'] = 0
+                return
+            events = list(self.queue)
+            filename = self.spool_file + ".tmp"
+            with open(filename, 'w') as f:
+                json.dump(events, f)
+            os.replace(filename, self.spool_file)
+            self.stats['spooled'] = len(events)
+        except Exception as e:
+            print('Unable to save IFTTT spool: ', e)
+
+    def pending(self):
+        with self.cond:
+            return len(self.queue)
+
+    def close(self):
+        with self.cond:
+            self.run_thread = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(TIMEOUT)
+        # Keep unsent events for next time.
+        with self.cond:
+            self._save_spool()
+        self.session.close()
+
+
+class IFTTT_Wrapper:
+    def __init__(self, key, spool_dir=None, url_base=IFTTT_URL_BASE):
+        self.key = key if key else ''
+        self.url_base = url_base
+        self.client = IFTTTClient(key, spool_dir, url_base)
+
+    def ping_event(self, event_name, event_type, data):
+        # Returns right away -- the event is sent in the background.
+        self.client.send(event_name, data, event_type=='json')
+
+    def build_url(self, event_name, event_type, data):
+        return self.client.build_url(event_name, event_type=='json')
+
+    def close(self):
+        self.client.close()
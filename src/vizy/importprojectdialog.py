@@ -1,9 +1,11 @@
 import os
+import shutil
 import kritter
 import base64
 import json
 import time 
 import gdown
+from .projectarchive import extract_archive, transfer
 
 IMPORT_FILE = "import.zip"
 
@@ -71,24 +73,33 @@ class ImportProjectDialog(kritter.Kdialog):
     def _update_status(self, percent):
         self.kapp.push_mods(self.status.out_value(f"Downloading {self.project_name} project ({percent}%)..."))
 
+    def _update_unzip_status(self, percent, name):
+        self.kapp.push_mods(self.status.out_value(f"Unzipping project files ({percent}%)..."))
+
     def _import(self):
+        new_project_dir = os.path.join(self.project_dir, self.project_name)
         try:
-            new_project_dir = os.path.join(self.project_dir, self.project_name)
+            # Fails if the project exists (e.g. another client imported it
+            # in the meantime) -- we only clean up a directory we created.
             os.makedirs(new_project_dir)
+        except OSError as e:
+            print("Unable to import project.", e)
+            self.kapp.push_mods(self.status.out_value(f'Unable to import project. ({e})'))
+            return []
+        try:
             import_file = os.path.join(new_project_dir, IMPORT_FILE) 
             # Use gdown code to download if we don't have Google Drive credentials
             if self.gdrive is None:
                 self.kapp.push_mods(self.status.out_value(f"Downloading {self.project_name} project..."))
                 gdown.download(id=self.key, output=import_file)
             else: # Otherwise use Google credentials, which gives us a some feedback.
-                self.gdrive.download(self.key, import_file, self._update_status)
+                transfer(self.gdrive.download, self.key, import_file, self._update_status)
             self.kapp.push_mods(self.status.out_value("Unzipping project files..."))
-            os.chdir(new_project_dir)
-            os.system(f"unzip {IMPORT_FILE}")
+            extract_archive(import_file, new_project_dir, self._update_unzip_status)
             os.remove(import_file)
         except Exception as e:
             print("Unable to import project.", e)
-            os.rmdir(new_project_dir)
+            shutil.rmtree(new_project_dir, ignore_errors=True)
             self.kapp.push_mods(self.status.out_value(f'Unable to import project. ({e})'))
             return []
         self.kapp.push_mods(self.status.out_value("Done!")) 
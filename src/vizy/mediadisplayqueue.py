@@ -3,17 +3,19 @@ import kritter
 import dash_html_components as html
 from dash_devices.dependencies import Output
 from functools import wraps
+from .metadatastore import load_metadata_many
 
 
 class MediaDisplayQueue:
-    def __init__(self, media_dir, display_width, media_width, media_display_width=300, num_media=25, font_size=12, disp=True, kapp=None):
+    def __init__(self, media_dir, display_width, media_width, media_display_width=300, num_media=25, font_size=12, disp=True, kapp=None, stage=None):
         self.display_width = display_width
         self.media_width = media_width
         self.media_display_width = media_display_width
         self.num_media = num_media
         self.font_size = font_size
         self.kapp = kritter.Kritter.kapp if kapp is None else kapp
-        self.set_media_dir(media_dir)
+        self.stage = None
+        self.set_media_dir(media_dir, stage)
         self.dialog_image = kritter.Kimage(overlay=True, service=None)
         self.image_dialog = kritter.Kdialog(title="", layout=[self.dialog_image], size="xl")
         self.dialog_video = kritter.Kvideo(src="")
@@ -75,22 +77,24 @@ class MediaDisplayQueue:
         return kimage.overlay.out_draw()
 
     def get_images_and_data(self):
-        images = os.listdir(self.media_dir)
+        # Include media that's staged (see MediaStage) but not written yet.
+        images = self.stage.listdir() if self.stage else os.listdir(self.media_dir)
         images = [i for i in images if i.endswith(".jpg") or i.endswith(".mp4")]
         images.sort(reverse=True)
+        images = images[:self.num_media]
 
-        images_and_data = []
-        for image in images:
-            data = kritter.load_metadata(os.path.join(self.media_dir, image))
-            images_and_data.append((image, data))
-            if len(images_and_data)==self.num_media:
-                break
-        return images_and_data
+        if self.stage:
+            return [(image, self.stage.load_metadata(image)) for image in images]
+        data = load_metadata_many(self.media_dir, images)
+        return [(image, data[image]) for image in images]
 
-    def set_media_dir(self, media_dir):
+    def set_media_dir(self, media_dir, stage=None):
         if media_dir:
             self.media_dir = media_dir
             self.kapp.media_path.insert(0, self.media_dir)
+            self.stage = stage
+            if stage and stage.stage_dir:
+                self.kapp.media_path.insert(0, stage.stage_dir)
 
     def dialog_image_callback(self, state=()):
         def wrap_func(func):
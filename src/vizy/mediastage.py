@@ -0,0 +1,342 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import cv2
+import time
+import json
+import shutil
+import kritter
+from threading import Thread, Lock
+from .metadatastore import get_store, load_metadata, save_metadata, remove_metadata
+
+# Staged files live in RAM (tmpfs) until they're flushed to the media directory.
+STAGE_ROOT = "/dev/shm/vizy_stage"
+JOURNAL_FILE = "journal"
+# Flush when the staged files add up to MAX_BYTES or the oldest is MAX_AGE old.
+MAX_BYTES = 8*1024*1024
+MAX_AGE = 60 # seconds
+POLL_PERIOD = 1 # seconds
+MEDIA_EXTENSIONS = (".jpg", ".mp4")
+
+
+class MediaStage:
+    """
+    Stages media files (images and their metadata) in tmpfs and writes them
+    to the media directory in batches, which keeps writes off the frame path
+    and reduces SD card wear:
+
+    - Metadata written again before a flush (e.g. an updated pick) replaces
+      the staged copy, so it only hits flash once.
+    - Files removed before a flush, or pruned because there are more than
+      `keep` of them, never hit flash at all.
+    - Each staged file is recorded in a journal after it's completely
+      written.  If the app crashes, journaled files are flushed the next
+      time the stage is opened, and partially written files are discarded.
+      (Staged files don't survive a power loss -- at most MAX_AGE seconds
+      of media is lost.)
+
+    Staged files can be served and listed along with the flushed ones --
+    add stage_dir to kapp.media_path and use listdir() and load_metadata().
+    If tmpfs isn't available (or enable is False), files are written straight
+    to media_dir.
+    """
+    def __init__(self, media_dir, keep=None, stage_dir=None, max_bytes=MAX_BYTES, max_age=MAX_AGE, enable=True):
+        self.media_dir = media_dir
+        self.keep = keep
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if stage_dir is None and os.path.isdir(os.path.dirname(STAGE_ROOT)):
+            stage_dir = os.path.join(STAGE_ROOT, os.path.abspath(media_dir).strip("/").replace("/", "_"))
+        self.stage_dir = stage_dir if enable else None
+        os.makedirs(media_dir, exist_ok=True)
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        # name: {time, files, size, version} of each staged media file
+        self.staged = {}
+        self.stats_ = dict(staged=0, flushed=0, dropped=0, merged=0, failed=0, flushes=0, bytes_written=0, bytes_avoided=0)
+        self.t0 = time.time()
+        if self.stage_dir:
+            os.makedirs(self.stage_dir, exist_ok=True)
+            self.journal_file = os.path.join(self.stage_dir, JOURNAL_FILE)
+            self._recover()
+            self.run_thread = True
+            self.thread = Thread(target=self.flush_thread, daemon=True)
+            self.thread.start()
+        else:
+            self.thread = None
+
+    def _journal(self, entry):
+        with open(self.journal_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def _recover(self):
+        # Journaled files from a previous run that weren't flushed.
+        staged = {}
+        try:
+            with open(self.journal_file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break # partially written entry
+                    if entry['op']=="stage":
+                        staged.setdefault(entry['name'], dict(time=entry['time'], files=[], size=0, version=0))['files'].append(entry['file'])
+                    elif entry['op']=="remove":
+                        staged.pop(entry['name'], None)
+        except OSError:
+            pass
+        for s in staged.values():
+            s['files'] = [f for f in set(s['files']) if os.path.exists(os.path.join(self.stage_dir, f))]
+            s['size'] = self._size(s['files'])
+        # Anything else is left over from an interrupted write.
+        keep = set([JOURNAL_FILE] + [f for s in staged.values() for f in s['files']])
+        for f in os.listdir(self.stage_dir):
+            if f not in keep:
+                os.remove(os.path.join(self.stage_dir, f))
+        self.staged = staged
+        if staged:
+            print(f"Recovering {len(staged)} staged files for {self.media_dir}")
+            self.flush()
+        elif os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+    def _size(self, files):
+        return sum([os.path.getsize(os.path.join(self.stage_dir, f)) for f in files])
+
+    def _stage(self, name, filename, write):
+        # Write to a temp file, then rename and journal, so a crash can't leave
+        # a partial file in the stage.
+        path = os.path.join(self.stage_dir, filename)
+        write(path + ".tmp")
+        os.rename(path + ".tmp", path)
+        with self.lock:
+            entry = self.staged.get(name)
+            if entry is None:
+                entry = self.staged[name] = dict(time=time.time(), files=[], size=0, version=0)
+                self.stats_['staged'] += 1
+            elif filename in entry['files']:
+                # Rewritten before it was flushed
+                self.stats_['merged'] += 1
+            if filename not in entry['files']:
+                entry['files'].append(filename)
+            entry['size'] = self._size(entry['files'])
+            entry['version'] += 1
+            self._journal({"op": "stage", "name": name, "file": filename, "time": entry['time']})
+            self._prune_staged()
+
+    def _prune_staged(self):
+        # Drop the oldest staged media if there are more than we keep anyway.
+        if self.keep is None:
+            return
+        names = sorted([n for n in self.staged if n.endswith(MEDIA_EXTENSIONS)])
+        for name in names[:max(len(names)-self.keep, 0)]:
+            self._drop(name)
+
+    def _drop(self, name):
+        entry = self.staged.pop(name)
+        for f in entry['files']:
+            try:
+                os.remove(os.path.join(self.stage_dir, f))
+            except OSError:
+                pass
+        self._journal({"op": "remove", "name": name})
+        self.stats_['dropped'] += 1
+        self.stats_['bytes_avoided'] += entry['size']
+
+    def store_image_array(self, image, filename=None, data=None):
+        """
+        Encodes image as JPEG and stages it (and data as its metadata, if
+        given).  Returns the filename, which is time-stamped if not given.
+        """
+        if filename is None:
+            filename = kritter.time_stamped_file("jpg")
+        if not self.stage_dir:
+            path = os.path.join(self.media_dir, filename)
+            cv2.imwrite(path, image)
+            if data is not None:
+                save_metadata(path, data)
+            return filename
+        # Encode before writing so imwrite's extension check isn't fooled by .tmp
+        res, jpg = cv2.imencode(".jpg", image)
+        def write(path):
+            with open(path, "wb") as f:
+                f.write(jpg.tobytes())
+        self._stage(filename, filename, write)
+        if data is not None:
+            self.save_metadata(filename, data)
+        return filename
+
+    def save_metadata(self, filename, data):
+        """
+        Saves metadata for filename (a media file in the stage or media_dir).
+        """
+        filename = os.path.basename(filename)
+        with self.lock:
+            staged = filename in self.staged
+        if not staged:
+            save_metadata(os.path.join(self.media_dir, filename), data)
+            return
+        meta_filename = os.path.basename(kritter.get_metadata_filename(os.path.join(self.stage_dir, filename)))
+        def write(path):
+            # save_metadata() works out the metadata filename from the media filename.
+            tmp = os.path.join(self.stage_dir, filename + ".tmp")
+            kritter.save_metadata(tmp, data)
+            os.rename(kritter.get_metadata_filename(tmp), path)
+        self._stage(filename, meta_filename, write)
+
+    def load_metadata(self, filename):
+        try:
+            return load_metadata(self.path(filename))
+        except OSError:
+            # It may have been flushed in the meantime.
+            return load_metadata(os.path.join(self.media_dir, os.path.basename(filename)))
+
+    def path(self, filename):
+        """
+        Returns the full path of filename, wherever it is right now.
+        """
+        filename = os.path.basename(filename)
+        with self.lock:
+            if filename in self.staged:
+                return os.path.join(self.stage_dir, filename)
+        return os.path.join(self.media_dir, filename)
+
+    def listdir(self):
+        """
+        Returns the names of the media files in media_dir and the stage.
+        """
+        with self.lock:
+            staged = list(self.staged.keys())
+        return list(set(os.listdir(self.media_dir) + staged))
+
+    def remove(self, filename):
+        filename = os.path.basename(filename)
+        with self.lock:
+            if filename in self.staged:
+                self._drop(filename)
+                return
+        path = os.path.join(self.media_dir, filename)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        remove_metadata(path)
+
+    def _copy(self, src, dest):
+        tmp = dest + ".tmp"
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdest:
+            shutil.copyfileobj(fsrc, fdest)
+            fdest.flush()
+            os.fsync(fdest.fileno())
+        os.replace(tmp, dest)
+
+    def flush(self):
+        """
+        Writes all staged files to media_dir.
+        """
+        if not self.stage_dir:
+            return
+        with self.flush_lock:
+            with self.lock:
+                staged = [(name, list(s['files']), s['version']) for name, s in self.staged.items()]
+            written = failed = 0
+            copied = []
+            for name, files, version in staged:
+                try:
+                    for f in files:
+                        self._copy(os.path.join(self.stage_dir, f), os.path.join(self.media_dir, f))
+                        written += os.path.getsize(os.path.join(self.media_dir, f))
+                    copied.append((name, files, version))
+                except OSError as e:
+                    # Leave it staged (and journaled) and try again next flush.
+                    print(f"Unable to flush {name}: {e}")
+                    failed += 1
+            with self.lock:
+                for name, files, version in copied:
+                    entry = self.staged.get(name)
+                    # Leave it staged if it was rewritten (or removed) while we were flushing.
+                    if entry and entry['version']==version:
+                        for f in entry['files']:
+                            os.remove(os.path.join(self.stage_dir, f))
+                        del self.staged[name]
+                        self.stats_['flushed'] += 1
+                self.stats_['flushes'] += 1
+                self.stats_['failed'] += failed
+                self.stats_['bytes_written'] += written
+                # Start a new journal with whatever's still staged.
+                with open(self.journal_file + ".tmp", "w") as f:
+                    for name, s in self.staged.items():
+                        for file in s['files']:
+                            f.write(json.dumps({"op": "stage", "name": name, "file": file, "time": s['time']}) + "\n")
+                os.replace(self.journal_file + ".tmp", self.journal_file)
+            # If media_dir has a metadata store, the sidecars we just wrote go into it.
+            store = get_store(self.media_dir)
+            if store:
+                store.migrate([name for name, files, version in copied])
+            self._prune()
+
+    def _prune(self):
+        # Keep the newest `keep` media files in media_dir.
+        if self.keep is None:
+            return
+        names = sorted([n for n in os.listdir(self.media_dir) if n.endswith(MEDIA_EXTENSIONS)], reverse=True)
+        for name in names[self.keep:]:
+            path = os.path.join(self.media_dir, name)
+            files = [path, path + "_"]
+            try:
+                files.append(os.path.join(self.media_dir, load_metadata(path)['thumbnail']))
+            except:
+                pass
+            for f in files:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+            remove_metadata(path)
+
+    def flush_thread(self):
+        while self.run_thread:
+            time.sleep(POLL_PERIOD)
+            with self.lock:
+                if not self.staged:
+                    continue
+                t = min([s['time'] for s in self.staged.values()])
+                size = sum([s['size'] for s in self.staged.values()])
+            if size>=self.max_bytes or time.time()-t>=self.max_age:
+                self.flush()
+
+    def stats(self):
+        """
+        Returns dict with the number of files staged, flushed, dropped
+        (never written to flash), merged (rewritten while staged) and failed
+        (flush attempts that couldn't be written), and the bytes written to
+        flash (total and per hour).
+        """
+        with self.lock:
+            stats = dict(self.stats_)
+            stats['pending'] = len(self.staged)
+        hours = max(time.time()-self.t0, 1)/3600
+        stats['bytes_per_hour'] = stats['bytes_written']/hours
+        return stats
+
+    def summary(self):
+        """
+        Returns a line of text with the storage stats, for the apps'
+        "storage" text command.
+        """
+        s = self.stats()
+        return f"{s['bytes_per_hour']/1024:.0f} KB/hour written to flash, {s['flushed']} written, {s['dropped']} never written, {s['merged']} merged, {s['failed']} failed, {s['pending']} pending"
+
+    def close(self):
+        if self.thread:
+            self.run_thread = False
+            self.thread.join()
+        self.flush()
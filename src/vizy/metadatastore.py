@@ -0,0 +1,262 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import json
+import sqlite3
+import kritter
+from contextlib import contextmanager
+from threading import Lock, RLock
+
+# The store's database lives in the directory it describes, so it moves (and
+# is exported) along with the media.
+DB_FILE = ".metadata.db"
+MEDIA_EXTENSIONS = (".jpg", ".jpeg", ".png", ".mp4")
+
+
+class MetadataStore:
+    """
+    Metadata for the media files in a directory, kept in a single SQLite
+    database instead of a sidecar file per media file.  Entries are keyed by
+    the media file's name and hold the same dicts kritter.save_metadata()
+    writes:
+
+        store = MetadataStore(training_dir)
+        data = store.get("2023_01_01_12_00_00.jpg")
+        all_data = store.get_many()
+        store.update({name: data, ...})    # one transaction
+        store.modify(names, func)          # read-modify-write, one transaction
+
+    Sidecar files already in the directory (from older versions, imports,
+    or code that still calls kritter.save_metadata()) are migrated into the
+    store and removed when it's opened, and by migrate().  Use open_store()
+    to get the (shared) store for a directory, and the module's
+    load_metadata()/save_metadata()/remove_metadata() in place of kritter's --
+    they use the store if the directory has one, and sidecars if it doesn't.
+    """
+    def __init__(self, directory, migrate=True):
+        self.directory = directory
+        self.filename = os.path.join(directory, DB_FILE)
+        self.lock = RLock()
+        # We begin and commit transactions ourselves (isolation_level=None).
+        self.db = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        if migrate:
+            self.migrate()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def get(self, filename, default=None):
+        """
+        Returns the metadata for filename (a media file name or path), or
+        default if there isn't any.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT data FROM metadata WHERE name=?", (os.path.basename(filename),)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def get_many(self, filenames=None):
+        """
+        Returns dict of name: metadata for filenames, or for all entries if
+        filenames is None.  Files without metadata are left out.
+        """
+        with self.lock:
+            if filenames is None:
+                rows = self.db.execute("SELECT name, data FROM metadata").fetchall()
+            else:
+                names = [os.path.basename(f) for f in filenames]
+                rows = []
+                # Stay under SQLite's limit on the number of parameters.
+                for i in range(0, len(names), 500):
+                    chunk = names[i:i+500]
+                    rows += self.db.execute(f"SELECT name, data FROM metadata WHERE name IN ({','.join('?'*len(chunk))})", chunk).fetchall()
+        return {name: json.loads(data) for name, data in rows}
+
+    def put(self, filename, data):
+        self.update({filename: data})
+
+    def update(self, items):
+        """
+        Sets the metadata for each filename: data in items, in one
+        transaction.
+        """
+        rows = [(os.path.basename(f), json.dumps(data)) for f, data in items.items()]
+        with self.transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO metadata (name, data) VALUES (?, ?)", rows)
+
+    def modify(self, filenames, func):
+        """
+        Calls func(name, data) for each of filenames (data is {} if there's
+        no metadata yet) and saves what it returns, all in one transaction.
+        If func returns None, the entry is left alone.
+        """
+        with self.transaction() as db:
+            current = self.get_many(filenames)
+            rows = []
+            for f in filenames:
+                name = os.path.basename(f)
+                data = func(name, current.get(name, {}))
+                if data is not None:
+                    rows.append((name, json.dumps(data)))
+            db.executemany("INSERT OR REPLACE INTO metadata (name, data) VALUES (?, ?)", rows)
+        return len(rows)
+
+    def remove(self, filenames):
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        with self.transaction() as db:
+            db.executemany("DELETE FROM metadata WHERE name=?", [(os.path.basename(f),) for f in filenames])
+
+    def names(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT name FROM metadata")]
+
+    def migrate(self, filenames=None):
+        """
+        Moves sidecar files into the store -- for filenames, or for all the
+        media files in the directory if filenames is None, in which case
+        entries for media files that no longer exist are also dropped.
+        Returns the number of sidecars migrated.
+        """
+        listing = set(os.listdir(self.directory))
+        if filenames is None:
+            media = [f for f in listing if f.lower().endswith(MEDIA_EXTENSIONS)]
+        else:
+            media = [os.path.basename(f) for f in filenames]
+        items = {}
+        sidecars = []
+        for name in media:
+            sidecar = kritter.get_metadata_filename(os.path.join(self.directory, name))
+            if os.path.basename(sidecar) in listing:
+                try:
+                    with open(sidecar) as f:
+                        items[name] = json.load(f)
+                    sidecars.append(sidecar)
+                except (OSError, ValueError) as e:
+                    print(f"Unable to migrate {sidecar}: {e}")
+        with self.transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO metadata (name, data) VALUES (?, ?)", [(name, json.dumps(data)) for name, data in items.items()])
+            if filenames is None:
+                stale = [name for name in self.names() if name not in listing]
+                db.executemany("DELETE FROM metadata WHERE name=?", [(name,) for name in stale])
+        # Only remove the sidecars once they're safely in the store.
+        for sidecar in sidecars:
+            try:
+                os.remove(sidecar)
+            except OSError:
+                pass
+        if sidecars and filenames is None:
+            print(f"Migrated {len(sidecars)} metadata files in {self.directory}")
+        return len(sidecars)
+
+    def export_sidecars(self, dest_dir, filenames=None):
+        """
+        Writes sidecar files for filenames (or all entries) to dest_dir, for
+        tools that expect them (e.g. the training notebook).
+        """
+        for name, data in self.get_many(filenames).items():
+            kritter.save_metadata(os.path.join(dest_dir, name), data)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+_stores = {}
+_stores_lock = Lock()
+
+def open_store(directory):
+    """
+    Returns the store for directory, creating it if necessary, and migrates
+    any sidecar files in the directory (e.g. from an imported project).
+    """
+    key = os.path.realpath(directory)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store and not os.path.exists(store.filename):
+            # The directory was removed or replaced.
+            store.close()
+            store = None
+        if store is None:
+            store = _stores[key] = MetadataStore(directory)
+        else:
+            store.migrate()
+        return store
+
+def get_store(directory):
+    """
+    Returns the store for directory, or None if the directory doesn't have
+    one (i.e. it still uses sidecar files).
+    """
+    store = _stores.get(os.path.realpath(directory))
+    if store and os.path.exists(store.filename):
+        return store
+    if os.path.exists(os.path.join(directory, DB_FILE)):
+        return open_store(directory)
+    return None
+
+def _pending_sidecar(store, filename):
+    # Something wrote a sidecar (e.g. kritter itself) -- pull it in.
+    if os.path.exists(kritter.get_metadata_filename(filename)):
+        store.migrate([filename])
+
+def load_metadata(filename):
+    """
+    Same as kritter.load_metadata(), but uses the directory's store if it
+    has one.
+    """
+    store = get_store(os.path.dirname(filename) or ".")
+    if store is None:
+        return kritter.load_metadata(filename)
+    _pending_sidecar(store, filename)
+    return store.get(filename, {})
+
+def load_metadata_many(directory, filenames):
+    """
+    Returns dict of name: metadata for filenames in directory, with one
+    query if directory has a store.
+    """
+    store = get_store(directory)
+    if store is None:
+        return {os.path.basename(f): kritter.load_metadata(os.path.join(directory, os.path.basename(f))) for f in filenames}
+    res = store.get_many(filenames)
+    return {os.path.basename(f): res.get(os.path.basename(f), {}) for f in filenames}
+
+def save_metadata(filename, data):
+    """
+    Same as kritter.save_metadata(), but uses the directory's store if it
+    has one.
+    """
+    store = get_store(os.path.dirname(filename) or ".")
+    if store is None:
+        kritter.save_metadata(filename, data)
+    else:
+        store.put(filename, data)
+
+def remove_metadata(filename):
+    """
+    Removes filename's metadata (sidecar file or store entry).
+    """
+    try:
+        os.remove(kritter.get_metadata_filename(filename))
+    except OSError:
+        pass
+    store = get_store(os.path.dirname(filename) or ".")
+    if store:
+        store.remove(filename)
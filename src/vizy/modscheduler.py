@@ -0,0 +1,178 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import json
+import time
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+from plotly.utils import PlotlyJSONEncoder
+from kritter import Kritter
+
+# Send at most this many batches of mods per second.
+FLUSH_RATE = 30
+# Values that haven't changed are still sent this often, so browsers that
+# connect later (or missed a value) catch up.
+RESEND_PERIOD = 5 # seconds
+
+
+def _fingerprint(value):
+    # Same encoding Dash uses to send the value, so equal fingerprints mean
+    # the browser would receive the same thing.  This also catches values
+    # (e.g. overlay figures) that are modified in place.
+    try:
+        return json.dumps(value, cls=PlotlyJSONEncoder, sort_keys=True)
+    except:
+        return None
+
+
+class ModScheduler:
+    """
+    Coalesces mods that are pushed at frame rate before they're sent to the
+    browsers:
+
+    - Mods for the same output (id and property) pushed within a flush
+      period are merged -- only the last value is sent.
+    - Mods whose value is the same as the last value sent for that output
+      are dropped (they're resent every resend_period seconds).
+    - Batches are sent at most rate times per second.
+
+    Use push() in place of kapp.push_mods() on the frame path.  Only the
+    values sent through the scheduler are known to it, so when an output
+    that's also pushed through the scheduler is set elsewhere (e.g. by a
+    callback's return), pass the mods through invalidate():
+
+        return self.mod_scheduler.invalidate(self.video.overlay.out_draw())
+
+    Otherwise the scheduler could drop the next frame's value as unchanged,
+    and the browser would keep the callback's value for up to resend_period
+    seconds.
+    """
+    def __init__(self, kapp=None, rate=FLUSH_RATE, resend_period=RESEND_PERIOD):
+        self.kapp = Kritter.kapp if kapp is None else kapp
+        self.period = 1/rate
+        self.resend_period = resend_period
+        self.cond = Condition()
+        self.flush_lock = Lock()
+        self.pending = OrderedDict()
+        self.sent = {}
+        self.count = 0
+        self.last_flush = 0
+        self.stats_ = dict(pushed=0, merged=0, unchanged=0, sent=0, flushes=0)
+        self.running = True
+        self.thread = Thread(target=self.flush_thread, daemon=True)
+        self.thread.start()
+
+        # A new browser needs the current values, not just the changes.
+        @self.kapp.callback_connect
+        def func(client, connect):
+            if connect:
+                self.reset()
+
+    def push(self, mods):
+        if not isinstance(mods, (list, tuple)):
+            mods = [mods]
+        if not mods:
+            return
+        with self.cond:
+            for m in mods:
+                try:
+                    key = m.component_id, m.component_property
+                except AttributeError:
+                    # Not an Output, send as is.
+                    key = self.count
+                    self.count += 1
+                if key in self.pending:
+                    # Move to the end, so outputs are sent in the order of their last update.
+                    del self.pending[key]
+                    self.stats_['merged'] += 1
+                self.pending[key] = m
+                self.stats_['pushed'] += 1
+            self.cond.notify()
+
+    def flush(self):
+        """
+        Sends pending mods now.
+        """
+        with self.flush_lock:
+            with self.cond:
+                pending = self.pending
+                self.pending = OrderedDict()
+                self.last_flush = time.time()
+            if not pending:
+                return
+            t = time.time()
+            mods = []
+            unchanged = 0
+            for key, m in pending.items():
+                if isinstance(key, tuple):
+                    fingerprint = _fingerprint(m.value)
+                    sent = self.sent.get(key)
+                    if fingerprint is not None and sent and sent[0]==fingerprint and t-sent[1]<self.resend_period:
+                        unchanged += 1
+                        continue
+                    self.sent[key] = fingerprint, t
+                mods.append(m)
+            if mods:
+                self.kapp.push_mods(mods)
+            with self.cond:
+                self.stats_['unchanged'] += unchanged
+                self.stats_['sent'] += len(mods)
+                self.stats_['flushes'] += 1 if mods else 0
+
+    def flush_thread(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                wait = self.last_flush + self.period - time.time()
+            if wait>0:
+                time.sleep(wait)
+            self.flush()
+
+    def invalidate(self, mods):
+        """
+        Forgets the values sent for the outputs in mods, because they're
+        being set outside of the scheduler.  Returns mods.
+        """
+        if not isinstance(mods, (list, tuple)):
+            mods = [mods]
+        with self.flush_lock:
+            for m in mods:
+                try:
+                    self.sent.pop((m.component_id, m.component_property), None)
+                except AttributeError:
+                    pass
+        return mods
+
+    def reset(self):
+        """
+        Forgets the values sent, so the next mods for each output are sent
+        regardless.
+        """
+        with self.flush_lock:
+            self.sent = {}
+
+    def stats(self):
+        """
+        Returns dict with the number of mods pushed, merged (replaced by a
+        later mod for the same output), unchanged (dropped because the value
+        was already sent) and sent, and the number of batches sent.
+        """
+        with self.cond:
+            return dict(self.stats_)
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        self.flush()
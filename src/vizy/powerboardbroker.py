@@ -0,0 +1,239 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import grp
+import json
+import socket
+import datetime
+import queue
+import threading
+from .vizypowerboard import VizyPowerBoard, EVENT_BUTTON, EVENT_IO, EVENT_POWER_OFF, EVENT_QUEUE_SIZE
+
+BROKER_SOCKET = "/run/vizy_power_board.sock"
+# Users in this group can access the power board directly (over I2C), so they
+# can use the broker.
+BROKER_GROUP = "i2c"
+# Reads from different clients within this window share one I2C transfer.
+COALESCE_TTL = 0.02 # seconds
+# Methods that only affect the caller's own object aren't forwarded.
+LOCAL_METHODS = ["snapshot", "invalidate", "subscribe", "unsubscribe"]
+
+
+def _encode(obj):
+    if isinstance(obj, datetime.datetime):
+        return {"__datetime__": obj.isoformat()}
+    raise TypeError(f"{type(obj)} is not serializable")
+
+def _decode(obj):
+    if "__datetime__" in obj:
+        return datetime.datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+def _send(sock, msg):
+    sock.sendall((json.dumps(msg, default=_encode)+'\n').encode())
+
+def _lines(sock):
+    buf = b''
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            return
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            yield json.loads(line, object_hook=_decode)
+
+
+class PowerBoardBroker:
+    """
+    Owns the Vizy Power Board's I2C bus and serves VizyPowerBoard method calls
+    to other processes (see VizyPowerBoardProxy) over a Unix socket.  Calls
+    are serialized so clients never contend for the firmware semaphore, and
+    register reads are coalesced through the power board's snapshot mode.
+    Button, IO and power-off events are published to subscribed clients.
+    """
+    def __init__(self, power_board=None, path=BROKER_SOCKET, group=BROKER_GROUP):
+        if power_board is None:
+            power_board = VizyPowerBoard()
+        self.power_board = power_board
+        self.power_board.snapshot(COALESCE_TTL)
+        self.path = path
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.methods = [m for m in dir(VizyPowerBoard) if not m.startswith('_') and m not in LOCAL_METHODS and callable(getattr(VizyPowerBoard, m))]
+        try:
+            os.remove(path)
+        except:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        # Only root and members of group can connect.
+        os.chmod(path, 0o660)
+        try:
+            os.chown(path, -1, grp.getgrnam(group).gr_gid)
+        except KeyError:
+            print(f"Group {group} doesn't exist, only root can use the power board broker")
+        self.server.listen()
+        self.run_thread = True
+        self.thread = threading.Thread(target=self.accept_thread, daemon=True)
+        self.thread.start()
+        self.subscribed = False
+
+    def accept_thread(self):
+        while self.run_thread:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.client_thread, args=(conn,), daemon=True).start()
+
+    def client_thread(self, conn):
+        try:
+            for msg in _lines(conn):
+                if "call" in msg:
+                    _send(conn, self.call(msg['call'], msg.get('args', []), msg.get('kwargs', {})))
+                elif "attr" in msg:
+                    val = getattr(self.power_board, msg['attr'], self)
+                    if msg['attr'].startswith('_') or not isinstance(val, (bool, int, float, str, list, type(None))):
+                        _send(conn, {"error": f"{msg['attr']} is not available"})
+                    else:
+                        _send(conn, {"result": val})
+                elif "describe" in msg:
+                    _send(conn, {"result": self.methods})
+                elif "subscribe" in msg:
+                    with self.lock:
+                        self.subscribers.append(conn)
+                        if not self.subscribed:
+                            self.power_board.subscribe(self.publish, [EVENT_BUTTON, EVENT_IO, EVENT_POWER_OFF])
+                            self.subscribed = True
+                    # Connection is now used for events only.
+                    return
+        except Exception as e:
+            print("Power board broker client error:", e)
+        conn.close()
+
+    def call(self, name, args, kwargs):
+        if name not in self.methods:
+            return {"error": f"{name} is not a VizyPowerBoard method"}
+        try:
+            with self.lock:
+                return {"result": getattr(self.power_board, name)(*args, **kwargs)}
+        except Exception as e:
+            return {"error": str(e)}
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = self.subscribers[:]
+        for s in subscribers:
+            try:
+                _send(s, {"event": event})
+            except:
+                with self.lock:
+                    self.subscribers.remove(s)
+                s.close()
+
+    def close(self):
+        self.run_thread = False
+        self.power_board.unsubscribe(self.publish)
+        self.server.close()
+        with self.lock:
+            for s in self.subscribers:
+                s.close()
+            self.subscribers = []
+        try:
+            os.remove(self.path)
+        except:
+            pass
+
+
+class VizyPowerBoardProxy:
+    """
+    Drop-in replacement for VizyPowerBoard that forwards method calls to a
+    PowerBoardBroker running in another process.  Button, IO and power-off
+    events published by the broker are received through subscribe().
+    """
+    def __init__(self, path=BROKER_SOCKET):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lines = _lines(self.sock)
+        self.methods = self._request({"describe": True})
+        self.subscribers = []
+        self.event_sock = None
+
+    def _request(self, msg):
+        with self.lock:
+            _send(self.sock, msg)
+            res = next(self.lines)
+        if "error" in res:
+            raise RuntimeError(res['error'])
+        return res['result']
+
+    def __getattr__(self, name):
+        if name.startswith('_') or 'methods' not in self.__dict__:
+            raise AttributeError(name)
+        # Non-method attributes such as "connected" are fetched by value. 
+        if name not in self.methods:
+            try:
+                return self._request({"attr": name})
+            except RuntimeError:
+                raise AttributeError(name)
+        def method(*args, **kwargs):
+            return self._request({"call": name, "args": args, "kwargs": kwargs})
+        return method
+
+    def snapshot(self, ttl=None):
+        # The broker already coalesces reads across clients.
+        pass
+
+    def invalidate(self):
+        pass
+
+    def subscribe(self, callback=None, types=None, period=None):
+        """
+        Same as VizyPowerBoard.subscribe(), except events are published by the
+        broker (period is determined by the broker).
+        """
+        if types is None:
+            types = [EVENT_BUTTON, EVENT_IO]
+        subscriber = callback if callback else queue.Queue(EVENT_QUEUE_SIZE)
+        self.subscribers.append((subscriber, types))
+        if self.event_sock is None:
+            self.event_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.event_sock.connect(self.path)
+            _send(self.event_sock, {"subscribe": True})
+            threading.Thread(target=self.event_thread, daemon=True).start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers = [s for s in self.subscribers if s[0]!=subscriber]
+
+    def event_thread(self):
+        try:
+            for msg in _lines(self.event_sock):
+                event = msg['event']
+                for subscriber, types in self.subscribers:
+                    if event['type'] not in types:
+                        continue
+                    if isinstance(subscriber, queue.Queue):
+                        if subscriber.full():
+                            subscriber.get_nowait()
+                        subscriber.put_nowait(event)
+                    else:
+                        subscriber(event)
+        except OSError:
+            pass
+
+    def close(self):
+        self.sock.close()
+        if self.event_sock:
+            self.event_sock.close()
@@ -0,0 +1,217 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import glob
+import time
+import json
+from bisect import bisect_left
+from functools import wraps
+from threading import Thread, Lock
+
+# Upper edges of the histogram buckets (seconds).  The last bucket catches
+# everything longer.
+BUCKETS = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+# Each process's profile is written here (with its pid) so VizyVisor can
+# display it.
+PROFILE_FILE = "/dev/shm/vizy_profile_{pid}.json"
+WRITE_PERIOD = 2 # seconds
+# Set VIZY_PROFILE=0 to turn profiling off.
+ENABLED = os.getenv("VIZY_PROFILE", "1")!="0"
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram.  Adding a sample is a bisect and a few
+    additions, so it's cheap enough to run on every frame.
+    """
+    def __init__(self):
+        self.counts = [0]*(len(BUCKETS)+1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, t):
+        self.counts[bisect_left(BUCKETS, t)] += 1
+        self.count += 1
+        self.total += t
+        if t>self.max:
+            self.max = t
+
+    def percentile(self, p):
+        # Upper edge of the bucket that contains the pth percentile
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n>=self.count*p/100:
+                return BUCKETS[i] if i<len(BUCKETS) else self.max
+        return 0
+
+    def to_dict(self):
+        return {"count": self.count, "avg": self.total/self.count if self.count else 0, "max": self.max,
+            "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99), "counts": self.counts}
+
+
+class Profiler:
+    """
+    Records per-stage latency into histograms:
+
+        profiler = Profiler()
+        with profiler.stage("absdiff"):
+            ...
+        @profiler.profile("detect")
+        def detect(...):
+            ...
+        profiler.record("push", seconds)
+
+    FrameLoop records each of its stages into the default profiler (see
+    get_profiler()).  If write is True, histograms are written to
+    PROFILE_FILE (one file per process) every WRITE_PERIOD seconds, where
+    VizyVisor's Profiler dialog picks them up.
+    """
+    def __init__(self, name=None, enabled=ENABLED, write=False):
+        self.name = name
+        self.enabled = enabled
+        self.lock = Lock()
+        self.histograms_ = {}
+        self.t0 = time.time()
+        self.thread = None
+        if write and enabled:
+            self.thread = Thread(target=self.write_thread, daemon=True)
+            self.thread.start()
+
+    def record(self, name, t):
+        if not self.enabled:
+            return
+        with self.lock:
+            h = self.histograms_.get(name)
+            if h is None:
+                h = self.histograms_[name] = Histogram()
+            h.add(t)
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def profile(self, name=None):
+        def wrap_func(func):
+            name_ = func.__name__ if name is None else name
+            @wraps(func)
+            def _func(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                t0 = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name_, time.perf_counter()-t0)
+            return _func
+        return wrap_func
+
+    def histograms(self):
+        with self.lock:
+            return {name: h.to_dict() for name, h in self.histograms_.items()}
+
+    def to_json(self):
+        return {"name": self.name, "pid": os.getpid(), "time": time.time(), "start": self.t0, "buckets": BUCKETS, "stages": self.histograms()}
+
+    def dump(self, filename):
+        # Write atomically so readers never see a partial file.
+        with open(filename + ".tmp", "w") as f:
+            json.dump(self.to_json(), f)
+        os.replace(filename + ".tmp", filename)
+
+    def reset(self):
+        with self.lock:
+            self.histograms_ = {}
+            self.t0 = time.time()
+
+    def write_thread(self):
+        while True:
+            time.sleep(WRITE_PERIOD)
+            if self.histograms_:
+                try:
+                    self.dump(PROFILE_FILE.format(pid=os.getpid()))
+                except Exception as e:
+                    print("Unable to write profile:", e)
+                    return
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, time.perf_counter()-self.t0)
+
+
+_profiler = None
+
+def get_profiler():
+    """
+    Returns the default (per-process) profiler, which writes to PROFILE_FILE.
+    """
+    global _profiler
+    if _profiler is None:
+        import __main__
+        name = os.path.basename(os.path.dirname(os.path.abspath(getattr(__main__, "__file__", "python"))))
+        _profiler = Profiler(name, write=True)
+    return _profiler
+
+def profile(name=None):
+    """
+    Decorator that records the function's run time in the default profiler.
+    """
+    return get_profiler().profile(name)
+
+def stage(name):
+    """
+    Context manager that records the block's run time in the default profiler.
+    """
+    return get_profiler().stage(name)
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+
+def load_profile(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def load_profiles():
+    """
+    Returns the profiles of the running processes, sorted by name and pid.
+    Profiles left by processes that have exited are removed.
+    """
+    profiles = []
+    for filename in glob.glob(PROFILE_FILE.format(pid="*")):
+        profile = load_profile(filename)
+        if profile is None:
+            continue
+        if running(profile['pid']):
+            profiles.append(profile)
+        else:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+    return sorted(profiles, key=lambda p: (str(p['name']), p['pid']))
@@ -0,0 +1,76 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import time
+from threading import Thread
+import dash_html_components as html
+import dash_bootstrap_components as dbc
+from dash_devices.dependencies import Output
+from kritter import Kritter, Ktext, Kdialog, KsideMenuItem
+from .profiler import load_profiles
+
+UPDATE_PERIOD = 1 # seconds
+BARS = "▁▂▃▄▅▆▇█"
+COLUMNS = ["Stage", "Count", "Avg (ms)", "p50 (ms)", "p90 (ms)", "p99 (ms)", "Max (ms)", "Histogram"]
+
+
+def _bars(counts):
+    m = max(counts)
+    if not m:
+        return ""
+    return "".join([BARS[(len(BARS)-1)*c//m] if c else " " for c in counts])
+
+
+class ProfilerDialog:
+
+    def __init__(self, kapp, pmask):
+        self.kapp = kapp
+        self.run = 0
+        self.thread = None
+
+        style = {"label_width": 3, "control_width": 9}
+        self.app_c = Ktext(name="Programs", style=style)
+        self.table_div = html.Div(id=Kritter.new_id(), style={"overflow-x": "auto"})
+        layout = [self.app_c, self.table_div]
+        dialog = Kdialog(title=[Kritter.icon("tachometer"), "Profiler"], layout=layout, size="xl")
+        self.layout = KsideMenuItem("Profiler", dialog, "tachometer")
+
+        @dialog.callback_view()
+        def func(open):
+            if open:
+                self.run += 1
+                if self.run==1:
+                    self.thread = Thread(target=self.update_thread)
+                    self.thread.start()
+                return self.update()
+            elif self.run>0:  # Stale dialogs in browser can result in negative counts.
+                self.run -= 1
+
+    def update_thread(self):
+        while self.run:
+            time.sleep(UPDATE_PERIOD)
+            self.kapp.push_mods(self.update())
+
+    def update(self):
+        # One table per process (e.g. the app and the power monitor).
+        profiles = load_profiles()
+        if not profiles:
+            return self.app_c.out_value("No profile data (is a program running?)") + [Output(self.table_div.id, "children", None)]
+        tables = []
+        for profile in profiles:
+            desc = f"{profile['name']} (pid {profile['pid']}), {(profile['time']-profile['start'])/60:.0f} minutes of data, updated {time.time()-profile['time']:.0f}s ago"
+            rows = []
+            for name, h in sorted(profile['stages'].items()):
+                rows.append(html.Tr([html.Td(name), html.Td(h['count'])] + [html.Td(f"{h[k]*1000:.1f}") for k in ("avg", "p50", "p90", "p99", "max")] + [html.Td(_bars(h['counts']), style={"font-family": "monospace", "white-space": "pre"})]))
+            tables += [html.H6(desc), dbc.Table([html.Thead(html.Tr([html.Th(c) for c in COLUMNS])), html.Tbody(rows)], size="sm", striped=True)]
+        return self.app_c.out_value(", ".join([f"{p['name']} (pid {p['pid']})" for p in profiles])) + [Output(self.table_div.id, "children", tables)]
+
+    def close(self):
+        self.run = 0
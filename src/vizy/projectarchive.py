@@ -0,0 +1,225 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import time
+import json
+import shutil
+import hashlib
+import zipfile
+
+# Content hashes of the archived files, checked when extracting.
+MANIFEST_FILE = ".manifest.json"
+# These are already compressed, deflating them just burns CPU.
+STORE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".mp4", ".tflite", ".zip", ".gz")
+CHUNK_SIZE = 1024*1024
+TRANSFER_RETRIES = 3
+RETRY_DELAY = 5 # seconds
+
+
+class _Progress:
+    # Calls callback(percent, name) when the percentage changes.
+    def __init__(self, callback, total):
+        self.callback = callback
+        self.total = max(total, 1)
+        self.done = 0
+        self.percent = -1
+
+    def update(self, n, name):
+        self.done += n
+        percent = min(100*self.done//self.total, 100)
+        if self.callback and percent!=self.percent:
+            self.percent = percent
+            self.callback(percent, name)
+
+
+def _walk(root, files):
+    # Yields (relative path, full path) for files, descending into directories.
+    for f in files:
+        path = os.path.join(root, f)
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    full = os.path.join(dirpath, filename)
+                    yield os.path.relpath(full, root), full
+        elif os.path.exists(path):
+            yield f, path
+
+
+def write_archive(dest, root, files, progress_callback=None):
+    """
+    Zips files (names relative to root, directories are included
+    recursively) into dest, one chunk at a time.  JPEGs, models, etc. are
+    stored without compression.  A manifest of SHA-256 hashes is added so
+    extract_archive() can check the contents.  progress_callback(percent,
+    name) is called as the archive is written.  Returns the manifest
+    (dict of name: hash).
+    """
+    entries = list(_walk(root, files))
+    progress = _Progress(progress_callback, sum([os.path.getsize(full) for name, full in entries]))
+    manifest = {}
+    tmp = dest + ".tmp"
+    with zipfile.ZipFile(tmp, "w", allowZip64=True) as zf:
+        for name, full in entries:
+            info = zipfile.ZipInfo.from_file(full, name)
+            info.compress_type = zipfile.ZIP_STORED if name.lower().endswith(STORE_EXTENSIONS) else zipfile.ZIP_DEFLATED
+            sha = hashlib.sha256()
+            with open(full, "rb") as fsrc, zf.open(info, "w", force_zip64=True) as fdest:
+                while True:
+                    chunk = fsrc.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    fdest.write(chunk)
+                    progress.update(len(chunk), name)
+            manifest[name] = sha.hexdigest()
+        zf.writestr(MANIFEST_FILE, json.dumps(manifest, indent=1), zipfile.ZIP_DEFLATED)
+    os.replace(tmp, dest)
+    return manifest
+
+
+def extract_archive(src, dest, progress_callback=None):
+    """
+    Extracts src into dest, one chunk at a time, and checks each file
+    against the archive's manifest (archives without one, e.g. from older
+    versions, aren't checked).  Raises RuntimeError if a file is corrupt or
+    would be written outside of dest.  Returns the number of files
+    extracted.
+    """
+    dest = os.path.realpath(dest)
+    with zipfile.ZipFile(src) as zf:
+        try:
+            manifest = json.loads(zf.read(MANIFEST_FILE))
+        except KeyError:
+            manifest = None
+        infos = [i for i in zf.infolist() if i.filename!=MANIFEST_FILE]
+        progress = _Progress(progress_callback, sum([i.file_size for i in infos]))
+        count = 0
+        for info in infos:
+            path = os.path.realpath(os.path.join(dest, info.filename))
+            if not path.startswith(dest + os.sep):
+                raise RuntimeError(f"{info.filename} is outside of the project")
+            if info.is_dir():
+                os.makedirs(path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            sha = hashlib.sha256()
+            with zf.open(info) as fsrc, open(path, "wb") as fdest:
+                while True:
+                    chunk = fsrc.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    fdest.write(chunk)
+                    progress.update(len(chunk), info.filename)
+            if manifest is not None and manifest.get(info.filename)!=sha.hexdigest():
+                raise RuntimeError(f"{info.filename} is corrupt")
+            count += 1
+    return count
+
+
+def transfer(func, *args, retries=TRANSFER_RETRIES, delay=RETRY_DELAY):
+    """
+    Calls func(*args) (e.g. gdrive.copy_to), retrying up to retries times if
+    it raises -- uploads and downloads of large projects are prone to
+    dropped connections.
+    """
+    for i in range(retries+1):
+        try:
+            return func(*args)
+        except Exception as e:
+            if i==retries:
+                raise
+            print(f"Transfer failed ({e}), retrying...")
+            time.sleep(delay)
+
+
+class LocalDrive:
+    """
+    Stand-in for kritter's GdriveInterface that keeps files in a local
+    directory, for testing project export and import without a Google
+    account:
+
+        drive = LocalDrive("/tmp/drive")
+        ExportProjectDialog(drive, ...)
+        ImportProjectDialog(drive, ...)
+
+    Copies are done in chunks to a .part file, and an interrupted copy
+    resumes where it left off.
+    """
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.index_file = os.path.join(root, ".index.json")
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, path):
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def _id(self, path):
+        # Ids don't contain "." so they survive share key parsing.
+        return hashlib.sha1(path.lstrip("/").encode()).hexdigest()
+
+    def _index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _copy(self, src, dest, progress_callback=None):
+        part = dest + ".part"
+        size = os.path.getsize(src)
+        done = os.path.getsize(part) if os.path.exists(part) else 0
+        if done>size:
+            done = 0
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        with open(src, "rb") as fsrc, open(part, "ab" if done else "wb") as fdest:
+            fsrc.seek(done)
+            while True:
+                chunk = fsrc.read(self.chunk_size)
+                if not chunk:
+                    break
+                fdest.write(chunk)
+                done += len(chunk)
+                if progress_callback and 100*done//max(size, 1)!=100*(done-len(chunk))//max(size, 1):
+                    progress_callback(100*done//max(size, 1))
+        os.replace(part, dest)
+
+    def copy_to(self, src, dest, block=True, progress_callback=None):
+        self._copy(src, self._path(dest), progress_callback)
+        index = self._index()
+        index[self._id(dest)] = dest.lstrip("/")
+        with open(self.index_file, "w") as f:
+            json.dump(index, f)
+
+    def copy_from(self, src, dest, block=True, progress_callback=None):
+        self._copy(self._path(src), dest, progress_callback)
+
+    def get_url(self, path):
+        return f"file://{self.root}/d/{self._id(path)}/view"
+
+    def download(self, id, dest, progress_callback=None):
+        try:
+            path = self._index()[id]
+        except KeyError:
+            raise FileNotFoundError(f"No file with id {id}")
+        self._copy(self._path(path), dest, progress_callback)
+
+    def exists(self, path):
+        return os.path.exists(self._path(path))
+
+    def delete(self, path):
+        path = self._path(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
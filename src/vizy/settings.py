@@ -0,0 +1,91 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+# Settings and directories that don't depend on kritter, so that light
+# consumers such as vizy-power-monitor can use them without importing the
+# UI framework.
+
+import os
+import json
+
+VIZY_HOME = "VIZY_HOME"
+ETCDIR_NAME = 'etc'
+APPSDIR_NAME = 'apps'
+EXAMPLESDIR_NAME = 'examples'
+SCRIPTSDIR_NAME = 'scripts'
+
+CONFIG_FILE = "vizy_main.json"
+DEFAULT_CONFIG = {
+    "software": {
+        "update server": "https://vizycam.com/sd",
+        "channel": "vizy_main",
+        "start-up app": None,
+        "start-up example": "video",
+        "maximum logins": 3,
+        "power board broker": False,
+        "app zygote": False
+    }, 
+    "hardware": {
+        "power board": {
+            "PCB type": "rpi_main",
+            "firmware type": "main"
+        },
+        "camera": {
+            "type": "Sony IMX477 12.3 megapixel",
+            "IR-cut": "switchable",
+            "version": "1.0"
+        },
+        "coprocessor": None 
+    }
+}
+
+
+def dirs(num):
+    homedir = os.getenv(VIZY_HOME)
+    if homedir is None:
+        raise RuntimeError("VIZY_HOME environment variable should be set to the directory where Vizy software is installed.")
+    if not os.path.exists(homedir):
+        raise RuntimeError("VIZY_HOME directory doesn't exist!")
+    uid = os.stat(homedir).st_uid
+    gid = os.stat(homedir).st_gid
+    etcdir = os.path.join(homedir, ETCDIR_NAME)
+    if not os.path.exists(etcdir):
+        os.mkdir(etcdir)
+        os.chown(etcdir, uid, gid)
+    appsdir = os.path.join(homedir, APPSDIR_NAME)
+    if not os.path.exists(appsdir):
+        os.mkdir(appsdir)
+        os.chown(appsdir, uid, gid)
+    examplesdir = os.path.join(homedir, EXAMPLESDIR_NAME)
+    if not os.path.exists(examplesdir):
+        os.mkdir(examplesdir)
+        os.chown(examplesdir, uid, gid)
+
+    result = homedir, etcdir, appsdir, examplesdir
+    return result[0:num]
+
+
+
+def read_config(etcdir):
+    """
+    Returns the Vizy config (see VizyConfig) as a plain dict with defaults
+    for missing settings.  Changes aren't saved -- use VizyConfig for that.
+    """
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    try:
+        with open(os.path.join(etcdir, CONFIG_FILE)) as f:
+            for k, v in json.load(f).items():
+                if isinstance(v, dict) and isinstance(config.get(k), dict):
+                    config[k].update(v)
+                else:
+                    config[k] = v
+    except:
+        pass
+    return config
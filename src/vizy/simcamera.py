@@ -0,0 +1,364 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import cv2
+import time
+import numpy as np
+from threading import Thread, Condition
+
+# Set VIZY_CAMERA to "synthetic" or to one or more video files (separated by
+# os.pathsep) to replace kritter.Camera with SimCamera (see vizy.py).
+CAMERA_ENV = "VIZY_CAMERA"
+SYNTHETIC = "synthetic"
+# Optional, fixes the frame rate regardless of what the app asks for.
+FPS_ENV = "VIZY_CAMERA_FPS"
+# Optional, number of moving objects in synthetic scenes.
+OBJECTS_ENV = "VIZY_CAMERA_OBJECTS"
+DEFAULT_OBJECTS = 3
+DEFAULT_MODE = "768x432x10bpp"
+MIN_FRAMERATE = 1
+
+# Recording states, same as kritter's
+PRE_RECORDING = -1
+STOPPED = 0
+RECORDING = 1
+
+# Same modes (and video info) as Vizy's camera.  crop and offset are
+# fractions of the sensor, pixelsize is in sensor pixels.
+MODES = {
+    "640x480x10bpp (cropped)": dict(resolution=(640, 480), crop=(0.316, 0.316), offset=(0, 0), pixelsize=(2, 2), max_framerate=200),
+    "768x432x10bpp": dict(resolution=(768, 432), crop=(0.947, 0.711), offset=(0, 0), pixelsize=(5, 5), max_framerate=90),
+    "1280x720x10bpp": dict(resolution=(1280, 720), crop=(0.947, 0.711), offset=(0, 0), pixelsize=(3, 3), max_framerate=60),
+    "1920x1080x10bpp": dict(resolution=(1920, 1080), crop=(0.947, 0.711), offset=(0, 0), pixelsize=(2, 2), max_framerate=50),
+    "2016x1520x10bpp": dict(resolution=(2016, 1520), crop=(1, 1), offset=(0, 0), pixelsize=(2, 2), max_framerate=40),
+}
+
+
+def enabled():
+    return bool(os.getenv(CAMERA_ENV))
+
+
+class SyntheticScene:
+    """
+    Textured background with colored objects bouncing around on it.  read(t)
+    returns the scene at time t (seconds).  The background (without
+    objects) is in bg.
+    """
+    def __init__(self, resolution, objects, seed=0):
+        self.rand = np.random.RandomState(seed)
+        w, h = resolution
+        # Smooth gradient plus low-contrast texture, so background subtraction
+        # has something to chew on.
+        x = np.linspace(40, 120, w, dtype=np.float32)
+        y = np.linspace(30, 90, h, dtype=np.float32)
+        bg = (x[None, :] + y[:, None])[:, :, None] + self.rand.randint(0, 12, (h, w, 1))
+        self.bg = np.clip(np.repeat(bg, 3, axis=2)*[1.0, 1.1, 0.9], 0, 255).astype(np.uint8)
+        size = max(min(w, h)//20, 4)
+        self.objects = []
+        for i in range(objects):
+            self.objects.append(dict(pos=self.rand.uniform((0, 0), (w, h)), vel=self.rand.uniform(-w/4, w/4, 2),
+                radius=int(self.rand.randint(size, size*3)), color=tuple(int(c) for c in self.rand.randint(0, 256, 3))))
+        self.resolution = resolution
+        self.t = None
+
+    def read(self, t):
+        dt = 0 if self.t is None else t-self.t
+        self.t = t
+        w, h = self.resolution
+        image = self.bg.copy()
+        for o in self.objects:
+            o['pos'] += o['vel']*dt
+            for i, lim in enumerate((w, h)):
+                if not 0<=o['pos'][i]<lim:
+                    o['vel'][i] = -o['vel'][i]
+                    o['pos'][i] = min(max(o['pos'][i], 0), lim-1)
+            cv2.circle(image, (int(o['pos'][0]), int(o['pos'][1])), o['radius'], o['color'], -1)
+        return image
+
+
+class _Replay:
+    # Plays video files in sequence and loops.
+    def __init__(self, files, resolution):
+        self.files = files
+        self.resolution = resolution
+        self.index = 0
+        self.cap = None
+
+    def read(self, t):
+        for i in range(len(self.files)+1):
+            if self.cap is None:
+                self.cap = cv2.VideoCapture(self.files[self.index])
+                self.index = (self.index+1)%len(self.files)
+            res, image = self.cap.read()
+            if res:
+                if (image.shape[1], image.shape[0])!=self.resolution:
+                    image = cv2.resize(image, self.resolution)
+                return image
+            self.cap.release()
+            self.cap = None
+        raise RuntimeError(f"Unable to read {self.files}")
+
+
+class SimRecording:
+    """
+    Recording from SimCamera, with the same interface as kritter's (frame(),
+    seek(), save(), load(), etc.)  It's also what stream(False) returns.
+    """
+    def __init__(self, camera=None, duration=None, start_shift=0):
+        self.camera = camera
+        self.duration = duration
+        self.start_shift = start_shift
+        self.frames = []
+        self.index = 0
+        self.progress_ = 0
+        self.cond = Condition()
+        if camera is None:
+            self.state = STOPPED
+        else:
+            self.state = PRE_RECORDING if start_shift<0 else RECORDING
+            self.t0 = time.time() + max(start_shift, 0)
+            camera._add(self)
+
+    def _put(self, image, t):
+        with self.cond:
+            if self.state==PRE_RECORDING:
+                self.frames.append((image, t))
+                # Only keep -start_shift seconds while we wait for start()
+                while self.frames and t-self.frames[0][1]>-self.start_shift:
+                    self.frames.pop(0)
+            elif self.state==RECORDING and t>=self.t0:
+                self.frames.append((image, t))
+                if self.duration is not None and self.time_len()>=self.duration:
+                    self.state = STOPPED
+            self.cond.notify_all()
+        return self.state!=STOPPED
+
+    def start(self):
+        with self.cond:
+            if self.state==PRE_RECORDING:
+                self.state = RECORDING
+                self.t0 = 0
+
+    def stop(self):
+        with self.cond:
+            self.state = STOPPED
+
+    def recording(self):
+        return self.state
+
+    def len(self):
+        return len(self.frames)
+
+    def time_len(self):
+        return self.frames[-1][1]-self.frames[0][1] if self.frames else 0
+
+    def frame(self):
+        with self.cond:
+            if self.index>=len(self.frames):
+                return None
+            image, t = self.frames[self.index]
+            self.index += 1
+            return image, t-self.frames[0][1], self.index-1
+
+    def seek(self, index):
+        self.index = min(max(index, 0), len(self.frames))
+
+    def time_seek(self, t):
+        # Seek to the first frame at or after t, return its time.
+        for i, (image, _t) in enumerate(self.frames):
+            if _t-self.frames[0][1]>=t:
+                self.index = i
+                return _t-self.frames[0][1]
+        self.index = len(self.frames)
+        return self.time_len()
+
+    def progress(self):
+        return self.progress_
+
+    def save(self, filename):
+        self.progress_ = 0
+        if self.frames:
+            h, w = self.frames[0][0].shape[:2]
+            fps = (len(self.frames)-1)/self.time_len() if self.time_len() else 30
+            writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*"mp4v"), fps, (w, h))
+            for i, (image, t) in enumerate(self.frames):
+                writer.write(image)
+                self.progress_ = 100*(i+1)//len(self.frames)
+            writer.release()
+        self.progress_ = 100
+
+    def load(self, filename):
+        self.progress_ = 0
+        cap = cv2.VideoCapture(filename)
+        count = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 1)
+        frames = []
+        while True:
+            res, image = cap.read()
+            if not res:
+                break
+            frames.append((image, cap.get(cv2.CAP_PROP_POS_MSEC)/1000))
+            self.progress_ = min(100*len(frames)//count, 99)
+        cap.release()
+        with self.cond:
+            self.frames = frames
+            self.index = 0
+            self.state = STOPPED
+        self.progress_ = 100
+
+
+class SimStream:
+    """
+    Live stream from SimCamera.  frame() blocks until the next frame and
+    returns (image, timestamp, index) like kritter's stream.
+    """
+    def __init__(self, camera):
+        self.camera = camera
+        self.index = -1
+        self.running = True
+        camera._add(self)
+
+    def _put(self, image, t):
+        return self.running
+
+    def frame(self):
+        frame = self.camera._wait(self.index)
+        if frame is not None:
+            self.index = frame[2]
+        return frame
+
+    def stop(self):
+        self.running = False
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.camera._add(self)
+
+
+class SimCamera:
+    """
+    Stand-in for kritter.Camera that generates frames instead of reading
+    them from the sensor, for running apps (and benchmarks) without Vizy's
+    hardware.  If source is a list of video files, they're played in a loop
+    (resized to the camera mode's resolution if necessary).  Otherwise
+    synthetic scenes with moving objects are generated.  Frames are produced
+    at the camera's framerate by a single capture thread, which feeds all
+    streams and recordings, as with the real camera.
+
+    Set the VIZY_CAMERA environment variable to use it in place of
+    kritter.Camera, e.g. VIZY_CAMERA=synthetic or VIZY_CAMERA=birds.mp4.
+    """
+    def __init__(self, hflip=False, vflip=False, mem_reserve=None, source=None, fps=None, objects=None):
+        if source is None:
+            source = os.getenv(CAMERA_ENV, SYNTHETIC)
+        if isinstance(source, str):
+            source = None if source==SYNTHETIC else source.split(os.pathsep)
+        self.source = source
+        self.fixed_framerate = fps or float(os.getenv(FPS_ENV, 0)) or None
+        self.objects = objects if objects is not None else int(os.getenv(OBJECTS_ENV, DEFAULT_OBJECTS))
+        self.hflip = hflip
+        self.vflip = vflip
+        self.brightness = 50
+        self.awb = True
+        self.awb_red = 1.0
+        self.awb_blue = 1.0
+        self.autoshutter = True
+        self.shutter_speed = 0.01
+        self.cond = Condition()
+        self.consumers = []
+        self.latest = None
+        self.frames = 0
+        self.thread = None
+        self.running = False
+        self.mode = DEFAULT_MODE
+
+    def getmodes(self):
+        return dict(MODES)
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @mode.setter
+    def mode(self, mode):
+        if mode not in MODES:
+            raise ValueError(f"Unsupported mode {mode}")
+        with self.cond:
+            self._mode = mode
+            self.resolution = MODES[mode]['resolution']
+            self.max_framerate = self.fixed_framerate or MODES[mode]['max_framerate']
+            self.min_framerate = min(MIN_FRAMERATE, self.max_framerate)
+            self._framerate = self.max_framerate
+            self.generator = None # recreated at the new resolution
+
+    @property
+    def framerate(self):
+        return self._framerate
+
+    @framerate.setter
+    def framerate(self, framerate):
+        if not self.fixed_framerate:
+            self._framerate = min(max(framerate, self.min_framerate), self.max_framerate)
+
+    def _create_generator(self):
+        if self.source:
+            return _Replay(self.source, self.resolution)
+        return SyntheticScene(self.resolution, self.objects)
+
+    def _add(self, consumer):
+        with self.cond:
+            self.consumers.append(consumer)
+            if self.thread is None:
+                self.running = True
+                self.thread = Thread(target=self.capture_thread, daemon=True)
+                self.thread.start()
+
+    def _wait(self, index):
+        with self.cond:
+            while self.running and (self.latest is None or self.latest[2]==index):
+                self.cond.wait()
+            return self.latest
+
+    def capture_thread(self):
+        t_next = time.time()
+        while self.running:
+            with self.cond:
+                if self.generator is None:
+                    self.generator = self._create_generator()
+                generator = self.generator
+                period = 1/self._framerate
+            t = time.time()
+            if t<t_next:
+                time.sleep(t_next-t)
+                t = time.time()
+            t_next = max(t_next+period, t)
+            image = generator.read(t)
+            with self.cond:
+                self.latest = (image, t, self.frames)
+                self.frames += 1
+                self.consumers = [c for c in self.consumers if c._put(image, t)]
+                self.cond.notify_all()
+
+    def stream(self, start=True):
+        if start:
+            return SimStream(self)
+        return SimRecording()
+
+    def record(self, duration=None, start_shift=0):
+        return SimRecording(self, duration, start_shift)
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,174 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import time
+import socket
+import select
+from threading import Thread
+
+READY_SOCKET_ENV = "VIZY_READY_SOCKET"
+READY_SOCKET = "/tmp/vizy_ready.sock"
+READY_MESSAGE = b"listening"
+READY_POLL_PERIOD = 0.01 # seconds
+READY_TIMEOUT = 60 # seconds
+
+
+def notify_ready(port, path):
+    """
+    Called by apps (see Vizy.run()) to tell the supervisor (AppsDialog) that
+    the server is listening on the given port.  The path of the supervisor's
+    socket is passed to apps in the READY_SOCKET_ENV environment variable. 
+    The notification includes our pid, which isn't the supervisor's child
+    if we were forked from the zygote.  It returns right away.
+    """
+    def thread():
+        t0 = time.time()
+        # The server binds its socket once it's running, so wait for that.
+        while time.time()-t0<READY_TIMEOUT:
+            try:
+                socket.create_connection(("localhost", port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(READY_POLL_PERIOD)
+        else:
+            return
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            s.sendto(READY_MESSAGE + f" {os.getpid()}".encode(), path)
+            s.close()
+        except OSError:
+            pass
+    Thread(target=thread, daemon=True).start()
+
+
+class ReadySocket:
+    """
+    Receives "listening" notifications from apps.  Its environment variable
+    is set so that apps started from this process inherit the socket path.
+    pid is the app's pid from the last notification (or None if the app
+    didn't send it).
+    """
+    def __init__(self, path=READY_SOCKET):
+        self.path = path
+        try:
+            os.remove(path)
+        except:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        # Apps run as a regular user.
+        os.chmod(path, 0o666)
+        self.sock.setblocking(False)
+        self.pid = None
+        os.environ[READY_SOCKET_ENV] = path
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def received(self):
+        """
+        Returns True if a notification has been received (and consumes all
+        pending notifications).
+        """
+        res = False
+        while True:
+            try:
+                msg = self.sock.recv(64).split()
+            except (BlockingIOError, InterruptedError):
+                return res
+            if msg and msg[0]==READY_MESSAGE:
+                res = True
+                try:
+                    self.pid = int(msg[1])
+                except (IndexError, ValueError):
+                    self.pid = None
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except:
+            pass
+
+
+class ExitWatcher:
+    """
+    Becomes readable (see select()) when the given child process exits.  It
+    uses a pidfd if available, otherwise a thread that blocks on waitid().
+    In both cases the child isn't reaped -- the caller still needs to call
+    waitid()/waitpid().
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.pidfd = None
+        self.pipe = None
+        try:
+            self.pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            self.pipe = os.pipe()
+            Thread(target=self.thread, daemon=True).start()
+
+    def thread(self):
+        try:
+            os.waitid(os.P_PID, self.pid, os.WEXITED|os.WNOWAIT)
+        except ChildProcessError:
+            pass
+        try:
+            os.write(self.pipe[1], b'x')
+        except OSError:
+            pass
+        # Write end is ours to close (see close()).
+        os.close(self.pipe[1])
+
+    def fileno(self):
+        return self.pidfd if self.pidfd is not None else self.pipe[0]
+
+    def close(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+        else:
+            os.close(self.pipe[0])
+
+
+class Wakeup:
+    """
+    Self-pipe used to wake up a select() call from another thread.
+    """
+    def __init__(self):
+        self.pipe = os.pipe()
+        os.set_blocking(self.pipe[0], False)
+
+    def fileno(self):
+        return self.pipe[0]
+
+    def set(self):
+        os.write(self.pipe[1], b'x')
+
+    def clear(self):
+        try:
+            while os.read(self.pipe[0], 64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self, fds, timeout=None):
+        """
+        Waits for any of fds (or this object) to become readable.  Returns
+        list of readable objects.
+        """
+        r, _, _ = select.select(fds + [self], [], [], timeout)
+        if self in r:
+            self.clear()
+        return r
+
+    def close(self):
+        os.close(self.pipe[0])
+        os.close(self.pipe[1])
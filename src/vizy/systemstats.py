@@ -0,0 +1,229 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import time
+from threading import Thread, Lock
+
+SAMPLE_PERIOD = 1 # seconds
+FLASH_PATH = "/"
+FLASH_DEVICE = "mmcblk0"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def get_ram():
+    """
+    Returns total and available RAM in KB.
+    """
+    total = free = 0
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    total = int(line.split()[1])
+                elif line.startswith("MemAvailable:"):
+                    free = int(line.split()[1])
+                    break
+    except:
+        pass
+    return total, free
+
+def get_flash_total():
+    """
+    Returns size of flash (SD card) in KB.
+    """
+    try:
+        with open('/proc/partitions', 'r') as f:
+            for line in f:
+                parts = line.split()
+                if parts and parts[-1]==FLASH_DEVICE:
+                    return int(parts[2])
+    except:
+        pass
+    return 0
+
+def get_flash_free(path=FLASH_PATH):
+    """
+    Returns free space in KB (available to regular users, like df).
+    """
+    try:
+        st = os.statvfs(path)
+        return st.f_bavail*st.f_frsize//1024
+    except:
+        return 0
+
+def get_cpu_times():
+    """
+    Returns list of (busy, total) jiffies for each CPU core.
+    """
+    res = []
+    try:
+        with open('/proc/stat', 'r') as f:
+            for line in f:
+                if not line.startswith("cpu"):
+                    break
+                if line[3]==' ':
+                    continue # aggregate line
+                vals = [int(v) for v in line.split()[1:]]
+                # user, nice, system
+                res.append((vals[0]+vals[1]+vals[2], sum(vals)))
+    except:
+        pass
+    return res
+
+# pid: ppid of the processes we've seen, so each /proc/pid/stat is only read
+# once.
+_ppids = {}
+_ppids_lock = Lock()
+
+def get_process_tree(pid):
+    """
+    Returns list of pid and its descendants.
+    """
+    children = {}
+    try:
+        pids = set([int(p) for p in os.listdir('/proc') if p.isdigit()])
+    except OSError:
+        pids = set()
+    with _ppids_lock:
+        # Forget processes that have exited.
+        for p in list(_ppids.keys()):
+            if p not in pids:
+                del _ppids[p]
+        for p in pids:
+            if p not in _ppids:
+                try:
+                    with open(f'/proc/{p}/stat', 'r') as f:
+                        # Command name is in parentheses and may contain spaces.
+                        _ppids[p] = int(f.read().rsplit(')', 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+            children.setdefault(_ppids[p], []).append(p)
+    res = []
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        res.append(p)
+        pids += children.get(p, [])
+    return res
+
+def get_process_usage(pids):
+    """
+    Returns total CPU time (seconds) and RSS (bytes) of the given processes.
+    """
+    cpu = rss = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            # utime and stime are fields 14 and 15, rss is 24 (1-based, counting pid and comm)
+            cpu += (int(fields[11])+int(fields[12]))/CLOCK_TICKS
+            rss += int(fields[21])*PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            pass
+    return cpu, rss
+
+
+class SystemStats:
+    """
+    Samples CPU usage (per core), RAM, flash and the running app's CPU usage
+    and RSS in a background thread, and publishes each sample to all
+    subscribers.  The thread only runs while there are subscribers.
+
+        stats = SystemStats(app_pid_func=lambda: apps_dialog.pid)
+        stats.subscribe(callback) # callback(sample) is called every period
+        stats.sample() # latest sample, or a new one if not running
+    """
+    def __init__(self, period=SAMPLE_PERIOD, app_pid_func=None):
+        self.period = period
+        self.app_pid_func = app_pid_func
+        self.lock = Lock()
+        self.subscribers = []
+        self.thread = None
+        self.latest = None
+        self.cpu_times0 = None
+        self.app0 = None
+
+    def _sample(self):
+        t = time.time()
+        cpu_times = get_cpu_times()
+        usage = [0]*len(cpu_times)
+        if self.cpu_times0 and len(self.cpu_times0)==len(cpu_times):
+            for i, ((busy, total), (busy0, total0)) in enumerate(zip(cpu_times, self.cpu_times0)):
+                if total>total0:
+                    usage[i] = round(100*(busy-busy0)/(total-total0))
+        self.cpu_times0 = cpu_times
+        ram_total, ram_free = get_ram()
+        app = None
+        pid = self.app_pid_func() if self.app_pid_func else None
+        if pid:
+            app_cpu, app_rss = get_process_usage(get_process_tree(pid))
+            cpu = 0
+            if self.app0 and self.app0[0]==pid and t>self.app0[1]:
+                # Percent of one core, like top
+                cpu = round(100*(app_cpu-self.app0[2])/(t-self.app0[1]))
+            self.app0 = (pid, t, app_cpu)
+            app = {'pid': pid, 'cpu': max(cpu, 0), 'rss': app_rss}
+        self.latest = {
+            'time': t,
+            'cpu': {'usage': usage},
+            'ram': {'total': ram_total, 'free': ram_free},
+            'flash': {'total': get_flash_total(), 'free': get_flash_free()},
+            'app': app
+        }
+        return self.latest
+
+    def sample(self, max_age=None):
+        """
+        Returns the most recent sample if it's younger than max_age (defaults
+        to 2 periods), otherwise takes a new sample (which takes a period
+        because CPU usage is measured over an interval).
+        """
+        if max_age is None:
+            max_age = 2*self.period
+        with self.lock:
+            if self.latest and time.time()-self.latest['time']<max_age:
+                return self.latest
+            self._sample()
+        time.sleep(self.period)
+        with self.lock:
+            return self._sample()
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+            if self.thread is None:
+                self.thread = Thread(target=self.sample_thread, daemon=True)
+                self.thread.start()
+        return callback
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s!=callback]
+
+    def sample_thread(self):
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    return
+                sample = self._sample()
+                subscribers = self.subscribers[:]
+            for s in subscribers:
+                try:
+                    s(sample)
+                except Exception as e:
+                    print("Exception in system stats subscriber:", e)
+            time.sleep(self.period)
+
+    def close(self):
+        with self.lock:
+            self.subscribers = []
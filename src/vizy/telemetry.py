@@ -0,0 +1,227 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import mmap
+import time
+import struct
+import subprocess
+
+TELEMETRY_FILE = "/dev/shm/vizy_telemetry"
+MAGIC = b"VZTM"
+VERSION = 1
+FIELDS = ["time", "temp", "fan", "throttled", "vin", "v5", "cpu"]
+RECORD = struct.Struct("<" + "d"*len(FIELDS))
+# magic, version, sequence (odd while being written)
+HEADER = struct.Struct("<4sIQ")
+# head (next index to write), count
+TIER_HEADER = struct.Struct("<QQ")
+# (period in seconds, number of records) -- 1 hour of seconds, 1 day of minutes, 30 days of hours
+TIERS = [(1, 3600), (60, 1440), (3600, 720)]
+THROTTLED_FILE = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+READ_TRIES = 10
+
+
+def get_throttled():
+    """
+    Returns the Raspberry Pi firmware's throttle state bits (see vcgencmd get_throttled).
+    """
+    try:
+        with open(THROTTLED_FILE, 'r') as f:
+            return int(f.read().strip(), 16)
+    except:
+        pass
+    try:
+        out = subprocess.check_output(["vcgencmd", "get_throttled"]).decode()
+        return int(out.split('=')[1], 16)
+    except:
+        return 0
+
+
+class CpuLoad:
+    """
+    Returns total CPU load (0 to 100 percent) since the previous call.
+    """
+    def __init__(self):
+        self.busy0 = self.total0 = 0
+
+    def __call__(self):
+        try:
+            with open('/proc/stat', 'r') as f:
+                vals = [int(v) for v in f.readline().split()[1:]]
+        except:
+            return 0
+        # idle and iowait are the 4th and 5th values
+        total = sum(vals)
+        busy = total - vals[3] - vals[4]
+        load = 0
+        if total>self.total0:
+            load = 100*(busy-self.busy0)/(total-self.total0)
+        self.busy0, self.total0 = busy, total
+        return load
+
+
+def _offsets():
+    offset = HEADER.size + TIER_HEADER.size*len(TIERS)
+    res = []
+    for period, size in TIERS:
+        res.append(offset)
+        offset += RECORD.size*size
+    return res, offset
+
+
+class Telemetry:
+    """
+    Writer side of the telemetry ring buffer, used by vizy-power-monitor.
+    Samples are added once per second and downsampled (averaged) into the
+    1 minute and 1 hour tiers.  Throttle bits are ORed instead of averaged.
+    """
+    def __init__(self, filename=TELEMETRY_FILE):
+        self.offsets, size = _offsets()
+        # Keep history across monitor restarts if the file is still valid. 
+        if not os.path.exists(filename) or os.path.getsize(filename)!=size:
+            with open(filename, 'wb') as f:
+                f.truncate(size)
+        # Let apps read it.
+        os.chmod(filename, 0o644)
+        self.file = open(filename, 'r+b')
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        magic, version, self.seq = HEADER.unpack_from(self.mmap, 0)
+        if magic!=MAGIC or version!=VERSION:
+            self.seq = 0
+            self.mmap[:] = bytes(size)
+        self.seq += self.seq&1
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, self.seq)
+        tiers = [TIER_HEADER.unpack_from(self.mmap, HEADER.size+TIER_HEADER.size*i) for i in range(len(TIERS))]
+        self.heads = [t[0] for t in tiers]
+        self.counts = [t[1] for t in tiers]
+        # Accumulators for the downsampled tiers
+        self.accums = [[] for t in TIERS]
+
+    def _write(self, tier, record):
+        offset = self.offsets[tier] + RECORD.size*self.heads[tier]
+        RECORD.pack_into(self.mmap, offset, *record)
+        self.heads[tier] = (self.heads[tier]+1)%TIERS[tier][1]
+        self.counts[tier] = min(self.counts[tier]+1, TIERS[tier][1])
+        TIER_HEADER.pack_into(self.mmap, HEADER.size+TIER_HEADER.size*tier, self.heads[tier], self.counts[tier])
+
+    @staticmethod
+    def _downsample(records, t):
+        n = len(records)
+        res = [sum([r[i] for r in records])/n for i in range(len(FIELDS))]
+        res[0] = t
+        throttled = 0
+        for r in records:
+            throttled |= int(r[3])
+        res[3] = throttled
+        return res
+
+    def _accumulate(self, tier, record):
+        period = TIERS[tier][0]
+        accum = self.accums[tier]
+        # Write downsampled record when we cross into the next period.
+        if accum and int(accum[0][0]//period)!=int(record[0]//period):
+            record_ = self._downsample(accum, int(accum[0][0]//period)*period)
+            self.accums[tier] = []
+            self._write(tier, record_)
+            if tier+1<len(TIERS):
+                self._accumulate(tier+1, record_)
+        self.accums[tier].append(record)
+
+    def add(self, temp, fan, throttled, vin, v5, cpu, t=None):
+        if t is None:
+            t = time.time()
+        record = [t, temp, fan, throttled, vin, v5, cpu]
+        # Sequence is odd while we're writing so readers can retry.
+        self.seq += 1
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, self.seq)
+        self._write(0, record)
+        self._accumulate(1, record)
+        self.seq += 1
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, self.seq)
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+
+class TelemetryReader:
+    """
+    Reads the telemetry ring buffer written by vizy-power-monitor without
+    any sampling of its own.
+
+        t = TelemetryReader()
+        t.latest() # most recent 1 second record
+        t.history(60, time.time()-3600) # 1 minute records for the last hour
+    """
+    def __init__(self, filename=TELEMETRY_FILE):
+        self.offsets, self.size = _offsets()
+        self.filename = filename
+        self.mmap = None
+
+    def _open(self):
+        if self.mmap is None:
+            with open(self.filename, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.mmap
+
+    def _read(self, tier, n=None):
+        m = self._open()
+        for i in range(READ_TRIES):
+            magic, version, seq = HEADER.unpack_from(m, 0)
+            if magic!=MAGIC or version!=VERSION:
+                return []
+            if seq&1:
+                time.sleep(0.001)
+                continue
+            head, count = TIER_HEADER.unpack_from(m, HEADER.size+TIER_HEADER.size*tier)
+            size = TIERS[tier][1]
+            if n is not None:
+                count = min(count, n)
+            records = []
+            for j in range(head-count, head):
+                offset = self.offsets[tier] + RECORD.size*(j%size)
+                records.append(RECORD.unpack_from(m, offset))
+            if HEADER.unpack_from(m, 0)[2]==seq:
+                return records
+        return []
+
+    def history(self, period=1, start=None, end=None, n=None):
+        """
+        Returns list of dicts (oldest first) with the FIELDS keys for the tier
+        with the given `period` (1, 60 or 3600 seconds) between `start` and
+        `end` (epoch seconds), optionally limited to the most recent `n` records.
+        """
+        tier = [t[0] for t in TIERS].index(period)
+        try:
+            records = self._read(tier, n)
+        except (OSError, ValueError):
+            return []
+        res = []
+        for r in records:
+            if (start is None or r[0]>=start) and (end is None or r[0]<=end):
+                r = dict(zip(FIELDS, r))
+                r['throttled'] = int(r['throttled'])
+                res.append(r)
+        return res
+
+    def latest(self, max_age=None):
+        """
+        Returns the most recent 1 second record, or `None` if there isn't one
+        (or it's older than `max_age` seconds).
+        """
+        start = None if max_age is None else time.time()-max_age
+        records = self.history(1, start, n=1)
+        return records[-1] if records else None
+
+    def close(self):
+        if self.mmap:
+            self.mmap.close()
+            self.mmap = None
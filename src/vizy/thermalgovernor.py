@@ -0,0 +1,199 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import mmap
+import time
+import struct
+from collections import defaultdict
+from .vizypowerboard import get_cpu_temp
+
+THERMAL_FILE = "/dev/shm/vizy_thermal"
+# time, budget, temperature, temperature slope (C/s)
+RECORD = struct.Struct("<dddd")
+# The CPU throttles at 80C.  We want to back off smoothly before that.
+BUDGET_TEMP_START = 72 # Celsius
+BUDGET_TEMP_END = 79
+# Fan has headroom if it isn't at max speed, so start backing off later.
+FAN_HEADROOM = 3 # Celsius
+BUDGET_MIN = 0.2
+# Look this far ahead using the temperature trend.
+HORIZON = 30 # seconds
+SLOPE_ATTEN = 0.1
+BUDGET_ATTEN = 0.25
+# Budget is considered stale (and ignored) after this long.
+MAX_AGE = 5 # seconds
+READ_PERIOD = 0.5 # seconds
+METRICS_PERIOD = 1 # seconds
+
+
+class ThermalGovernor:
+    """
+    Used by vizy-power-monitor to compute a thermal budget (BUDGET_MIN to 1.0)
+    from the CPU temperature trend and fan state and publish it for apps
+    (see ThermalBudget).
+    """
+    def __init__(self, filename=THERMAL_FILE):
+        with open(filename, 'wb') as f:
+            f.write(bytes(RECORD.size))
+        # Let apps read it.
+        os.chmod(filename, 0o644)
+        self.file = open(filename, 'r+b')
+        self.mmap = mmap.mmap(self.file.fileno(), RECORD.size)
+        self.temp = None
+        self.t = 0
+        self.slope = 0
+        self.budget = 1
+
+    def update(self, temp, fan, fan_max):
+        t = time.time()
+        if self.temp is not None and t>self.t:
+            slope = (temp-self.temp)/(t-self.t)
+            self.slope = SLOPE_ATTEN*slope + (1-SLOPE_ATTEN)*self.slope
+        self.temp, self.t = temp, t
+        # Only look ahead if temperature is rising.
+        predicted = temp + max(self.slope, 0)*HORIZON
+        start = BUDGET_TEMP_START if fan>=fan_max else BUDGET_TEMP_START+FAN_HEADROOM
+        start = min(start, BUDGET_TEMP_END-1)
+        budget = 1 - (predicted-start)/(BUDGET_TEMP_END-start)*(1-BUDGET_MIN)
+        budget = min(max(budget, BUDGET_MIN), 1)
+        # Back off quickly, recover slowly.
+        if budget<self.budget:
+            self.budget = budget
+        else:
+            self.budget = BUDGET_ATTEN*budget + (1-BUDGET_ATTEN)*self.budget
+        RECORD.pack_into(self.mmap, 0, t, self.budget, temp, self.slope)
+        return self.budget
+
+    def close(self):
+        # Don't leave a stale budget behind.
+        RECORD.pack_into(self.mmap, 0, 0, 1, 0, 0)
+        self.mmap.close()
+        self.file.close()
+
+
+class ThermalBudget:
+    """
+    Used by apps to follow the thermal budget published by vizy-power-monitor.
+    Wrap the detector with wrap(), which times each inference where it
+    actually runs (e.g. in KimageDetectorThread's thread, not where the
+    frame is submitted).  Call ready() once per frame before submitting --
+    it returns False when inference should be skipped so that the fraction
+    of time spent on inference follows the budget.
+
+        detector = self.thermal.wrap(detector_process)
+        detector = kritter.KimageDetectorThread(detector) # optional
+        ...
+        if self.thermal.ready():
+            dets = detector.detect(frame)
+
+    metrics() returns the sustained frame and (completed) inference rates
+    for each CPU temperature (1C buckets).
+    """
+    def __init__(self, filename=THERMAL_FILE):
+        self.filename = filename
+        self.mmap = None
+        self.budget_ = 1
+        self.temp = 0
+        self.read_time = 0
+        self.t0 = 0
+        self.t_end = 0
+        self.duration = 0
+        self.busy = False
+        self.frames = self.inferences = 0
+        self.metrics_t0 = time.time()
+        self.metrics_ = defaultdict(lambda: [0, 0, 0]) # time, frames, inferences
+
+    def _read(self):
+        if self.mmap is None:
+            with open(self.filename, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), RECORD.size, access=mmap.ACCESS_READ)
+        return RECORD.unpack_from(self.mmap, 0)
+
+    def budget(self):
+        """
+        Returns the current budget, 1.0 meaning no restriction.
+        """
+        t = time.time()
+        if t-self.read_time>READ_PERIOD:
+            self.read_time = t
+            try:
+                t_, budget, self.temp, _ = self._read()
+                if t-t_>MAX_AGE:
+                    raise ValueError
+                self.budget_ = budget
+            except (OSError, ValueError):
+                # vizy-power-monitor isn't publishing a budget.
+                self.budget_ = 1
+                try:
+                    self.temp = get_cpu_temp()
+                except:
+                    pass
+        return self.budget_
+
+    def ready(self):
+        budget = self.budget()
+        t = time.time()
+        self.frames += 1
+        self._update_metrics(t)
+        # Wait until the current inference is finished, and long enough
+        # after it so that inference takes up the budgeted fraction of the
+        # time.
+        if budget<1 and (self.busy or t-self.t_end<self.duration*(1/budget-1)):
+            return False
+        return True
+
+    def start(self):
+        self.t0 = time.time()
+        self.busy = True
+
+    def done(self):
+        self.t_end = time.time()
+        self.duration = self.t_end - self.t0
+        self.inferences += 1
+        self.busy = False
+
+    def wrap(self, detector):
+        """
+        Returns detector with its detect() timed by start() and done().
+        """
+        return _TimedDetector(self, detector)
+
+    def _update_metrics(self, t):
+        dt = t - self.metrics_t0
+        if dt>=METRICS_PERIOD:
+            m = self.metrics_[round(self.temp)]
+            m[0] += dt
+            m[1] += self.frames
+            m[2] += self.inferences
+            self.metrics_t0 = t
+            self.frames = self.inferences = 0
+
+    def metrics(self):
+        """
+        Returns dict of {temperature: (frames per second, inferences per second)}.
+        """
+        return {temp: (m[1]/m[0], m[2]/m[0]) for temp, m in sorted(self.metrics_.items()) if m[0]}
+
+
+class _TimedDetector:
+    def __init__(self, thermal, detector):
+        self.thermal = thermal
+        self.detector = detector
+
+    def detect(self, *args, **kwargs):
+        self.thermal.start()
+        try:
+            return self.detector.detect(*args, **kwargs)
+        finally:
+            self.thermal.done()
+
+    def __getattr__(self, name):
+        return getattr(self.detector, name)
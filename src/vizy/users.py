@@ -9,8 +9,14 @@
 #
 
 import os
+import time
+import hmac
 import hashlib
 import binascii
+import asyncio
+from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from kritter import ConfigFile, PMASK_MAX, PMASK_MIN
 
 def user(username, permissions, password=None):
@@ -29,10 +35,33 @@ DEFAULT_CONFIG['users'].update(user("guest", PMASK_MIN))
 # Admin has all permission bits set.
 DEFAULT_CONFIG['users'].update(user("admin", PMASK_MAX))
 
+HASH_ITERATIONS = 10000
+# Password hashing is slow on a Pi, so we limit how many hashes run at once.
+HASH_WORKERS = 2
+# Authorization results are cached (least recently used are evicted).
+CACHE_SIZE = 32
+CACHE_TTL = 300 # seconds
+# Check for changes to the users file at most this often.
+RELOAD_PERIOD = 1 # seconds
+# After this many failed attempts for a user from a given address within
+# FAIL_WINDOW, further attempts (from that address) are rejected without
+# checking the password until the window expires.  Throttling by address as well
+# as username means that someone else can't lock out admin.
+FAIL_LIMIT = 5
+FAIL_WINDOW = 60 # seconds
+# Maximum number of (address, username) pairs we keep track of.
+FAIL_ENTRIES = 256
+
 class Users(ConfigFile):
 
     def __init__(self, etcdir):
-        self.auth_cache = {}
+        self.lock = Lock()
+        self.auth_cache = OrderedDict()
+        # Cache keys are salted digests, so passwords aren't kept in memory.
+        self.cache_salt = os.urandom(16)
+        self.failures = OrderedDict()
+        self.reload_time = 0
+        self.pool = ThreadPoolExecutor(HASH_WORKERS)
         config_filename = os.path.join(etcdir, CONFIG_FILE)
         super().__init__(config_filename, DEFAULT_CONFIG)
 
@@ -51,37 +80,101 @@ class Users(ConfigFile):
         if save:
             self.save()
 
-    def authorize(self, username, password):
-        res = 0
-        up = username+password
-
-        # Make sure the password file hasn't changed.
-        if self.reload():
-            # If it has changed, flush the cache.
-            self.auth_cache = {}
-            
-        # Check auth_cache first and return if it's in there.
-        try:
-            res = self.auth_cache[up] 
-        except:
-            # Lazy way to bound cache size     
-            if len(self.auth_cache)>10: 
-                # BTW we're likely being attacked... 
-                self.auth_cache = {}
+    def _cache_key(self, username, password):
+        return hmac.new(self.cache_salt, f"{username}\0{password}".encode(), hashlib.sha256).digest()
 
-            # Verify password
+    def _throttled(self, fkey, t):
+        try:
+            failures = [f for f in self.failures[fkey] if t-f<FAIL_WINDOW]
+        except KeyError:
+            return False
+        if failures:
+            self.failures[fkey] = failures
+        else:
+            del self.failures[fkey]
+        return len(failures)>=FAIL_LIMIT
+
+    def _fail(self, fkey, t):
+        # We only need the most recent FAIL_LIMIT failures.
+        self.failures[fkey] = (self.failures.get(fkey, []) + [t])[-FAIL_LIMIT:]
+        self.failures.move_to_end(fkey)
+        # Entries are ordered by most recent failure, so sweep from the front.
+        while self.failures:
+            fkey0, failures = next(iter(self.failures.items()))
+            if t-failures[-1]<FAIL_WINDOW and len(self.failures)<=FAIL_ENTRIES:
+                break
+            del self.failures[fkey0]
+
+    def _lookup(self, username, password, address):
+        # Returns (permissions, key), where permissions is None if the result isn't cached
+        # (or 0 if the user is throttled).
+        t = time.time()
+        key = self._cache_key(username, password)
+        with self.lock:
+            # Make sure the password file hasn't changed, but don't stat it every time.
+            if t-self.reload_time>RELOAD_PERIOD:
+                self.reload_time = t
+                if self.reload():
+                    # If it has changed, flush the cache.
+                    self.auth_cache.clear()
             try:
-                info = self.config['users'][username]
-                if Users.verify_password(password, info['password']):
-                    res = info['permissions']
-            except:
+                res, t0 = self.auth_cache[key]
+                if t-t0<CACHE_TTL:
+                    self.auth_cache.move_to_end(key)
+                    return res, key
+                del self.auth_cache[key]
+            except KeyError:
                 pass
+            # BTW we're likely being attacked... 
+            if self._throttled((address, username), t):
+                return 0, key
+        return None, key
 
+    def _verify(self, username, password, address, key):
+        res = 0
+        try:
+            info = self.config['users'][username]
+            if Users.verify_password(password, info['password']):
+                res = info['permissions']
+        except:
+            pass
+        with self.lock:
+            if res:
+                self.failures.pop((address, username), None)
+            else:
+                self._fail((address, username), time.time())
             # Cache result regardless
-            self.auth_cache[up] = res
-
+            self.auth_cache[key] = res, time.time()
+            while len(self.auth_cache)>CACHE_SIZE:
+                self.auth_cache.popitem(last=False)
         return res
 
+    def authorize(self, username, password, address=None):
+        """
+        Returns the user's permissions, or 0 if the password is wrong.  address
+        is the client's address (if known), which failed attempts are
+        throttled by.
+        """
+        res, key = self._lookup(username, password, address)
+        if res is not None:
+            return res
+        # Hash in the worker pool so that no more than HASH_WORKERS logins hash at once.
+        return self.pool.submit(self._verify, username, password, address, key).result()
+
+    async def authorize_async(self, username, password, address=None):
+        """
+        Same as authorize(), but doesn't block the event loop while the
+        password is hashed.
+        """
+        res, key = self._lookup(username, password, address)
+        if res is not None:
+            return res
+        return await asyncio.get_event_loop().run_in_executor(self.pool, self._verify, username, password, address, key)
+
+    def flush_cache(self):
+        with self.lock:
+            self.auth_cache.clear()
+
     def add_change_user(self, username, permissions, password):
         if password is None:
             try:
@@ -93,6 +186,7 @@ class Users(ConfigFile):
 
         self.config['users'].update(user(username, permissions, password))
         self.save()
+        self.flush_cache()
 
     def remove_user(self, username):
         try:
@@ -100,6 +194,7 @@ class Users(ConfigFile):
             self.save()
         except:
             pass
+        self.flush_cache()
 
     @staticmethod
     def hash_password(password, salt=None):
@@ -109,10 +204,10 @@ class Users(ConfigFile):
         password += salt
         # Generating a secure and timely hash on a Raspberry Pi is difficult 
         # (dklen=10000), but this should be fine.
-        hashed = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 10000).hex().upper()
+        hashed = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), HASH_ITERATIONS).hex().upper()
         return f"{hashed}:{salt}"
 
     @staticmethod
     def verify_password(password, hash_string):
         salt = hash_string.split(":")[1]
-        return Users.hash_password(password, salt)==hash_string
+        return hmac.compare_digest(Users.hash_password(password, salt), hash_string)
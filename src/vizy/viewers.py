@@ -0,0 +1,90 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+import os
+import time
+from threading import Lock
+from kritter import Kritter
+
+# Keep rendering this long after the last browser disconnects, so reloading
+# the page doesn't leave it without video.
+LINGER = 2 # seconds
+# Set VIZY_ALWAYS_RENDER=1 to render as if someone is always watching (e.g.
+# to measure what the fast path saves).
+ALWAYS_RENDER_ENV = "VIZY_ALWAYS_RENDER"
+
+
+class Viewers:
+    """
+    Keeps track of whether anyone is watching the app, so the frame path
+    can skip work nobody will see -- encoding frames (Kvideo.push_frame()),
+    rendering overlays and pushing overlay mods -- while detection,
+    recording and events keep running:
+
+        self.viewers = Viewers(self.kapp)
+        ...
+        if self.viewers.watching(self.video):
+            self.video.push_frame(image)
+
+    A Kvideo that isn't displayed (e.g. it's on another tab) can be marked
+    with set_visible(video, False), and watching(video) then returns False
+    for it even with browsers connected.
+    """
+    def __init__(self, kapp=None, linger=LINGER):
+        self.kapp = Kritter.kapp if kapp is None else kapp
+        self.linger = linger
+        self.always = os.getenv(ALWAYS_RENDER_ENV, "0")!="0"
+        self.lock = Lock()
+        self.clients = set()
+        self.t_left = 0
+        self.hidden = set()
+        self.watched = self.unwatched = 0
+
+        @self.kapp.callback_connect
+        def func(client, connect):
+            with self.lock:
+                if connect:
+                    self.clients.add(client)
+                else:
+                    self.clients.discard(client)
+                    if not self.clients:
+                        self.t_left = time.time()
+
+    def present(self):
+        """
+        Returns True if there are browsers connected.
+        """
+        return self.always or bool(self.clients) or time.time()-self.t_left<self.linger
+
+    def watching(self, video=None):
+        """
+        Returns True if there are browsers connected, and video (a Kvideo)
+        is visible, if given.  Also counts the calls for stats().
+        """
+        res = self.present() and (video is None or video.id not in self.hidden or self.always)
+        if res:
+            self.watched += 1
+        else:
+            self.unwatched += 1
+        return res
+
+    def set_visible(self, video, visible):
+        with self.lock:
+            if visible:
+                self.hidden.discard(video.id)
+            else:
+                self.hidden.add(video.id)
+
+    def stats(self):
+        """
+        Returns dict with the number of browsers connected and the number of
+        watching() calls with and without anyone watching.
+        """
+        return dict(clients=len(self.clients), watched=self.watched, unwatched=self.unwatched)
@@ -9,16 +9,36 @@
 #
 
 import os
-from kritter import Kritter, ConfigFile, Klogin, MEDIA_DIR
+import quart
+import kritter
+from kritter import Kritter, ConfigFile, Klogin, MEDIA_DIR, PORT
 from .vizypowerboard import VizyPowerBoard
+from .powerboardbroker import VizyPowerBoardProxy, BROKER_SOCKET
 from .users import Users 
+from .supervisor import notify_ready, READY_SOCKET_ENV
+from .settings import VIZY_HOME, ETCDIR_NAME, APPSDIR_NAME, EXAMPLESDIR_NAME, SCRIPTSDIR_NAME, CONFIG_FILE, DEFAULT_CONFIG, dirs
+from .simcamera import CAMERA_ENV
+
+_Camera = kritter.Camera
+
+def setup_env():
+    """
+    Swaps in the simulated camera if VIZY_CAMERA is set, so apps run
+    unmodified without Vizy's hardware (see simcamera.py).  Apps import vizy
+    before they create their camera.  This runs on import, and again in app
+    processes forked from the zygote (see zygote.py).
+    """
+    if os.getenv(CAMERA_ENV):
+        from .simcamera import SimCamera
+        kritter.Camera = SimCamera
+    else:
+        kritter.Camera = _Camera
+
+setup_env()
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
-VIZY_HOME = "VIZY_HOME"
-ETCDIR_NAME = 'etc'
-APPSDIR_NAME = 'apps'
-EXAMPLESDIR_NAME = 'examples'
-SCRIPTSDIR_NAME = 'scripts'
+# Where login.html posts to
+LOGIN_PATH = "/login"
 
 VIZY_STYLE = '''
 .side-button {
@@ -44,54 +64,6 @@ html, body, #react-entry-point, #_main {
 }
 '''
 
-CONFIG_FILE = "vizy_main.json"
-DEFAULT_CONFIG = {
-    "software": {
-        "update server": "https://vizycam.com/sd",
-        "channel": "vizy_main",
-        "start-up app": None,
-        "start-up example": "video",
-        "maximum logins": 3
-    }, 
-    "hardware": {
-        "power board": {
-            "PCB type": "rpi_main",
-            "firmware type": "main"
-        },
-        "camera": {
-            "type": "Sony IMX477 12.3 megapixel",
-            "IR-cut": "switchable",
-            "version": "1.0"
-        },
-        "coprocessor": None 
-    }
-}
-
-
-def dirs(num):
-    homedir = os.getenv(VIZY_HOME)
-    if homedir is None:
-        raise RuntimeError("VIZY_HOME environment variable should be set to the directory where Vizy software is installed.")
-    if not os.path.exists(homedir):
-        raise RuntimeError("VIZY_HOME directory doesn't exist!")
-    uid = os.stat(homedir).st_uid
-    gid = os.stat(homedir).st_gid
-    etcdir = os.path.join(homedir, ETCDIR_NAME)
-    if not os.path.exists(etcdir):
-        os.mkdir(etcdir)
-        os.chown(etcdir, uid, gid)
-    appsdir = os.path.join(homedir, APPSDIR_NAME)
-    if not os.path.exists(appsdir):
-        os.mkdir(appsdir)
-        os.chown(appsdir, uid, gid)
-    examplesdir = os.path.join(homedir, EXAMPLESDIR_NAME)
-    if not os.path.exists(examplesdir):
-        os.mkdir(examplesdir)
-        os.chown(examplesdir, uid, gid)
-
-    result = homedir, etcdir, appsdir, examplesdir
-    return result[0:num]
-
 
 class VizyConfig(ConfigFile):
 
@@ -105,8 +77,24 @@ class VizyLogin(Klogin):
     def __init__(self, kapp):
         super().__init__(kapp, os.path.join(BASE_DIR, "login"), kapp.users.config['secret'])
 
+        self.users = kapp.users
         # Override authorize function with ours
-        self.authorize_func = kapp.users.authorize
+        self.authorize_func = self._authorize
+
+        # Klogin's handler calls authorize_func synchronously, which would block
+        # the event loop (and every other client) while the password is hashed.
+        # So we check the password asynchronously first -- the result is cached,
+        # so when Klogin calls _authorize() it returns right away.
+        @kapp.server.before_request
+        async def check_login():
+            if quart.request.method=="POST" and quart.request.path==LOGIN_PATH:
+                form = await quart.request.form
+                if "username" in form and "password" in form:
+                    await self.users.authorize_async(form['username'], form['password'], quart.request.remote_addr)
+
+    def _authorize(self, username, password):
+        address = quart.request.remote_addr if quart.has_request_context() else None
+        return self.users.authorize(username, password, address)
 
 
 class Vizy(Kritter):
@@ -118,17 +106,33 @@ class Vizy(Kritter):
         self.homedir, self.etcdir, self.appsdir, self.examplesdir = dirs(4)
         self.vizy_config = VizyConfig(self.etcdir)
         self.users = Users(self.etcdir)
+        # Set if we were started by AppsDialog
+        self.ready_socket = os.getenv(READY_SOCKET_ENV)
 
         # Add our own media path
         self.media_path.insert(0, os.path.join(BASE_DIR, MEDIA_DIR))
 
-        # Instantiate power board
-        self.power_board = VizyPowerBoard()
+        # Instantiate power board, go through vizy-power-monitor's broker if enabled.
+        self.power_board = None
+        if self.vizy_config['software'].get('power board broker') and os.path.exists(BROKER_SOCKET):
+            try:
+                self.power_board = VizyPowerBoardProxy()
+            except OSError as e:
+                # The socket may be left over from a broker that's no longer running.
+                print(f"Unable to connect to power board broker ({e}), accessing power board directly")
+        if self.power_board is None:
+            self.power_board = VizyPowerBoard()
         self.uuid = self.power_board.uuid()
 
         # Create login
         self.login = VizyLogin(self)
 
+    def run(self, *args, **kwargs):
+        # Let AppsDialog know as soon as we're listening (if it started us).
+        if self.ready_socket:
+            notify_ready(PORT, self.ready_socket)
+        super().run(*args, **kwargs)
+
     @property
     def style(self):
         return self.__style
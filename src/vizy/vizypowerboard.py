@@ -26,11 +26,16 @@ with the Vizy camera.
 More information 
 about Vizy can be found [here](https://vizycam.com).
 """    
-import smbus
-import wiringpi as wp
+try:
+    import smbus
+    import wiringpi as wp
+except ImportError: # off-hardware, e.g. when used with FakeBus
+    smbus = wp = None
 import time
 import datetime
 import os
+import threading
+import queue
 from functools import wraps
 
 COMPAT_HW_VERSION = [3, 0]
@@ -49,6 +54,27 @@ EXEC_DA = 3
 EXEC_RTC = 16
 EXEC_RTC_CALIBRATE = 17
 
+# Contiguous status/IO register range read in one transfer in snapshot mode:
+# button (47), vcc (48), LED (49-57), LED background (58-60), buzzer (61-67),
+# IO modes (68-71), IO bits (72), IR filter (73) and fan (75).
+SNAPSHOT_OFFSET = 47
+SNAPSHOT_LEN = 29
+
+# Set VIZY_POWER_BOARD=fake to use an in-memory power board (vizy.fakebus)
+# instead of I2C, e.g. for running apps without hardware.
+POWER_BOARD_ENV = "VIZY_POWER_BOARD"
+POWER_BOARD_FAKE = "fake"
+
+EVENT_POLL_PERIOD = 0.05 # seconds
+EVENT_QUEUE_SIZE = 100
+IO_BITS = 4
+EVENT_BUTTON = "button"
+"""Used with `VizyPowerBoard.subscribe()`."""
+EVENT_IO = "io"
+"""Used with `VizyPowerBoard.subscribe()`."""
+EVENT_POWER_OFF = "power_off"
+"""Used with `VizyPowerBoard.subscribe()`."""
+
 IO_MODE_INPUT = 0
 """Used with `VizyPowerBoard.io_set_mode()`."""
 IO_MODE_OUTPUT = 0x80 
@@ -141,22 +167,49 @@ class VizyPowerBoard:
     User programs can also instantiate this class and
     use its methods simultaneously.
     """    
-    def __init__(self, addr=0x14, bus=1, check_hwver=True):
+    def __init__(self, addr=0x14, bus=1, check_hwver=True, snapshot=None):
         """
         Args:
           addr (integer, optional, default=0x14): I2C address of the board
-          bus (integer, optional, default=1): the I2C bus number 
+          bus (integer, optional, default=1): the I2C bus number, or an 
+            object with the same block read/write methods as `smbus.SMBus`,
+            e.g. `vizy.fakebus.FakeBus` for running without hardware.  If
+            the VIZY_POWER_BOARD environment variable is set to "fake", a
+            shared FakeBus is used in place of the I2C bus.
+          snapshot (float, optional, default=None): if specified, enables
+            snapshot mode with the given time-to-live (in seconds).  See
+            `VizyPowerBoard.snapshot()`.
 
         """    
+        if isinstance(bus, int) and os.getenv(POWER_BOARD_ENV)==POWER_BOARD_FAKE:
+            from .fakebus import get_fake_bus
+            bus = get_fake_bus()
         # We need to lock here because it can affect other process' read operations.
-        self.bus = smbus.SMBus(bus)
+        if isinstance(bus, int):
+            self.bus = smbus.SMBus(bus)
+            self.gpio = True
+        else:
+            self.bus = bus
+            self.gpio = False
         self.addr = addr
         self.connected = True
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_ttl = None
+        self.snapshot_data = None
+        self.snapshot_time = 0
+        self.i2c_transactions = 0
+        self.i2c_rate_t0 = time.time()
+        self.i2c_rate_count0 = 0
+        self.i2c_rate_ = 0
+        self.subscribers = []
+        self.event_thread = None
+        self.snapshot(snapshot)
         if check_hwver:
             hwv = self.hw_version()
             if hwv!=COMPAT_HW_VERSION:
                 raise RuntimeError("The hardware version of your Vizy Power Board (" + str(hwv[0])+'.'+str(hwv[1]) + ") is incompatible with this software file (" + str(COMPAT_HW_VERSION[0])+'.'+str(COMPAT_HW_VERSION[1]) + ").")
-        wp.wiringPiSetupPhys()
+        if self.gpio:
+            wp.wiringPiSetupPhys()
 
     @staticmethod
     def _bcd2decimal(bcd):
@@ -199,11 +252,186 @@ class VizyPowerBoard:
             return 0
         return i
 
+    def _read(self, offset, length):
+        if self.snapshot_ttl and offset>=SNAPSHOT_OFFSET and offset+length<=SNAPSHOT_OFFSET+SNAPSHOT_LEN:
+            with self.snapshot_lock:
+                t = time.time()
+                if self.snapshot_data is None or t-self.snapshot_time>self.snapshot_ttl:
+                    self.i2c_transactions += 1
+                    self.snapshot_data = self.bus.read_i2c_block_data(self.addr, SNAPSHOT_OFFSET, SNAPSHOT_LEN)
+                    self.snapshot_time = t
+                offset -= SNAPSHOT_OFFSET
+                return self.snapshot_data[offset:offset+length]
+        self.i2c_transactions += 1
+        return self.bus.read_i2c_block_data(self.addr, offset, length)
+
+    def _write(self, offset, data):
+        self.invalidate()
+        self.i2c_transactions += 1
+        self.bus.write_i2c_block_data(self.addr, offset, data)
+
+    def snapshot(self, ttl=None):
+        """
+        Enables or disables snapshot mode.  In snapshot mode the status and IO
+        registers (button, vcc12/vcc5, LED background, IO modes, IO bits, 
+        IR filter and fan) are read from the Vizy Power Board in a single
+        block transfer and the results are cached for `ttl` seconds.  Getters
+        such as `VizyPowerBoard.button()` and `VizyPowerBoard.io_get_bit()`
+        are served from the cached snapshot until it expires, which greatly
+        reduces I2C traffic when these getters are called for every frame.  
+        Any write through this object invalidates the snapshot.   
+
+            v = VizyPowerBoard(snapshot=0.05) # enable snapshot mode, 50ms time-to-live
+            v.snapshot(0.1) # change time-to-live to 100ms
+            v.snapshot() # disable snapshot mode
+
+        Note, writes made by other processes (or other `VizyPowerBoard` 
+        objects) are not seen until the snapshot expires, so choose a `ttl`
+        that is shorter than the latency your application can tolerate.
+
+        Args:
+          ttl (float, optional, default=None): time-to-live of the snapshot
+            in seconds.  `None` or 0 disables snapshot mode.
+        """
+        with self.snapshot_lock:
+            self.snapshot_ttl = ttl
+            self.snapshot_data = None
+
+    def invalidate(self):
+        """
+        Discards the current snapshot (if any) so that the next getter call 
+        reads the registers from the Vizy Power Board.  This is called 
+        automatically for every write.  See `VizyPowerBoard.snapshot()`.
+        """
+        self.snapshot_data = None
+
+    def i2c_rate(self):
+        """
+        Returns the number of I2C transactions per second issued by this 
+        object, averaged since the previous call (updated at most once per
+        second).  The total number of transactions is available in the
+        `i2c_transactions` attribute.  This is useful for measuring the I2C
+        traffic your program generates, e.g. with and without snapshot mode.
+        """
+        t = time.time()
+        if t-self.i2c_rate_t0>=1:
+            self.i2c_rate_ = (self.i2c_transactions-self.i2c_rate_count0)/(t-self.i2c_rate_t0)
+            self.i2c_rate_t0 = t
+            self.i2c_rate_count0 = self.i2c_transactions
+        return self.i2c_rate_
+
+    def subscribe(self, callback=None, types=None, period=EVENT_POLL_PERIOD):
+        """
+        Subscribes to button, IO and power-off events so that your program 
+        doesn't need to poll.  A single background thread reads the status
+        and IO registers (in one block transfer) every `period` seconds and
+        reports changes, so events are delivered within `period` seconds and
+        your frame loop does no I2C work.  Events are dicts, for example:
+
+            {"type": "button", "state": True, "edge": "rising", "time": 1650000000.0}
+            {"type": "io", "bit": 0, "state": False, "edge": "falling", "time": 1650000000.0}
+            {"type": "power_off", "state": True, "edge": "rising", "time": 1650000000.0}
+
+        If `callback` is specified, it's called with each event from the 
+        background thread.  Otherwise a queue is returned that receives the
+        events (oldest events are discarded if the queue isn't serviced).
+
+            def handle_event(event):
+                if event['type']=="button" and event['state']:
+                    print("button pressed")
+            v.subscribe(handle_event, [EVENT_BUTTON])
+            q = v.subscribe(types=[EVENT_IO])
+            event = q.get()
+
+        Args:
+          callback (function, optional, default=None): function to call 
+            with each event.
+          types (list, optional, default=None): list of event types to
+            receive, any of EVENT_BUTTON, EVENT_IO and EVENT_POWER_OFF.
+            `None` receives button and IO events.
+          period (float, optional, default=0.05): polling period in seconds,
+            i.e. the maximum event latency.  The shortest period of all
+            subscribers is used.
+
+        Returns:
+          The subscriber, which is `callback` or the queue.  Pass it to
+          `VizyPowerBoard.unsubscribe()` to stop receiving events.
+        """
+        if types is None:
+            types = [EVENT_BUTTON, EVENT_IO]
+        subscriber = callback if callback else queue.Queue(EVENT_QUEUE_SIZE)
+        self.subscribers.append((subscriber, types, period))
+        if self.event_thread is None or not self.event_thread.is_alive():
+            self.event_thread = threading.Thread(target=self._event_thread, daemon=True)
+            self.event_thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        Stops sending events to the given subscriber (callback or queue) 
+        returned by `VizyPowerBoard.subscribe()`.  The background thread
+        exits when there are no more subscribers.
+        """
+        self.subscribers = [s for s in self.subscribers if s[0]!=subscriber]
+
+    def _publish(self, event):
+        for subscriber, types, _ in self.subscribers:
+            if event['type'] not in types:
+                continue
+            if isinstance(subscriber, queue.Queue):
+                if subscriber.full():
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+                subscriber.put_nowait(event)
+            else:
+                try:
+                    subscriber(event)
+                except Exception as e:
+                    print("Exception in power board event callback:", e)
+
+    def _event_thread(self):
+        state = {}
+        while self.subscribers:
+            subscribers = self.subscribers
+            time.sleep(min([s[2] for s in subscribers]))
+            types = set().union(*[s[1] for s in subscribers])
+            if not self.connected:
+                continue
+            _state = {}
+            try:
+                if EVENT_BUTTON in types or EVENT_IO in types:
+                    with self.snapshot_lock:
+                        self.i2c_transactions += 1
+                        regs = self.bus.read_i2c_block_data(self.addr, SNAPSHOT_OFFSET, SNAPSHOT_LEN)
+                        # Refresh the snapshot while we're at it.
+                        if self.snapshot_ttl:
+                            self.snapshot_data, self.snapshot_time = regs, time.time()
+                    _state[EVENT_BUTTON] = bool(regs[47-SNAPSHOT_OFFSET]&0x02)
+                    for bit in range(IO_BITS):
+                        _state[(EVENT_IO, bit)] = bool(regs[72-SNAPSHOT_OFFSET]&(1<<bit))
+                if EVENT_POWER_OFF in types:
+                    _state[EVENT_POWER_OFF] = self._read(38, 1)[0]==0x0f
+            except:
+                # Bus hiccup, try again next period.
+                continue
+            t = time.time()
+            for key, val in _state.items():
+                # The first reading establishes the state, except for power-off requests.
+                prev = state.get(key, False if key==EVENT_POWER_OFF else val)
+                if val!=prev:
+                    event = {"type": key[0], "bit": key[1]} if isinstance(key, tuple) else {"type": key}
+                    event.update({"state": val, "edge": "rising" if val else "falling", "time": t})
+                    self._publish(event)
+            state.update(_state)
+        self.event_thread = None
+
     def _status(self):
-        return self.bus.read_i2c_block_data(self.addr, 0, 1)[0]
+        return self._read(0, 1)[0]
 
     def _status_exec(self):
-        return self.bus.read_i2c_block_data(self.addr, EXEC_OFFSET, 1)[0]
+        return self._read(EXEC_OFFSET, 1)[0]
 
     def _grab_semaphore(self):
         count = 0
@@ -218,7 +446,7 @@ class VizyPowerBoard:
             count += 1
 
     def _release_semaphore(self):
-        self.bus.write_i2c_block_data(self.addr, EXEC_OFFSET, [EXEC_SEMAPHORE])
+        self._write(EXEC_OFFSET, [EXEC_SEMAPHORE])
         # Give other processes some time to grab semaphore.
         time.sleep(0.001)
 
@@ -231,7 +459,7 @@ class VizyPowerBoard:
         """
         Returns the major and minor versions of the PCB as a 2-item list.
         """ 
-        return self.bus.read_i2c_block_data(self.addr, 1, 2)
+        return self._read(1, 2)
 
     @check([0, 0, 0])
     def fw_version(self):
@@ -239,7 +467,7 @@ class VizyPowerBoard:
         Returns the major, minor and build versions of the firmware as 
         a 3-item list.
         """ 
-        return self.bus.read_i2c_block_data(self.addr, 3, 3)
+        return self._read(3, 3)
 
     @check('')
     def resource_url(self):
@@ -248,7 +476,7 @@ class VizyPowerBoard:
         resources, such as the location of the latest version of this code, 
         latest firmware, etc.
         """
-        chars = self.bus.read_i2c_block_data(self.addr, 6, 32)
+        chars = self._read(6, 32)
         s = ''
         for c in chars:
             if c==0: # read up to the null character
@@ -263,7 +491,7 @@ class VizyPowerBoard:
         ID for your Vizy camera.  This unique ID is stored on the Vizy Power
         Board and remains constant regardless of firmware upgrades, etc.
         """
-        return self.bus.read_i2c_block_data(self.addr, 22, 16)
+        return self._read(22, 16)
 
     @check()    
     def power_off_requested(self, req=None):
@@ -278,7 +506,7 @@ class VizyPowerBoard:
         This is used by the vizy-power-monitor service. 
         """
         if req is None:
-            button = self.bus.read_i2c_block_data(self.addr, 38, 1)
+            button = self._read(38, 1)
             if button[0]==0x0f:
                 return True
             else:
@@ -286,7 +514,7 @@ class VizyPowerBoard:
         # Initiate power down as if we pressed the button
         elif req:
             self.buzzer(250, 500)
-            self.bus.write_i2c_block_data(self.addr, 38, [0x0f])
+            self._write(38, [0x0f])
 
     @check()
     def power_off(self, t=5000):
@@ -295,7 +523,7 @@ class VizyPowerBoard:
         to wait before turning off (specified in milliseconds).  The 
         vizy-power-monitor service calls this upon shutdown.
         """
-        self.bus.write_i2c_block_data(self.addr, 38, [0x1f, int(t/100)])
+        self._write(38, [0x1f, int(t/100)])
 
     @check(0)
     def boot_mode(self):
@@ -313,7 +541,7 @@ class VizyPowerBoard:
 
         See `VizyPowerBoard.dip_switches()` for more information about boot mode selection. 
         """
-        return self.bus.read_i2c_block_data(self.addr, 38, 1)[0]
+        return self._read(38, 1)[0]
 
     @check()
     def power_on_alarm_date(self, datetime_=None):
@@ -351,12 +579,12 @@ class VizyPowerBoard:
           power, Vizy will turn on as soon as it receives power.  
         """
         if datetime_ is None:
-            t = self.bus.read_i2c_block_data(self.addr, 41, 6)
+            t = self._read(41, 6)
             if t[5]==0:
                 return None
             return datetime.datetime(year=self._bcd2decimal(t[5])+2016, month=self._bcd2decimal(t[4]), day=self._bcd2decimal(t[3]), hour=self._bcd2decimal(t[2]), minute=self._bcd2decimal(t[1]), second=self._bcd2decimal(t[0]))
         t = [self._decimal2bcd(datetime_.second), self._decimal2bcd(datetime_.minute), self._decimal2bcd(datetime_.hour), self._decimal2bcd(datetime_.day), self._decimal2bcd(datetime_.month), self._decimal2bcd(datetime_.year-2016)]
-        self.bus.write_i2c_block_data(self.addr, 41, t)
+        self._write(41, t)
     
 
     @check()
@@ -403,7 +631,7 @@ class VizyPowerBoard:
         * POWER_ON_SOURCE_5V, indicates that Vizy was powered on by applying
         power to the Raspberry Pi's USB-C power input.
         """
-        source = self.bus.read_i2c_block_data(self.addr, 40, 1)[0]
+        source = self._read(40, 1)[0]
         return source
 
     @check(False)
@@ -411,7 +639,7 @@ class VizyPowerBoard:
         """
         Returns `True` if the button is being pressed currently, `False` otherwise.
         """
-        button = self.bus.read_i2c_block_data(self.addr, 47, 1)
+        button = self._read(47, 1)
         if button[0]&0x02:
             return True
         else:
@@ -425,10 +653,10 @@ class VizyPowerBoard:
         slow, as button presses are not missed (as long as you check at least
         every 5 seconds!)
         """
-        button = self.bus.read_i2c_block_data(self.addr, 47, 1)
+        button = self._read(47, 1)
         if button[0]&0x01:
             # Reset bit
-            self.bus.write_i2c_block_data(self.addr, 47, [0])
+            self._write(47, [0])
             return True
         else:
             return False
@@ -439,7 +667,7 @@ class VizyPowerBoard:
         If `state` is `True`, the 12V output on Vizy's I/O connector (pin 2) will be enabled and output 12V.  If `state` is `False`, the 12V output
         will be disabled.  Calling without arguments returns its current state.
         """ 
-        config = self.bus.read_i2c_block_data(self.addr, 48, 1)[0]
+        config = self._read(48, 1)[0]
         if state is None:
             return True if config&0x01 else False
         if state:
@@ -447,7 +675,7 @@ class VizyPowerBoard:
         else:
             config &= ~0x01
 
-        self.bus.write_i2c_block_data(self.addr, 48, [config])
+        self._write(48, [config])
 
     @check(False)
     def vcc5(self, state=None):
@@ -456,7 +684,7 @@ class VizyPowerBoard:
         be enabled and output 5V.  If `state` is `False`, the 5V output will be
         disabled.  Calling without arguments returns its current state.
         """ 
-        config = self.bus.read_i2c_block_data(self.addr, 48, 1)[0]
+        config = self._read(48, 1)[0]
         if state is None:
             return True if config&0x02 else False
         if state:
@@ -464,7 +692,7 @@ class VizyPowerBoard:
         else:
             config &= ~0x02
 
-        self.bus.write_i2c_block_data(self.addr, 48, [config])
+        self._write(48, [config])
 
     @check()
     def led(self, r=0, g=0, b=0, flashes=0, repeat=False, atten=255, on=100, off=100, pause=200):
@@ -512,7 +740,7 @@ class VizyPowerBoard:
             mode = 0x02
         else:
             mode = 0x01
-        self.bus.write_i2c_block_data(self.addr, 49, [mode, self._u_int8(r), self._u_int8(g), self._u_int8(b),
+        self._write(49, [mode, self._u_int8(r), self._u_int8(g), self._u_int8(b),
             on, off, self._u_int8(flashes), pause, self._u_int8(atten)])
 
     @check()
@@ -530,7 +758,7 @@ class VizyPowerBoard:
 
         on = self._u_int8(10 + (10-speed)*140/10)
         atten = self._u_int8(3 + speed*47/10)    
-        self.bus.write_i2c_block_data(self.addr, 49, [0x08, 0, 0, 0, on, 0, 0, 0, atten])
+        self._write(49, [0x08, 0, 0, 0, on, 0, 0, 0, atten])
 
     @check()
     def led_background(self, r=-1, g=-1, b=-1):
@@ -549,8 +777,8 @@ class VizyPowerBoard:
             led(0, 0, 0)  # turn LED off, and restore background color (yellow as set previously)    
         """
         if r==-1:
-            return self.bus.read_i2c_block_data(self.addr, 58, 3)
-        self.bus.write_i2c_block_data(self.addr, 58, [self._u_int8(r), self._u_int8(g), self._u_int8(b)])
+            return self._read(58, 3)
+        self._write(58, [self._u_int8(r), self._u_int8(g), self._u_int8(b)])
  
 
     @check()
@@ -577,7 +805,7 @@ class VizyPowerBoard:
         freq = self._uint16(freq)
         f0 = freq&0xff
         f1 = (freq>>8)&0xff
-        self.bus.write_i2c_block_data(self.addr, 61, [0, f0, f1, self._u_int8(on/10), self._u_int8(off/10), 
+        self._write(61, [0, f0, f1, self._u_int8(on/10), self._u_int8(off/10), 
             self._u_int8(count), self._int8(shift)])
 
     @check()
@@ -609,10 +837,10 @@ class VizyPowerBoard:
         makes it serial RX input.     
         """
         if mode is None:
-            return self.bus.read_i2c_block_data(self.addr, 68+bit, 1)[0]
+            return self._read(68+bit, 1)[0]
         if (bit==0 or bit==1) and mode==IO_MODE_SERIAL:
             raise RuntimeError("Only bits 2 and 3 can be set IO_MODE_SERIAL")
-        elif bit==2:
+        elif bit==2 and self.gpio:
             if mode==IO_MODE_SERIAL:
                 # set ALT5 mode (serial TX output)
                 wp.pinModeAlt(8, 2) 
@@ -620,7 +848,7 @@ class VizyPowerBoard:
             else:
                 # set pin 8 (UART TXD) as input so it doesn't conflict
                 wp.pinMode(8, 0)
-        elif bit==3:
+        elif bit==3 and self.gpio:
             if mode==IO_MODE_SERIAL:
                 # set ALT5 mode (serial input)
                 wp.pinModeAlt(10, 2) 
@@ -629,7 +857,7 @@ class VizyPowerBoard:
                 # set pin 10 (UART RX) as input so it doesn't receive garbage
                 wp.pinMode(19, 0)
 
-        self.bus.write_i2c_block_data(self.addr, 68+bit, [self._u_int8(mode)])
+        self._write(68+bit, [self._u_int8(mode)])
 
     @check(0)
     def io_bits(self, bits=None):
@@ -646,8 +874,8 @@ class VizyPowerBoard:
             io_bits(io_bits()|1)  # set IO bit 0 to logic 1, leave bits 1, 2, 3 unchanged. 
         """
         if bits is None:
-            return self.bus.read_i2c_block_data(self.addr, 72, 1)[0]
-        self.bus.write_i2c_block_data(self.addr, 72, [bits])
+            return self._read(72, 1)[0]
+        self._write(72, [bits])
 
     @check()
     def io_set_bit(self, bit):
@@ -697,11 +925,11 @@ class VizyPowerBoard:
         filter.
         """
         if state is None:
-            return True if self.bus.read_i2c_block_data(self.addr, 73, 1)[0] else False
+            return True if self._read(73, 1)[0] else False
         data = [1] if state else [0]
         if duration is not None:
             data.append(int(duration/10))
-        self.bus.write_i2c_block_data(self.addr, 73, data)
+        self._write(73, data)
 
     @check(0)
     def fan(self, speed=None):
@@ -713,8 +941,8 @@ class VizyPowerBoard:
         Calling this method without arguments returns the current fan speed.  
         """
         if speed is None:
-            return self.bus.read_i2c_block_data(self.addr, 75, 1)[0]
-        self.bus.write_i2c_block_data(self.addr, 75, [self._u_int8(speed)])
+            return self._read(75, 1)[0]
+        self._write(75, [self._u_int8(speed)])
        
 
     @check(datetime.datetime.now())
@@ -740,23 +968,23 @@ class VizyPowerBoard:
         if datetime_ is None:
             # Initiate RTC retrieval.
             self._grab_semaphore()
-            self.bus.write_i2c_block_data(self.addr, EXEC_OFFSET, [EXEC_RTC])
+            self._write(EXEC_OFFSET, [EXEC_RTC])
             # Wait until it's ready.
             self._wait_until_not_busy()
-            t = self.bus.read_i2c_block_data(self.addr, EXEC_OFFSET+1, 8)
+            t = self._read(EXEC_OFFSET+1, 8)
             self._release_semaphore()
             try:
                 return datetime.datetime(year=self._bcd2decimal(t[7])+2016, month=self._bcd2decimal(t[6]), day=self._bcd2decimal(t[4]), hour=self._bcd2decimal(t[3]), minute=self._bcd2decimal(t[2]), second=self._bcd2decimal(t[1]))
             except:
                 print(t)
-                t = self.bus.read_i2c_block_data(self.addr, EXEC_OFFSET+1, 8)
+                t = self._read(EXEC_OFFSET+1, 8)
                 print(t)
                 raise Exception
 
  
         t = [EXEC_RTC|EXEC_WRITE, 0, self._decimal2bcd(datetime_.second), self._decimal2bcd(datetime_.minute), self._decimal2bcd(datetime_.hour), self._decimal2bcd(datetime_.day), 0, self._decimal2bcd(datetime_.month), self._decimal2bcd(datetime_.year-2016)]
         self._grab_semaphore()
-        self.bus.write_i2c_block_data(self.addr, EXEC_OFFSET, t)
+        self._write(EXEC_OFFSET, t)
         self._wait_until_not_busy()
         self._release_semaphore()
 
@@ -829,15 +1057,15 @@ class VizyPowerBoard:
         """
         if val is None:
             self._grab_semaphore()
-            self.bus.write_i2c_block_data(self.addr, EXEC_OFFSET, [EXEC_NVCONFIG])
+            self._write(EXEC_OFFSET, [EXEC_NVCONFIG])
             # Wait until it's ready.
             self._wait_until_not_busy()
-            res = self.bus.read_i2c_block_data(self.addr, EXEC_OFFSET+1, 1)[0]
+            res = self._read(EXEC_OFFSET+1, 1)[0]
             self._release_semaphore()
             return res
 
         self._grab_semaphore()
-        self.bus.write_i2c_block_data(self.addr, EXEC_OFFSET, [EXEC_NVCONFIG|EXEC_WRITE, self._u_int8(val)])
+        self._write(EXEC_OFFSET, [EXEC_NVCONFIG|EXEC_WRITE, self._u_int8(val)])
         self._wait_until_not_busy()
         self._release_semaphore()
 
@@ -863,15 +1091,15 @@ class VizyPowerBoard:
         """
         if val is None:
             self._grab_semaphore()
-            self.bus.write_i2c_block_data(self.addr, EXEC_OFFSET, [EXEC_RTC_CALIBRATE])
+            self._write(EXEC_OFFSET, [EXEC_RTC_CALIBRATE])
             # Wait until it's ready.
             self._wait_until_not_busy()
-            res = self.bus.read_i2c_block_data(self.addr, EXEC_OFFSET+1, 1)[0]
+            res = self._read(EXEC_OFFSET+1, 1)[0]
             self._release_semaphore()
             return res
 
         self._grab_semaphore()
-        self.bus.write_i2c_block_data(self.addr, EXEC_OFFSET, [EXEC_RTC_CALIBRATE|EXEC_WRITE, self._int8(val)])
+        self._write(EXEC_OFFSET, [EXEC_RTC_CALIBRATE|EXEC_WRITE, self._int8(val)])
         self._wait_until_not_busy()
         self._release_semaphore()
 
@@ -889,10 +1117,10 @@ class VizyPowerBoard:
         voltage rail provided to the Raspberry Pi.
         """  
         self._grab_semaphore()
-        self.bus.write_i2c_block_data(self.addr, EXEC_OFFSET, [EXEC_AD, self._u_int8(channel)])
+        self._write(EXEC_OFFSET, [EXEC_AD, self._u_int8(channel)])
         # Wait until it's ready.
         self._wait_until_not_busy()
-        val = self.bus.read_i2c_block_data(self.addr, EXEC_OFFSET+2, 2)
+        val = self._read(EXEC_OFFSET+2, 2)
         self._release_semaphore()
         return (val[1]*0x100 + val[0])/1000
 
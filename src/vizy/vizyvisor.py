@@ -24,6 +24,7 @@ from .updatedialog import UpdateDialog
 from .appsdialog import AppsDialog 
 from .userdialog import UserDialog
 from .systemdialog import SystemDialog
+from .profilerdialog import ProfilerDialog
 from .rebootdialog import RebootDialog
 from .timedialog import TimeDialog
 from .gclouddialog import GcloudDialog
@@ -87,6 +88,7 @@ class VizyVisor(Vizy):
         self.wifi_dialog = WifiDialog(self, PMASK_NETWORKING)
         self.time_dialog = TimeDialog(self, PMASK_TIME)
         self.system_dialog = SystemDialog(self, self.textvisor, PMASK_POWER)
+        self.profiler_dialog = ProfilerDialog(self, PMASK_SYSTEM)
         self.update_dialog = UpdateDialog(self, self.apps_dialog.exit_app, PMASK_UPDATE)
         self.reboot_dialog = RebootDialog(self, PMASK_REBOOT)
         self.gcloud_dialog = GcloudDialog(self, PMASK_GCLOUD)
@@ -99,6 +101,7 @@ class VizyVisor(Vizy):
             self.wifi_dialog.layout, 
             self.time_dialog.layout, 
             self.system_dialog.layout, 
+            self.profiler_dialog.layout, 
             self.shell_item, 
             self.python_item, 
             self.editor_item, 
@@ -165,6 +168,7 @@ class VizyVisor(Vizy):
                     mods += hide(self.time_dialog.layout)
                 if not client.authentication&PMASK_SYSTEM:
                     mods += hide(self.system_dialog.layout)
+                    mods += hide(self.profiler_dialog.layout)
                 if not client.authentication&PMASK_GCLOUD:
                     mods += hide(self.gcloud_dialog.layout)
                 if not client.authentication&PMASK_REMOTE:
@@ -246,6 +250,7 @@ class VizyVisor(Vizy):
         self.apps_dialog.close()
         self.reboot_dialog.close()
         self.time_dialog.close()
+        self.profiler_dialog.close()
         self.remote_dialog.close()
         self.texting_dialog.close()
         self.textvisor.close()
@@ -0,0 +1,203 @@
+#
+# This file is part of Vizy 
+#
+# All Vizy source code is provided under the terms of the
+# GNU General Public License v2 (http://www.gnu.org/licenses/gpl-2.0.html).
+# Those wishing to use Vizy source code, software and/or
+# technologies under different licensing terms should contact us at
+# support@charmedlabs.com. 
+#
+
+# This file only uses the standard library and is run as a script, e.g.
+#   python3 zygote.py serve
+#   python3 zygote.py run main.py [args]
+# so that the "run" client starts quickly.
+
+import os
+import sys
+# When run as a script, don't let this directory's modules shadow the vizy package.
+if __name__=="__main__" and os.path.realpath(sys.path[0])==os.path.dirname(os.path.realpath(__file__)):
+    del sys.path[0]
+import json
+import array
+import signal
+import socket
+import importlib
+from threading import Thread
+
+ZYGOTE_PATH = os.path.realpath(__file__)
+ZYGOTE_SOCKET = "/tmp/vizy_zygote.sock"
+# Modules that most Vizy apps import and take a long time to import.
+PRELOAD = ["numpy", "cv2", "dash", "dash_core_components", "dash_html_components", "dash_bootstrap_components", "dash_devices", "kritter", "kritter.tflite", "vizy.vizy"]
+STDIO = [0, 1, 2]
+# Preloaded modules that do setup based on the environment when they're
+# imported, and the function that redoes it.  The zygote's environment isn't
+# the app's, so these are called in the app process once its environment is
+# in place.
+ENV_HOOKS = {"vizy.vizy": "setup_env"}
+
+# Connections to "run" clients of apps that are still running
+_conns = set()
+
+
+def _send_json(sock, msg, fds=None):
+    data = (json.dumps(msg)+'\n').encode()
+    if fds:
+        sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    else:
+        sock.sendall(data)
+
+def _recv_json(sock, nfds=0):
+    fds = array.array("i")
+    data = b''
+    while not data.endswith(b'\n'):
+        msg, ancdata, flags, addr = sock.recvmsg(4096, socket.CMSG_LEN(nfds*fds.itemsize) if nfds else 0)
+        if not msg:
+            raise ConnectionError("zygote connection closed")
+        data += msg
+        for level, type_, cdata in ancdata:
+            if level==socket.SOL_SOCKET and type_==socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata)-(len(cdata)%fds.itemsize)])
+    return json.loads(data), list(fds)
+
+
+def _child(conn, server, req, fds):
+    # We're the forked app process.  Close the zygote's sockets, including
+    # other apps' connections, so we don't hold them open.
+    server.close()
+    conn.close()
+    for c in list(_conns):
+        c.close()
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_DFL)
+    os.setsid()
+    for i, fd in enumerate(fds):
+        os.dup2(fd, STDIO[i])
+        os.close(fd)
+    os.environ.clear()
+    os.environ.update(req['env'])
+    for module, func in ENV_HOOKS.items():
+        if module in sys.modules:
+            getattr(sys.modules[module], func)()
+    os.chdir(req['cwd'])
+    script = req['argv'][0]
+    sys.argv = req['argv']
+    sys.path.insert(0, os.path.dirname(os.path.realpath(script)))
+    # Don't share random state with other apps.
+    import random
+    random.seed()
+    if "numpy" in sys.modules:
+        sys.modules['numpy'].random.seed()
+    import runpy
+    code = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def _handle(conn, server):
+    try:
+        req, fds = _recv_json(conn, len(STDIO))
+    except Exception as e:
+        print("Zygote request error:", e)
+        conn.close()
+        return
+    pid = os.fork()
+    if pid==0:
+        _child(conn, server, req, fds)
+    for fd in fds:
+        os.close(fd)
+    _conns.add(conn)
+    def wait():
+        _, status = os.waitpid(pid, 0)
+        try:
+            _send_json(conn, {"status": os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else (os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status))})
+        except OSError:
+            pass
+        _conns.discard(conn)
+        conn.close()
+    try:
+        _send_json(conn, {"pid": pid})
+    except OSError:
+        pass
+    Thread(target=wait, daemon=True).start()
+
+
+def serve(path=ZYGOTE_SOCKET, preload=PRELOAD):
+    """
+    Imports the preload modules, then forks a new process for each run
+    request.  Run this as the user that runs the apps.
+    """
+    for m in preload:
+        try:
+            importlib.import_module(m)
+        except Exception as e:
+            print(f"Zygote unable to preload {m}: {e}")
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen()
+    print(f"Zygote ready ({len(preload)} modules preloaded)")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            conn, _ = server.accept()
+            # Fork from the main thread only.
+            _handle(conn, server)
+    finally:
+        server.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def run(argv, path=ZYGOTE_SOCKET):
+    """
+    Runs python script argv[0] (with arguments argv[1:]) in a process
+    forked from the zygote and returns its exit code.  The process shares
+    our stdin/stdout/stderr and we forward signals to it.  Falls back to
+    a plain exec of the script if the zygote isn't running.
+    """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        _send_json(sock, {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}, STDIO)
+        pid = _recv_json(sock)[0]['pid']
+    except (OSError, ValueError, KeyError):
+        os.execvp(sys.executable, [sys.executable] + argv)
+    def forward(signum, frame):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT):
+        signal.signal(sig, forward)
+    while True:
+        try:
+            return _recv_json(sock)[0]['status']
+        except InterruptedError:
+            continue
+        except (OSError, ValueError):
+            return 1
+
+
+if __name__=="__main__":
+    if len(sys.argv)>1 and sys.argv[1]=="serve":
+        serve()
+    elif len(sys.argv)>2 and sys.argv[1]=="run":
+        sys.exit(run(sys.argv[2:]))
+    else:
+        sys.exit(f"usage: {sys.argv[0]} serve | run script.py [args]")